@@ -1,11 +1,19 @@
-from qt_pvp.interest_merge_funcs import merge_overlapping_interests
+from qt_pvp.interest_merge_funcs import merge_overlapping_interests, InterestIntervalSet
+from qt_pvp.interests_search.incremental import IncrementalInterestDetector
 from qt_pvp.cms_interface import functions as cms_api_funcs
 from qt_pvp.functions import parse_interest_name
 from qt_pvp.qt_rm_client import QTRMAsyncClient
 from qt_pvp import functions as main_funcs
+from qt_pvp.async_state import async_state
+from qt_pvp import state_store
 from qt_pvp.cms_interface import cms_http
+from qt_pvp.cms_interface import telemetry_cache
+from qt_pvp.cms_interface import circuit_breaker
+from qt_pvp.cms_interface import session as cms_session
+from qt_pvp.cms_interface import retry_policy
 from qt_pvp.cms_interface import cms_api
 from qt_pvp import cloud_uploader
+from qt_pvp import cloud_reconcile
 from qt_pvp.logger import logger
 from qt_pvp.data import settings
 import posixpath
@@ -26,6 +34,7 @@ class Main:
         self._per_device_sem = {}
         self._devices_sem = None
         self._interest_refill_in_progress = set()
+        self._detectors: dict[str, IncrementalInterestDetector] = {}
         self.qt_rm_client = QTRMAsyncClient(
             base_url=settings.qt_rm_url,
             username=settings.qt_rm_login,
@@ -61,9 +70,10 @@ class Main:
         Сравнивает интересы, найденные при recheck, с тем, что уже лежит на WebDAV:
 
           - берём интересы на облаке в окне [st, en]
-          - фаззи-сравниваем их с recheck_interests
+          - сравниваем их с recheck_interests
           - новые (detected, которых нет на облаке) -> append_pending_interests
           - устаревшие (на облаке, но нет в detected) -> удаляем с облака
+        Листинг, сравнение и удаление — cloud_reconcile (при [Cloud] RECONCILE_DRY_RUN только отчёт).
         """
 
         if not recheck_interests:
@@ -91,103 +101,22 @@ class Main:
                 continue
 
         if not plate:
-            # fallback: пробуем из states.json
-            reg_cfg = main_funcs.get_reg_info(reg_id)
+            # fallback: пробуем из хранилища состояний
+            reg_cfg = await async_state.get_reg_info(reg_id)
             plate = (reg_cfg or {}).get("plate")
 
         if not plate:
             logger.warning(f"{reg_id}: Не удалось определить plate для recheck-синхронизации. Пропускаем.")
             return
 
-        client = cloud_uploader.client
-
-        # Собираем имена интересов на облаке, которые попадают в окно [window_start, window_end]
-        expected_names: set[str] = set()
-
-        # С небольшим запасом по датам, чтобы не откусить края
-        day = window_start.date()
-        last_day = window_end.date()
-        margin_sec = 120  # запас по секундам при отборе интересов по окну
-
-        while day <= last_day:
-            day_str = day.strftime("%Y.%m.%d")
-            cloud_names = cloud_uploader._list_cloud_interest_folders_for_day(client, plate, day_str)
-            for name in cloud_names:
-                try:
-                    _, s_dt, e_dt = main_funcs._interest_name_to_interval(name)
-                except Exception:
-                    continue
-                # отсекаем интересы, которые явно вне окна recheck, с запасом
-                if e_dt < (window_start - datetime.timedelta(seconds=margin_sec)):
-                    continue
-                if s_dt > (window_end + datetime.timedelta(seconds=margin_sec)):
-                    continue
-                expected_names.add(name)
-            day += datetime.timedelta(days=1)
-
-        detected_names: set[str] = set()
-        for it in recheck_interests:
-            nm = (it or {}).get("name")
-            if nm:
-                detected_names.add(nm)
-
-        new_exact, missing_exact = main_funcs.exact_diff_sets(expected_names, detected_names)
-
-        # 2. Новые интересы → в pending_interests
-        if new_exact:
-            raw_to_append = [it for it in recheck_interests if it.get("name") in new_exact]
-            to_append: list[dict] = []
-            for it in raw_to_append:
-                name = it.get("name")
-                if not name:
-                    continue
-                if await self._interest_exists_in_cloud(name):
-                    logger.info(f"{reg_id}: RECHECK: {name} уже есть в облаке, пропускаем добавление в pending.")
-                    continue
-                to_append.append(it)
-            if to_append:
-                logger.info(
-                    f"{reg_id}: RECHECK: обнаружено {len(to_append)} новых интересов по сравнению с WebDAV "
-                    f"(будут добавлены в pending_interests)."
-                )
-                main_funcs.append_pending_interests(reg_id, to_append)
-
-        # 3. Устаревшие интересы → удалить с облака
-        for name in sorted(missing_exact):
-            try:
-                plate2, s_dt, _ = main_funcs._interest_name_to_interval(name)
-            except Exception:
-                logger.warning(f"{reg_id}: RECHECK: не удалось распарсить имя устаревшего интереса '{name}' — пропуск.")
-                continue
-
-            day_str = s_dt.strftime("%Y.%m.%d")
-            folder_path = f"{settings.CLOUD_PATH}/{plate2}/{day_str}/{name}"
-
-            try:
-                logger.info(f"{reg_id}: RECHECK: удаляем устаревший интерес с WebDAV: {folder_path}")
-                client.clean(folder_path)
-            except cloud_uploader.RemoteResourceNotFound:
-                logger.info(f"{reg_id}: RECHECK: папка интереса уже отсутствует: {folder_path}")
-            except Exception as e:
-                logger.error(f"{reg_id}: RECHECK: ошибка при удалении интереса '{name}' из WebDAV: {e}")
-
-
-    async def _interest_exists_in_cloud(self, interest_name: str) -> bool:
-        """
-        Осторожно проверяет наличие папки интереса в облаке с кэшем WebDAV.
-        """
-        try:
-            _, _, folder_path = cloud_uploader.get_interest_folder_path(interest_name, settings.CLOUD_PATH)
-        except Exception as e:
-            logger.warning(f"Не удалось получить путь интереса '{interest_name}' для проверки на облаке: {e}")
-            return False
-
-        try:
-            return await cloud_uploader.cached_check(cloud_uploader.client, folder_path)
-        except Exception as e:
-            logger.warning(f"[WEBDAV] Ошибка cached_check для '{folder_path}': {e}")
-            return False
-
+        await cloud_reconcile.reconcile(
+            reg_id=reg_id,
+            plate=plate,
+            detected=recheck_interests,
+            window_start=window_start,
+            window_end=window_end,
+            add=lambda new: async_state.append_pending_interests(reg_id, new),
+        )
 
     async def get_devices_online(self):
         devices_online = await cms_api.get_online_devices(self.jsession)
@@ -211,92 +140,104 @@ class Main:
             if reg_id in self.devices_in_progress:
                 self.devices_in_progress.remove(reg_id)
 
-    async def get_interests_async(self, reg_id, reg_info, start_time, stop_time):
+    async def get_interests_async(self, reg_id, reg_info, start_time, stop_time, refresh: bool = False):
         """
         Асинхронная версия получения интересов:
-        - CMS треки (queryTrackDetail) — в thread-пуле через asyncio.to_thread
-        - CMS alarm detail — в thread-пуле через asyncio.to_thread
-        - Подготовка алармов/сшивка — синхронно (CPU), можно оставить в основном потоке
-        Логика «шага назад по минуте» (max_extra_pulls) сохранена.
+        - CMS треки (queryTrackDetail) и alarm detail — параллельно, одним окном сразу с запасом
+          истории перед start_time (lookback_pad_sec); при включённом [Telemetry] — через
+          дисковый кэш, который догружает только недостающие куски окна
+        - концевики разбираются с start_time, треки до него — история для поиска остановки;
+          если её не хватило, догружается только недостающий префикс
+        - refresh (recheck) — из CMS перекачиваются куски, закэшированные до того, как данные
+          устоялись: ловим досланные данные; скачанное уже устоявшимся берётся из кэша
         """
-        max_extra_pulls = 8  # максимум шагов назад по минуте
-        pulls = 0
-
-        while True:
-            start_time_dt = datetime.datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
-
-            tracks_task = asyncio.create_task(cms_api.get_device_track_all_pages_async(
-                self.jsession, reg_id, start_time, stop_time))
-            alarms_task = asyncio.create_task(cms_api.get_device_alarm_all_pages_async(self.jsession, reg_id, start_time, stop_time))
-            tracks, alarm_reports = await asyncio.gather(tracks_task, alarms_task)
-            tracks = [t for page in tracks for t in (page.get("tracks") or [])]
-            all_alarms = []
-            for page in alarm_reports:
-                all_alarms.extend(page.get("alarms") or [])
-            #for alarm in all_alarms:
-            #    print(alarm)
-
-            prepared = cms_api_funcs.prepare_alarms(
-                raw_alarms=all_alarms,
-                reg_cfg=reg_info,
-                allowed_atp=frozenset({19, 20, 21, 22}),
-                min_stop_speed_kmh=settings.config.getint("Interests", "MIN_STOP_SPEED") / 10.0,
-                merge_gap_sec=15,
-                reg_id=reg_id
-            )
+        detector = IncrementalInterestDetector(reg_id)
+        detector.reset(start_time)
+        tracks, all_alarms = await self._fetch_telemetry(reg_id, detector.fetch_from(), stop_time, refresh)
+        detector.extend(tracks, all_alarms, stop_time)
+
+        result = await self._detect_with_history(detector, reg_id, reg_info, refresh)
+        if result.in_progress and not result.interests:
+            logger.info("Прерываем обработку интересов потому что машина грузится в это время ")
+            return {"error": "Loading in progress"}
+        return result.interests
+
+    async def _fetch_telemetry(self, reg_id, start_time, stop_time, refresh: bool = False) -> tuple[list, list]:
+        """
+        Плоские списки треков и сырых алармов за [start_time, stop_time].
+        refresh — перекачать куски кэша, скачанные до того, как данные устоялись.
+        """
+        cache = telemetry_cache.get_cache()
+        if cache is not None:
+            # из CMS догружаются только непокрытые куски окна (при refresh — и неустоявшиеся)
+            return await asyncio.gather(
+                cache.get_tracks(self.jsession, reg_id, start_time, stop_time, refresh=refresh),
+                cache.get_alarms(self.jsession, reg_id, start_time, stop_time, refresh=refresh))
+        tracks_task = asyncio.create_task(cms_api.get_device_track_all_pages_async(
+            self.jsession, reg_id, start_time, stop_time))
+        alarms_task = asyncio.create_task(cms_api.get_device_alarm_all_pages_async(self.jsession, reg_id, start_time, stop_time))
+        tracks, alarm_reports = await asyncio.gather(tracks_task, alarms_task)
+        tracks = [t for page in tracks for t in (page.get("tracks") or [])]
+        all_alarms = []
+        for page in alarm_reports:
+            all_alarms.extend(page.get("alarms") or [])
+        return tracks, all_alarms
+
+    async def get_new_interests_async(self, reg_id, reg_info, start_time, stop_time) -> tuple[list, str | None]:
+        """
+        Прямой проход через инкрементальный детектор устройства: догружается только то,
+        чего нет в его буфере, разбираются только новые треки.
+        Возвращает (окончательные интересы, время незавершённой погрузки или None) —
+        раньше этого времени last_upload_time сдвигать нельзя.
+        """
+        detector = self._detectors.get(reg_id)
+        if detector is None:
+            detector = self._detectors[reg_id] = IncrementalInterestDetector(reg_id)
+        if not detector.continues(start_time):
+            detector.reset(start_time)
 
-            try:
-                interests = cms_api_funcs.find_interests_by_lifting_switches(
-                    tracks=tracks,
-                    start_tracks_search_time=start_time_dt,
-                    reg_id=reg_id,
-                    alarms=prepared,
-                )
-            except cms_api_funcs.LoadingInProgress:
-                logger.info("Прерываем обработку интересов потому что машина грузится в это время ")
-                return {"error": "Loading in progress"}
-
-            if isinstance(interests, dict) and "interests" in interests:
-                return interests["interests"]
-
-            elif isinstance(interests, dict) and "error" in interests:
-                pulls += 1
-                if pulls > max_extra_pulls:
-                    logger.warning(f"[GUARD] Достигнут предел догрузок (pulls={pulls}). Останавливаемся.")
-                    return []
-                # двигаемся на минуту назад
-                start_time = (start_time_dt - datetime.timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
-                logger.info(f"Теперь ищем треки с {start_time}")
-                continue
+        fetch_from = detector.fetch_from()
+        if fetch_from <= stop_time:
+            tracks, alarms = await self._fetch_telemetry(reg_id, fetch_from, stop_time)
+            detector.extend(tracks, alarms, stop_time)
 
-            else:
-                # На случай иных форматов ответа
-                logger.warning(f"[ANALYZE] Неожиданный формат из find_interests_by_lifting_switches: {type(interests)}")
-                return []
+        result = await self._detect_with_history(detector, reg_id, reg_info)
+        return result.interests, (detector.scan_from if result.in_progress else None)
 
-    def _parse_start_ts(self, it: dict):
-        try:
-            return datetime.datetime.strptime(it.get("start_time", ""), settings.TIME_FMT)
-        except Exception:
-            return datetime.datetime.max  # если испорченный интерес — обрабатываем в самом конце
+    async def _detect_with_history(self, detector, reg_id, reg_info, refresh: bool = False):
+        """
+        Разбор буфера детектора. Если у первого концевика не хватило истории — догружаем
+        только недостающий префикс перед буфером и разбираем ещё раз локально; уже скачанное
+        окно не перекачивается.
+        """
+        result = await asyncio.to_thread(detector.detect, reg_info)
+        missing = detector.missing_history()
+        if result.need_history and missing:
+            since, until = missing
+            logger.info(f"{reg_id}: Догружаем историю [{since} → {until}]")
+            tracks, alarms = await self._fetch_telemetry(reg_id, since, until, refresh)
+            detector.prepend(tracks, alarms, since)
+            # глубже поиск остановки не заглядывает — дальше ищем с тем, что есть
+            result = await asyncio.to_thread(detector.detect, reg_info, True)
+        return result
 
     async def download_reg_videos(self, reg_id, plate):
         logger.debug(f"{reg_id}. Начинаем работу с устройством.")
 
         # Информация о регистраторе
-        reg_info = main_funcs.get_reg_info(reg_id) or main_funcs.create_new_reg(reg_id, plate)
+        reg_info = await async_state.get_reg_info(reg_id) or await async_state.create_new_reg(reg_id, plate)
         logger.debug(f"{reg_id}. Информация о регистраторе: {reg_info}.")
 
         ignore = reg_info.get("ignore", False)
         if ignore:
-            logger.debug(f"{reg_id}. Игнорируем регистратор, поскольку в states.json параметр ignore=true.")
+            logger.debug(f"{reg_id}. Игнорируем регистратор, поскольку в его состоянии (state_store) параметр ignore=true.")
             return
 
-        # Pending - уже извлеченные из CMS и сохраненные в states.json интересы
-        pending = main_funcs.get_pending_interests(reg_id)
+        # Pending - уже извлеченные из CMS и сохраненные в хранилище состояний интересы
+        pending = await async_state.get_pending_interests(reg_id)
         if not pending:
             await self._refill_pending_interests_if_due(reg_id)     # Извлечь новые интересы из CMS
-            pending = main_funcs.get_pending_interests(reg_id)
+            pending = await async_state.get_pending_interests(reg_id)
 
         if pending:
             interests = pending
@@ -308,26 +249,26 @@ class Main:
             return True
 
         logger.info(f"{reg_id}: Найдено {len(interests)} интересов")
-        interests = merge_overlapping_interests(interests)
-        logger.info(f"{reg_id}: К запуску {len(interests)} интересов (после фильтра processed).")
-
-        # сортируем интересы по времени начала, старые сначала
-        interests.sort(key=self._parse_start_ts)
+        # слитые интересы по времени начала, старые сначала
+        interest_set = InterestIntervalSet(interests)
+        logger.info(f"{reg_id}: К запуску {len(interest_set)} интересов (после фильтра processed).")
 
-        total_found = len(interests)
+        total_found = len(interest_set)
         max_per_batch = settings.config.getint("Interests", "MAX_INTERESTS_PER_BATCH", fallback=8)
+        # слитый интерес получает новое имя — claim/complete идут по именам исходных записей очереди
+        batch = interest_set.oldest_with_sources(max_per_batch)
         if total_found > max_per_batch:
             logger.info(
                 f"{reg_id}: Берём в работу только {max_per_batch} из {total_found} интересов (батч). "
                 f"Остальные — в следующий цикл."
             )
-            interests = interests[:max_per_batch]
         else:
             logger.info(f"{reg_id}: Влезают все интересы ({total_found}) в одну пачку.")
 
         # Стартуем задачи (сами ограничители внутри)
         channel_id = reg_info.get("chanel_id")
-        tasks = [asyncio.create_task(self._process_one_interest(it, channel_id)) for it in interests]
+        tasks = [asyncio.create_task(self._run_pending_interest(it, channel_id, sources))
+                 for it, sources in batch]
 
         # Собираем результаты по мере готовности
         end_times: list[str] = []
@@ -355,10 +296,48 @@ class Main:
             for t in tasks:
                 if not t.done():
                     t.cancel()
-        logger.info(f"{reg_id}: Пакет интересов завершён: {len(end_times)}/{len(interests)}")
+        logger.info(f"{reg_id}: Пакет интересов завершён: {len(end_times)}/{len(batch)}")
+
 
+    async def _run_pending_interest(self, interest: dict, channel_id,
+                                    source_names: list[str] | None = None) -> str | None:
+        """
+        Обёртка над _process_one_interest для очереди pending. source_names — имена записей
+        очереди, из которых слит interest (по умолчанию — его собственное имя): все они
+        помечаются взятыми в работу; если хоть одну уже взял другой обработчик — снимаем
+        свои claim и пропускаем интерес. Записи, которые обработка не закрыла (упала или
+        вернулась без удаления из очереди), возвращаются в очередь с учётом попытки.
+        """
+        reg_id = interest.get("reg_id")
+        interest_name = interest.get("name")
+        names = list(source_names or [interest_name])
+        claimed: list[str] = []
+        for name in names:
+            if not await async_state.claim_pending_interest(reg_id, name):
+                logger.debug(f"{reg_id}: {name} уже в работе у другого обработчика — пропускаем {interest_name}")
+                for other in claimed:
+                    await async_state.release_pending_interest(reg_id, other)
+                return None
+            claimed.append(name)
+        error = "обработка завершилась, не убрав интерес из очереди"
+        try:
+            # общий бюджет времени на все CMS-запросы интереса (включая вложенные задачи)
+            with retry_policy.deadline(settings.config.getfloat("Retry", "INTEREST_DEADLINE_SEC", fallback=0)):
+                return await self._process_one_interest(interest, channel_id, names)
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            # для уже закрытых (complete) записей fail — no-op
+            for name in claimed:
+                try:
+                    await async_state.fail_pending_interest(reg_id, name, error)
+                except Exception as err:
+                    logger.warning(f"{reg_id}: Не удалось вернуть {name} в очередь: {err}")
 
-    async def _process_one_interest(self, interest: dict, channel_id) -> str | None:
+    async def _process_one_interest(self, interest: dict, channel_id,
+                                    pending_names: list[str] | None = None) -> str | None:
+        """pending_names — записи очереди, которые закрываются вместе с интересом (по умолчанию — его имя)."""
         reg_id = interest.get("reg_id")
         # Ограничители глобально и по устройству
         async with self._get_global_sem(), self._get_device_sem(reg_id):
@@ -376,7 +355,7 @@ class Main:
 
             if not cloud_paths:
                 logger.error(f"{reg_id}: Не удалось создать папки для {interest_name}. Пропускаем интерес.")
-                self.del_pending_interest(reg_id, interest_name)
+                await self.del_pending_interest(reg_id, *(pending_names or [interest_name]))
                 return interest["end_time"]
 
             interest_cloud_folder = cloud_paths["interest_folder_path"]
@@ -415,15 +394,16 @@ class Main:
 
             if not final_channels_to_download:
                 logger.info("Нечего скачивать, все материалы уже есть в облаке.")
-                self.del_pending_interest(reg_id, interest_name)
+                await self.del_pending_interest(reg_id, *(pending_names or [interest_name]))
                 return None
 
-            # 4) скачиваем по одному клипу на канал
+            # 4) скачиваем по одному клипу на канал: полный — только для chanel_id, остальным — окна под кадры
             channels_files_dict = await cms_api.download_single_clip_per_channel(
                 jsession=self.jsession,
                 reg_id=reg_id,
                 interest=interest,
-                channels=final_channels_to_download
+                channels=final_channels_to_download,
+                frame_only_channels=[ch for ch in final_channels_to_download if ch not in to_download_for_full_clip],
             )
             # оставляем полную структуру для доступа к concat_sources при отладке
             channels_info = channels_files_dict
@@ -483,7 +463,7 @@ class Main:
                     asyncio.create_task(
                         self.qt_rm_client.recognize_webdav(interest_name=interest_name)
                     )
-                self.del_pending_interest(reg_id, interest_name)
+                await self.del_pending_interest(reg_id, *(pending_names or [interest_name]))
                 total_src_removed = 0
                 for ch, info in channels_info.items():
                     sources = (info or {}).get("concat_sources") or []
@@ -515,12 +495,13 @@ class Main:
 
         return interest["end_time"]
 
-    def del_pending_interest(self, reg_id, interest_name):
-        logger.info(f"{reg_id}: Удаляем pending interest: {interest_name}")
-        try:
-            main_funcs.remove_pending_interest(reg_id, interest_name)
-        except Exception as e:
-            logger.warning(f"{reg_id}: Не удалось удалить {interest_name} из pending_interests: {e}")
+    async def del_pending_interest(self, reg_id, *interest_names):
+        for interest_name in interest_names:
+            logger.info(f"{reg_id}: Удаляем pending interest: {interest_name}")
+            try:
+                await async_state.remove_pending_interest(reg_id, interest_name)
+            except Exception as e:
+                logger.warning(f"{reg_id}: Не удалось удалить {interest_name} из pending_interests: {e}")
 
 
     async def get_channels_to_download_pics(self, interest_cloud_path):
@@ -593,9 +574,14 @@ class Main:
             cloud_uploader.upload_file, video_path, cloud_folder)
         return upload_status
 
+    @property
+    def jsession(self) -> str | None:
+        """Текущая общая на процесс сессия CMS (обновляется менеджером сессий)."""
+        return cms_session.get_manager().jsession
+
     async def login(self):
-        login_result = await cms_api.login()
-        self.jsession = login_result.json()["jsession"]
+        # логин один на процесс: повторный вызов вернёт уже полученную сессию
+        await cms_session.get_manager().get()
 
     async def mainloop(self):
         logger.info("Mainloop has been launched with success.")
@@ -614,17 +600,36 @@ class Main:
                 if reg_id in self.devices_in_progress:
                     continue
 
-                async def _run_with_limit(rid, pl):
+                # устройство недавно уходило в офлайн — ждём окончания паузы
+                gate = circuit_breaker.allow(reg_id)
+                if gate == circuit_breaker.OPEN:
+                    continue
+
+                async def _run_with_limit(rid, pl, probe):
                     async with self._get_devices_sem():
+                        if probe and not await self._probe_device(rid):
+                            return
                         await self.operate_device(rid, pl)
 
                 # Стартуем корутину и НЕ ждём всю пачку
-                t = asyncio.create_task(_run_with_limit(reg_id, plate))
+                t = asyncio.create_task(_run_with_limit(reg_id, plate, gate == circuit_breaker.HALF_OPEN))
                 self._running.add(t)
                 t.add_done_callback(self._running.discard)
 
             await asyncio.sleep(3)
 
+    async def _probe_device(self, reg_id: str) -> bool:
+        """Пауза circuit breaker истекла: одна проба getDeviceStatus перед тяжёлой работой."""
+        online = False
+        try:
+            online = await cms_api.probe_device_online(self.jsession, reg_id)
+        finally:
+            if online:
+                circuit_breaker.record_success(reg_id)
+            else:
+                circuit_breaker.record_failure(reg_id, "probe: device offline")
+        return online
+
     async def _refill_pending_interests_if_due(self, reg_id: str) -> None:
         """
         Пополняет очередь pending_interests для reg_id двумя способами:
@@ -651,7 +656,7 @@ class Main:
         try:
             TIME_FMT = "%Y-%m-%d %H:%M:%S"
 
-            reg_info = main_funcs.get_reg_info(reg_id)
+            reg_info = await async_state.get_reg_info(reg_id)
 
             # --- last_upload_time (как раньше) ---
             last_up_str = reg_info.get("last_upload_time")
@@ -725,7 +730,8 @@ class Main:
                     )
                     verified_long_dt = earliest_allowed
 
-            collected: list[dict] = []
+            # интересы прямого прохода сливаются при добавлении, без повторной склейки всего списка
+            collected = InterestIntervalSet()
 
             def day_end(dt: datetime.datetime) -> datetime.datetime:
                 return dt.replace(hour=23, minute=59, second=59)
@@ -733,6 +739,24 @@ class Main:
             def day_start(dt: datetime.datetime) -> datetime.datetime:
                 return dt.replace(hour=0, minute=0, second=0)
 
+            incremental = settings.config.getboolean("Interests", "INCREMENTAL_DETECTION", fallback=True)
+
+            async def _forward_window(st: str, en: str) -> tuple[list, str]:
+                """Интересы окна и до какого времени сдвигать last_upload_time."""
+                reg_cfg = await async_state.get_reg_info(reg_id) or await async_state.create_new_reg(reg_id, plate=None)
+                resume_at = None
+                if incremental:
+                    interests, resume_at = await self.get_new_interests_async(reg_id, reg_cfg, st, en)
+                else:
+                    interests = await self.get_interests_async(reg_id, reg_cfg, st, en)
+                if interests:
+                    collected.update(interests)
+                    en = max(interest["end_time"] for interest in interests)
+                if resume_at:
+                    # незавершённая погрузка: следующий проход должен начаться не позже её концевика
+                    en = min(en, resume_at)
+                return interests, en
+
             # --- 1) Обычный forward-проход от last_upload_time к now ---
             if forward_due:
                 cur = last_up
@@ -742,29 +766,16 @@ class Main:
                 while cur.date() < today:
                     st = cur.strftime(TIME_FMT)
                     en_dt = day_end(cur)
-                    en = en_dt.strftime(TIME_FMT)
-
-                    reg_cfg = main_funcs.get_reg_info(reg_id) or main_funcs.create_new_reg(reg_id, plate=None)
-                    interests = await self.get_interests_async(reg_id, reg_cfg, st, en)
-                    if interests:
-                        interests = merge_overlapping_interests(interests)
-                        collected.extend(interests)
-                        en = max(interest["end_time"] for interest in interests)
+                    _, en = await _forward_window(st, en_dt.strftime(TIME_FMT))
 
-                    main_funcs.save_new_reg_last_upload_time(reg_id, en)
+                    await async_state.save_new_reg_last_upload_time(reg_id, en)
                     cur = en_dt + datetime.timedelta(seconds=1)
 
                 # остаток "сегодня до текущего момента"
                 if cur <= now:
                     st = cur.strftime(TIME_FMT)
-                    en = now.strftime(TIME_FMT)
-                    reg_cfg = main_funcs.get_reg_info(reg_id) or main_funcs.create_new_reg(reg_id, plate=None)
-                    interests = await self.get_interests_async(reg_id, reg_cfg, st, en)
-                    if interests:
-                        interests = merge_overlapping_interests(interests)
-                        collected.extend(interests)
-                        en = max(interest["end_time"] for interest in interests)
-                    main_funcs.save_new_reg_last_upload_time(reg_id, en)
+                    _, en = await _forward_window(st, now.strftime(TIME_FMT))
+                    await async_state.save_new_reg_last_upload_time(reg_id, en)
 
             # --- 2) Recheck-проход от verified_until к now ---
             if recheck_due:
@@ -776,8 +787,8 @@ class Main:
                     f"после паузы {recheck_hours}ч."
                 )
 
-                reg_cfg = main_funcs.get_reg_info(reg_id) or main_funcs.create_new_reg(reg_id, plate=None)
-                recheck_interests = await self.get_interests_async(reg_id, reg_cfg, st, en)
+                reg_cfg = await async_state.get_reg_info(reg_id) or await async_state.create_new_reg(reg_id, plate=None)
+                recheck_interests = await self.get_interests_async(reg_id, reg_cfg, st, en, refresh=True)
                 if recheck_interests:
                     recheck_interests = merge_overlapping_interests(recheck_interests)
                     # ВАЖНО: не добавляем их в collected, а синхронизируем с облаком
@@ -790,7 +801,7 @@ class Main:
                     )
 
                 # фиксируем, что этот интервал проверен
-                main_funcs.save_reg_verified_until(reg_id, en)
+                await async_state.save_reg_verified_until(reg_id, en)
                 try:
                     verified_dt = datetime.datetime.strptime(en, TIME_FMT)
                 except Exception:
@@ -806,8 +817,9 @@ class Main:
                         f"после паузы {recheck_long_hours}ч."
                     )
 
-                    reg_cfg = main_funcs.get_reg_info(reg_id) or main_funcs.create_new_reg(reg_id, plate=None)
-                    long_recheck_interests = await self.get_interests_async(reg_id, reg_cfg, st_long, en_long)
+                    reg_cfg = await async_state.get_reg_info(reg_id) or await async_state.create_new_reg(reg_id, plate=None)
+                    long_recheck_interests = await self.get_interests_async(reg_id, reg_cfg, st_long, en_long,
+                                                                            refresh=True)
                     if long_recheck_interests:
                         long_recheck_interests = merge_overlapping_interests(long_recheck_interests)
                         await self._sync_recheck_with_cloud(
@@ -818,7 +830,7 @@ class Main:
                             time_fmt=TIME_FMT,
                         )
 
-                    main_funcs.save_reg_verified_until_long(reg_id, en_long)
+                    await async_state.save_reg_verified_until_long(reg_id, en_long)
                     try:
                         verified_long_dt = datetime.datetime.strptime(en_long, TIME_FMT)
                     except Exception:
@@ -826,7 +838,7 @@ class Main:
 
             # --- forward-результат пишем в pending_interests (с дедупом по имени) ---
             if collected:
-                main_funcs.append_pending_interests(reg_id, collected)
+                await async_state.append_pending_interests(reg_id, collected.to_list())
 
         finally:
             self._interest_refill_in_progress.discard(reg_id)
@@ -840,6 +852,10 @@ async def _run():
     finally:
         # всегда освобождаем соединения httpx
         await cms_http.close_cms_async_client()
+        await cloud_reconcile.close_http_client()
+        # дожидаемся записей состояния, стоящих в очереди, и сбрасываем write-behind кэш
+        async_state.shutdown(wait=True)
+        state_store.checkpoint()
 
 
 if __name__ == "__main__":
@@ -1,17 +1,23 @@
 import os
+import json
 import asyncio
 import datetime
 from typing import List, Optional
 
 from fastapi import FastAPI, HTTPException, Security, Depends
+from fastapi.responses import StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field, validator
 from webdav3.client import Client
 from webdav3.exceptions import RemoteResourceNotFound
 
-from qt_pvp import functions as main_funcs
+from qt_pvp.async_state import async_state
+from qt_pvp import state_store
 from qt_pvp.interest_merge_funcs import merge_overlapping_interests
 from qt_pvp.cms_interface import functions as cms_funcs
+from qt_pvp.cms_interface import limits as cms_limits
+from qt_pvp.cms_interface import session as cms_session
+from qt_pvp import cloud_reconcile
 from main_operator import Main
 
 
@@ -84,24 +90,9 @@ async def get_all_devices_from_cms(jsession: str) -> list[dict]:
 
 
 def get_reg_id_by_car_num_local(car_num: str) -> Optional[str]:
-    """Поиск reg_id по госномеру машины в states.json"""
+    """Поиск reg_id по госномеру машины в локальном хранилище состояний (индекс госномеров)"""
     try:
-        from qt_pvp.data import settings
-        import json
-        
-        with open(settings.states, 'r', encoding='utf-8') as f:
-            states = json.load(f)
-        
-        regs = states.get('regs', {})
-        for reg_id, reg_info in regs.items():
-            plate = reg_info.get('plate', '')
-            if not plate:
-                continue
-            plate = plate.upper().replace(' ', '')
-            search_plate = car_num.upper().replace(' ', '')
-            if plate == search_plate:
-                return reg_id
-        return None
+        return state_store.get_store().find_reg_id_by_plate(car_num)
     except Exception:
         return None
 
@@ -144,17 +135,15 @@ async def resolve_reg_id(reg_id: Optional[str], car_num: Optional[str], jsession
         return reg_id
     
     if car_num:
-        # 1) Сначала ищем локально в states.json
-        found_reg_id = get_reg_id_by_car_num_local(car_num)
+        # 1) Сначала ищем локально в хранилище состояний
+        found_reg_id = await asyncio.to_thread(get_reg_id_by_car_num_local, car_num)
         if found_reg_id:
-            logger.info(f"[resolve_reg_id] Found in states.json: {car_num} -> {found_reg_id}")
+            logger.info(f"[resolve_reg_id] Found in local state: {car_num} -> {found_reg_id}")
             return found_reg_id
         
-        # 2) Запрос в CMS (создаем jsession если нет)
+        # 2) Запрос в CMS (общая сессия процесса, если не передали)
         if not jsession:
-            from qt_pvp.cms_interface import cms_api
-            login_resp = await cms_api.login()
-            jsession = login_resp.json()["jsession"]
+            jsession = await cms_session.get_manager().get()
         
         found_reg_id = await get_reg_id_by_car_num_cms(car_num, jsession)
         if found_reg_id:
@@ -188,55 +177,9 @@ def list_interest_folders(client: Client, base_path: str, plate: str, day_str: s
     return sorted(names)
 
 
-def parse_folder_name(name: str):
-    plate, rest = name.split("_", 1)
-    left, right = rest.split("-")
-    start_dt = datetime.datetime.strptime(left.strip(), TIME_FMT_FN)
-    date_prefix = start_dt.strftime("%Y.%m.%d")
-    end_dt = datetime.datetime.strptime(f"{date_prefix} {right.strip()}", TIME_FMT_FN)
-    return plate, start_dt, end_dt
-
-
-def fuzzy_equal(n1: str, n2: str, eps_sec: int = 10) -> bool:
-    try:
-        p1, s1, e1 = parse_folder_name(n1)
-        p2, s2, e2 = parse_folder_name(n2)
-    except Exception:
-        return False
-    return (
-        p1 == p2 and
-        abs((s1 - s2).total_seconds()) <= eps_sec and
-        abs((e1 - e2).total_seconds()) <= eps_sec
-    )
-
-
 def diff_sets(expected, detected, eps_sec: int = 0):
-    new = set(detected)
-    missing = set(expected)
-    if eps_sec <= 0:
-        return new - expected, missing - detected
-
-    matched_exp = set()
-    matched_det = set()
-
-    for e in expected:
-        for d in detected:
-            if d in matched_det:
-                continue
-
-            if e == d:
-                matched_exp.add(e)
-                matched_det.add(d)
-                break
-
-            if fuzzy_equal(e, d, eps_sec=eps_sec):
-                matched_exp.add(e)
-                matched_det.add(d)
-                break
-
-    new -= matched_det
-    missing -= matched_exp
-    return new, missing
+    """(new, missing) с фаззи-сопоставлением имён по времени (eps_sec) — cloud_reconcile.diff_names."""
+    return cloud_reconcile.diff_names(expected, detected, eps_sec)
 
 
 class CompareRequest(BaseModel):
@@ -310,13 +253,57 @@ class StopsRequest(BaseModel):
         return v
 
 
+class StopsBatchRequest(BaseModel):
+    reg_ids: List[str] = Field(default_factory=list, description="DevIDNO регистраторов")
+    car_nums: List[str] = Field(default_factory=list, description="Госномера автомобилей")
+    date_from: str = Field(..., description="Первая дата, YYYY-MM-DD")
+    date_to: str = Field(..., description="Последняя дата (включительно), YYYY-MM-DD")
+    sites: List[SiteItem]
+    radius_m: float = 120.0
+
+    @validator("date_from", "date_to")
+    def _check_date(cls, v):
+        try:
+            datetime.datetime.strptime(v, "%Y-%m-%d")
+        except Exception as e:
+            raise ValueError(f"date must be YYYY-MM-DD: {e}")
+        return v
+
+    @validator("date_to")
+    def _check_range(cls, v, values):
+        start = values.get("date_from")
+        if start and v < start:
+            raise ValueError("date_to must not be earlier than date_from")
+        return v
+
+    @validator("reg_ids", "car_nums")
+    def _check_devices_limit(cls, v):
+        from qt_pvp.data import settings
+        max_devices = settings.config.getint("Process", "STOPS_BATCH_MAX_DEVICES", fallback=100)
+        if len(v) > max_devices:
+            raise ValueError(f"at most {max_devices} devices per request")
+        return v
+
+    @validator("car_nums", always=True)
+    def _check_devices(cls, v, values):
+        if not values.get("reg_ids") and not v:
+            raise ValueError("Either reg_ids or car_nums must be provided")
+        return v
+
+
 app = FastAPI(title="qt_pvp API")
 
 
+_main: Main | None = None
+
+
 async def _get_main_logged_in() -> Main:
-    m = Main()
-    await m.login()
-    return m
+    """Один Main на процесс API; сессия CMS общая и обновляется сама."""
+    global _main
+    if _main is None:
+        _main = Main()
+    await _main.login()
+    return _main
 
 
 @app.post("/compare-interests")
@@ -327,7 +314,7 @@ async def compare_interests(req: CompareRequest, authorized: bool = Depends(veri
     # Логинимся в CMS для resolve и дальнейших запросов
     m = await _get_main_logged_in()
     reg_id = await resolve_reg_id(req.reg_id, req.car_num, m.jsession)
-    reg_info = main_funcs.get_reg_info(reg_id) or {}
+    reg_info = await async_state.get_reg_info(reg_id) or {}
     plate = reg_info.get("plate") or reg_id
 
     try:
@@ -340,7 +327,7 @@ async def compare_interests(req: CompareRequest, authorized: bool = Depends(veri
     start_time = f"{day_dt.strftime('%Y-%m-%d')} 00:00:00"
     stop_time = f"{day_dt.strftime('%Y-%m-%d')} 23:59:59"
 
-    reg_info_full = main_funcs.get_reg_info(reg_id)
+    reg_info_full = await async_state.get_reg_info(reg_id)
     interests = await m.get_interests_async(
         reg_id=reg_id,
         reg_info=reg_info_full,
@@ -365,7 +352,7 @@ async def compare_interests(req: CompareRequest, authorized: bool = Depends(veri
 async def get_interests_api(req: InterestRequest, authorized: bool = Depends(verify_api_key)):
     m = await _get_main_logged_in()
     reg_id = await resolve_reg_id(req.reg_id, req.car_num, m.jsession)
-    reg_info_full = main_funcs.get_reg_info(reg_id)
+    reg_info_full = await async_state.get_reg_info(reg_id)
     interests = await m.get_interests_async(
         reg_id=reg_id,
         reg_info=reg_info_full,
@@ -391,6 +378,91 @@ async def find_stops_api(req: StopsRequest, authorized: bool = Depends(verify_ap
     return res
 
 
+def _date_range(date_from: str, date_to: str) -> list[str]:
+    day = datetime.datetime.strptime(date_from, "%Y-%m-%d").date()
+    last = datetime.datetime.strptime(date_to, "%Y-%m-%d").date()
+    out = []
+    while day <= last:
+        out.append(day.strftime("%Y-%m-%d"))
+        day += datetime.timedelta(days=1)
+    return out
+
+
+@app.post("/find-stops/batch")
+async def find_stops_batch_api(req: StopsBatchRequest, authorized: bool = Depends(verify_api_key)):
+    """
+    Остановки у площадок по нескольким устройствам за диапазон дат.
+    Ответ — NDJSON: строка на каждую пару (устройство, дата) по мере готовности:
+    {"reg_id", "car_num", "date", "sites": [...]} или {"reg_id", "car_num", "date", "error"}.
+    Одновременно считается не больше [Process] STOPS_BATCH_CONCURRENCY пар; запросы к CMS
+    идут через общие лимиты процесса.
+    """
+    from qt_pvp.logger import logger
+    from qt_pvp.data import settings
+
+    dates = _date_range(req.date_from, req.date_to)
+    max_days = settings.config.getint("Process", "STOPS_BATCH_MAX_DAYS", fallback=31)
+    if len(dates) > max_days:
+        raise HTTPException(status_code=400, detail=f"Date range is longer than {max_days} days")
+    concurrency = max(1, settings.config.getint("Process", "STOPS_BATCH_CONCURRENCY", fallback=8))
+    sites = [s.dict() for s in req.sites]
+    m = await _get_main_logged_in()
+    devices = [(reg_id, None) for reg_id in req.reg_ids] + [(None, car_num) for car_num in req.car_nums]
+
+    resolved: dict[str, asyncio.Task] = {}
+
+    async def _reg_id_of(car_num: str) -> str:
+        # госномер ищется один раз на запрос, а не на каждую дату
+        task = resolved.get(car_num)
+        if task is None:
+            task = resolved[car_num] = asyncio.ensure_future(resolve_reg_id(None, car_num, m.jsession))
+        return await asyncio.shield(task)
+
+    async def _one(reg_id: Optional[str], car_num: Optional[str], date: str) -> dict:
+        head = {"reg_id": reg_id, "car_num": car_num, "date": date}
+        try:
+            if reg_id is None:
+                reg_id = head["reg_id"] = await _reg_id_of(car_num)
+            head["sites"] = await cms_funcs.find_stops_near_sites_by_date(
+                reg_id=reg_id, sites=sites, date=date, radius_m=req.radius_m, jsession=m.jsession)
+        except HTTPException as e:
+            logger.warning(f"{reg_id or car_num}: [STOP SEARCH] batch {date}: {e.detail}")
+            head["error"] = str(e.detail)
+        except Exception as e:
+            logger.warning(f"{reg_id or car_num}: [STOP SEARCH] batch {date}: {e}")
+            head["error"] = str(e) or type(e).__name__
+        return head
+
+    async def _stream():
+        # по устройству подряд все даты — его треки и сессия идут одним потоком к CMS
+        jobs = iter([(reg_id, car_num, date) for reg_id, car_num in devices for date in dates])
+        running: set[asyncio.Task] = set()
+        try:
+            while True:
+                while len(running) < concurrency:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    running.add(asyncio.create_task(_one(*job)))
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield json.dumps(task.result(), ensure_ascii=False) + "\n"
+        finally:
+            # клиент отключился — не считаем остальное впустую
+            for task in running:
+                task.cancel()
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
+@app.get("/cms-limits")
+async def cms_limits_api(authorized: bool = Depends(verify_api_key)):
+    """Текущие (адаптивные) лимиты запросов к CMS этого процесса и замеры задержек."""
+    return cms_limits.snapshot()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("qt_pvp.api:app", host="0.0.0.0", port=8001, reload=False)
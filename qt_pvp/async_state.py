@@ -0,0 +1,166 @@
+"""
+Асинхронный фасад над функциями состояния (qt_pvp.functions -> state_store).
+
+Функции состояния синхронные: берут межпроцессный лок, ходят в диск/SQLite, делают
+fsync. Вызов их прямо из корутины останавливает весь event loop (опросы CMS,
+выгрузки в облако). Здесь:
+  - запись идёт через выделенный однопоточный executor (один писатель на процесс,
+    порядок записей сохраняется);
+  - чтение — через небольшой пул потоков;
+  - одновременные чтения одного и того же (функция, reg_id) склеиваются в один
+    поход в хранилище (single-flight), запись по reg_id сбрасывает склейку,
+    чтобы читатели после записи видели свежие данные;
+  - одновременные append_pending_interests по одному reg_id копятся и пишутся
+    одной операцией;
+  - записи по одному reg_id внутри процесса упорядочены asyncio.Lock.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from qt_pvp import functions as main_funcs
+from qt_pvp.logger import logger
+from typing import Any, Callable
+import functools
+import asyncio
+import weakref
+import json
+
+
+class _LoopState:
+    """Примитивы asyncio привязаны к циклу — держим их отдельно на каждый loop."""
+
+    def __init__(self):
+        self.reg_locks: dict[str, asyncio.Lock] = {}
+        self.inflight_reads: dict[tuple, asyncio.Future] = {}
+        self.append_buffers: dict[str, list[dict]] = {}
+        self.append_futures: dict[str, asyncio.Future] = {}
+
+
+class AsyncState:
+    def __init__(self, max_readers: int = 4):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+        self._readers = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix="state-reader")
+        self._loops: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopState]" = \
+            weakref.WeakKeyDictionary()
+
+    # --- служебное -------------------------------------------------------------------
+
+    def _state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+        st = self._loops.get(loop)
+        if st is None:
+            st = _LoopState()
+            self._loops[loop] = st
+        return st
+
+    def _reg_lock(self, reg_id: str) -> asyncio.Lock:
+        locks = self._state().reg_locks
+        lock = locks.get(reg_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            locks[reg_id] = lock
+        return lock
+
+    async def _run(self, executor, fn: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    async def _read(self, fn: Callable, reg_id: str) -> Any:
+        """Single-flight чтение: одновременные запросы по одному ключу ждут один результат."""
+        st = self._state()
+        key = (fn.__name__, reg_id)
+        fut = st.inflight_reads.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._run(self._readers, fn, reg_id))
+            st.inflight_reads[key] = fut
+            fut.add_done_callback(lambda f, k=key: st.inflight_reads.pop(k, None)
+                                  if st.inflight_reads.get(k) is f else None)
+        result = await asyncio.shield(fut)
+        # каждому вызывающему — своя копия, чтобы правки не протекали между корутинами
+        return json.loads(json.dumps(result)) if isinstance(result, (dict, list)) else result
+
+    def _forget_reads(self, reg_id: str) -> None:
+        st = self._state()
+        for key in [k for k in st.inflight_reads if k[1] == reg_id]:
+            st.inflight_reads.pop(key, None)
+
+    async def _write(self, reg_id: str, fn: Callable, *args) -> Any:
+        async with self._reg_lock(reg_id):
+            self._forget_reads(reg_id)
+            try:
+                return await self._run(self._writer, fn, reg_id, *args)
+            finally:
+                self._forget_reads(reg_id)
+
+    # --- чтение ----------------------------------------------------------------------
+
+    async def get_reg_info(self, reg_id: str) -> dict:
+        return await self._read(main_funcs.get_reg_info, reg_id)
+
+    async def get_pending_interests(self, reg_id: str) -> list[dict]:
+        return await self._read(main_funcs.get_pending_interests, reg_id)
+
+    # --- запись ----------------------------------------------------------------------
+
+    async def create_new_reg(self, reg_id: str, plate) -> dict:
+        return await self._write(reg_id, main_funcs.create_new_reg, plate)
+
+    async def set_pending_interests(self, reg_id: str, interests: list[dict]) -> None:
+        await self._write(reg_id, main_funcs.set_pending_interests, list(interests))
+
+    async def append_pending_interests(self, reg_id: str, interests: list[dict]) -> None:
+        """
+        Одновременные добавления по одному reg_id склеиваются: первый вызов
+        становится «лидером» и пишет всё накопленное одной операцией.
+        """
+        if not interests:
+            return
+        st = self._state()
+        buf = st.append_buffers.setdefault(reg_id, [])
+        buf.extend(interests)
+        fut = st.append_futures.get(reg_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._flush_appends(reg_id))
+            st.append_futures[reg_id] = fut
+        await asyncio.shield(fut)
+
+    async def _flush_appends(self, reg_id: str) -> None:
+        st = self._state()
+        async with self._reg_lock(reg_id):
+            # после захвата лока больше никто к этой пачке не присоединится
+            st.append_futures.pop(reg_id, None)
+            batch = st.append_buffers.pop(reg_id, [])
+            self._forget_reads(reg_id)
+            try:
+                if batch:
+                    await self._run(self._writer, main_funcs.append_pending_interests, reg_id, batch)
+            finally:
+                self._forget_reads(reg_id)
+
+    async def remove_pending_interest(self, reg_id: str, interest_name: str) -> None:
+        await self._write(reg_id, main_funcs.remove_pending_interest, interest_name)
+
+    async def claim_pending_interest(self, reg_id: str, interest_name: str) -> bool:
+        return await self._write(reg_id, main_funcs.claim_pending_interest, interest_name)
+
+    async def fail_pending_interest(self, reg_id: str, interest_name: str, error: str | None = None) -> None:
+        await self._write(reg_id, main_funcs.fail_pending_interest, interest_name, error)
+
+    async def release_pending_interest(self, reg_id: str, interest_name: str) -> None:
+        await self._write(reg_id, main_funcs.release_pending_interest, interest_name)
+
+    async def save_new_reg_last_upload_time(self, reg_id: str, timestamp: str) -> None:
+        await self._write(reg_id, main_funcs.save_new_reg_last_upload_time, timestamp)
+
+    async def save_reg_verified_until(self, reg_id: str, timestamp: str) -> None:
+        await self._write(reg_id, main_funcs.save_reg_verified_until, timestamp)
+
+    async def save_reg_verified_until_long(self, reg_id: str, timestamp: str) -> None:
+        await self._write(reg_id, main_funcs.save_reg_verified_until_long, timestamp)
+
+    def shutdown(self, wait: bool = True) -> None:
+        logger.debug("[STATE] Останавливаем executors асинхронного фасада состояния")
+        self._writer.shutdown(wait=wait)
+        self._readers.shutdown(wait=wait)
+
+
+# глобальный экземпляр
+async_state = AsyncState()
@@ -0,0 +1,282 @@
+"""
+Сверка интересов, найденных при recheck, с папками интересов на WebDAV.
+
+Раньше _sync_recheck_with_cloud листал каждый день синхронным client.list прямо в event
+loop, проверял новые интересы на облаке по одному и удалял устаревшие блокирующим
+client.clean в цикле. Здесь:
+  - дни окна листаются асинхронным PROPFIND (Depth: 1) параллельно;
+  - расхождения ищутся проходом по интервалам, отсортированным по началу (diff_names);
+    он же заменяет попарное O(n·m) фаззи-сравнение diff_sets в api.py;
+  - свежий листинг дня заменяет поштучные проверки новых интересов на облаке;
+  - DELETE устаревших папок идут параллельно под семафором;
+  - dry_run — только отчёт, без изменений в pending и на облаке.
+"""
+from qt_pvp import functions as main_funcs
+from qt_pvp import cloud_uploader
+from qt_pvp.meta_cache import meta_cache
+from qt_pvp.logger import logger
+from qt_pvp.data import settings
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlparse
+from xml.etree import ElementTree
+import posixpath
+import datetime
+import asyncio
+import bisect
+import httpx
+
+DAY_FMT = "%Y.%m.%d"
+_DAV_NS = "{DAV:}"
+_PROPFIND_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:"><d:prop><d:resourcetype/></d:prop></d:propfind>'
+)
+
+_http: Optional[httpx.AsyncClient] = None
+
+
+@dataclass
+class ReconcileReport:
+    plate: str
+    window: Tuple[str, str]
+    cloud_total: int = 0
+    detected_total: int = 0
+    to_add: List[str] = field(default_factory=list)      # нет на облаке — в pending
+    to_delete: List[str] = field(default_factory=list)   # на облаке, но не найдены — удалить
+    added: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    failed: List[str] = field(default_factory=list)
+    dry_run: bool = False
+
+    def summary(self) -> str:
+        if self.dry_run:
+            return (f"DRY-RUN: на облаке {self.cloud_total}, найдено {self.detected_total}, "
+                    f"добавилось бы {len(self.to_add)}, удалилось бы {len(self.to_delete)}")
+        return (f"на облаке {self.cloud_total}, найдено {self.detected_total}, "
+                f"добавлено {len(self.added)}, удалено {len(self.deleted)}, ошибок {len(self.failed)}")
+
+
+def _concurrency() -> int:
+    return max(1, settings.config.getint("Cloud", "RECONCILE_CONCURRENCY", fallback=8))
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        timeout = settings.config.getfloat("Cloud", "RECONCILE_TIMEOUT_SEC", fallback=60)
+        _http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=_concurrency(), max_keepalive_connections=_concurrency()),
+            timeout=httpx.Timeout(timeout, connect=5.0),
+            headers={"User-Agent": "qt_pvp/1.0"},
+        )
+    return _http
+
+
+async def close_http_client() -> None:
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+def _auth(client) -> Optional[httpx.Auth]:
+    """Креды webdav3-клиента (requests Basic/Digest) -> httpx."""
+    auth = cloud_uploader._resolve_auth(client)
+    if auth is None:
+        return None
+    if type(auth).__name__ == "HTTPDigestAuth":
+        return httpx.DigestAuth(auth.username, auth.password)
+    return httpx.BasicAuth(auth.username, auth.password)
+
+
+def _is_interest_name(name: str) -> bool:
+    return "_" in name and "-" in name and "." in name
+
+
+def _parse_folders(xml_body: bytes, folder_url: str) -> List[str]:
+    """Имена подпапок из ответа PROPFIND (саму папку пропускаем)."""
+    own = unquote(urlparse(folder_url).path).rstrip("/")
+    names: List[str] = []
+    for resp in ElementTree.fromstring(xml_body).iter(f"{_DAV_NS}response"):
+        href = resp.findtext(f"{_DAV_NS}href") or ""
+        path = unquote(urlparse(href).path).rstrip("/")
+        if not path or path == own:
+            continue
+        if resp.find(f".//{_DAV_NS}resourcetype/{_DAV_NS}collection") is None:
+            continue
+        names.append(posixpath.basename(path))
+    return names
+
+
+async def list_folder(client, folder: str) -> List[str]:
+    """Подпапки folder через PROPFIND Depth: 1; нет папки — пустой список."""
+    url = cloud_uploader._build_full_url(client, folder) + "/"
+    resp = await get_http_client().request(
+        "PROPFIND", url, content=_PROPFIND_BODY, auth=_auth(client),
+        headers={"Depth": "1", "Content-Type": "application/xml; charset=utf-8"},
+    )
+    if resp.status_code == 404:
+        return []
+    resp.raise_for_status()
+    return _parse_folders(resp.content, url)
+
+
+async def list_interest_folders(client, plate: str, day_from: datetime.date, day_to: datetime.date,
+                                base_path: str = settings.CLOUD_PATH) -> Dict[str, List[str]]:
+    """
+    {день YYYY.MM.DD: [имена интересов]} за дни [day_from, day_to] — все дни листаются параллельно.
+    День, который не удалось прочитать, в ответ не попадает (его интересы нельзя считать удалёнными).
+    """
+    days = [day_from + datetime.timedelta(days=k) for k in range((day_to - day_from).days + 1)]
+    sem = asyncio.Semaphore(_concurrency())
+
+    async def one(day: datetime.date):
+        folder = f"{base_path}/{plate}/{day.strftime(DAY_FMT)}"
+        async with sem:
+            try:
+                return day, sorted(n for n in await list_folder(client, folder) if _is_interest_name(n))
+            except Exception as e:
+                logger.warning(f"[WEBDAV] Ошибка PROPFIND '{folder}': {e}")
+                return day, None
+
+    out: Dict[str, List[str]] = {}
+    for day, names in await asyncio.gather(*(one(d) for d in days)):
+        if names is not None:
+            out[day.strftime(DAY_FMT)] = names
+    return out
+
+
+def _intervals(names: Iterable[str]) -> Tuple[List[Tuple[str, datetime.datetime, datetime.datetime, str]], List[str]]:
+    """(plate, start, end, name), отсортированные по (plate, start), и имена, которые не разобрались."""
+    parsed, bad = [], []
+    for name in names:
+        try:
+            plate, s_dt, e_dt = main_funcs._interest_name_to_interval(name)
+        except Exception:
+            bad.append(name)
+            continue
+        parsed.append((plate, s_dt, e_dt, name))
+    parsed.sort()
+    return parsed, bad
+
+
+def diff_names(expected: Iterable[str], detected: Iterable[str], eps_sec: float = 0) -> Tuple[Set[str], Set[str]]:
+    """
+    (new, missing): new — найденные, которым нет пары на облаке; missing — на облаке без пары.
+    Пара — то же имя или (при eps_sec > 0) тот же госномер с началом и концом в пределах eps_sec.
+    Найденные идут по началу, для каждого облачного смотрим только кандидатов с началом в
+    [start - eps, start + eps] (бинарный поиск) и берём ближайшего свободного.
+    """
+    expected, detected = set(expected), set(detected)
+    new, missing = detected - expected, expected - detected
+    if eps_sec <= 0 or not new or not missing:
+        return new, missing
+
+    eps = datetime.timedelta(seconds=eps_sec)
+    cand, _ = _intervals(new)
+    keys = [(plate, s_dt) for plate, s_dt, _, _ in cand]
+    taken = [False] * len(cand)
+    exp, _ = _intervals(missing)
+    for plate, s_dt, e_dt, name in exp:
+        lo = bisect.bisect_left(keys, (plate, s_dt - eps))
+        hi = bisect.bisect_right(keys, (plate, s_dt + eps))
+        best, best_cost = None, None
+        for k in range(lo, hi):
+            if taken[k] or abs(cand[k][2] - e_dt) > eps:
+                continue
+            cost = abs(cand[k][1] - s_dt) + abs(cand[k][2] - e_dt)
+            if best_cost is None or cost < best_cost:
+                best, best_cost = k, cost
+        if best is not None:
+            taken[best] = True
+            new.discard(cand[best][3])
+            missing.discard(name)
+    return new, missing
+
+
+async def reconcile(
+    reg_id: str,
+    plate: str,
+    detected: List[dict],
+    window_start: datetime.datetime,
+    window_end: datetime.datetime,
+    add: Callable[[List[dict]], Awaitable[None]],
+    *,
+    client=None,
+    margin_sec: int = 120,
+    eps_sec: float = 0,
+    dry_run: Optional[bool] = None,
+) -> ReconcileReport:
+    """
+    Сверить найденные интересы окна [window_start, window_end] с облаком:
+      - новые (нет на облаке) -> add(список интересов);
+      - устаревшие (на облаке, но не найдены) -> DELETE папки интереса.
+    Облачные интересы берутся с запасом margin_sec по краям окна. dry_run (по умолчанию —
+    [Cloud] RECONCILE_DRY_RUN) — только отчёт.
+    """
+    client = client or cloud_uploader.client
+    if dry_run is None:
+        dry_run = settings.config.getboolean("Cloud", "RECONCILE_DRY_RUN", fallback=False)
+    report = ReconcileReport(plate=plate, window=(str(window_start), str(window_end)), dry_run=dry_run)
+
+    margin = datetime.timedelta(seconds=margin_sec)
+    by_day = await list_interest_folders(client, plate, window_start.date(), window_end.date())
+    cloud: Set[str] = set()
+    parsed, _ = _intervals(n for names in by_day.values() for n in names)
+    for _, s_dt, e_dt, name in parsed:
+        # отсекаем интересы, которые явно вне окна recheck, с запасом
+        if e_dt < window_start - margin or s_dt > window_end + margin:
+            continue
+        cloud.add(name)
+
+    by_name = {it["name"]: it for it in detected if (it or {}).get("name")}
+    new, missing = diff_names(cloud, by_name, eps_sec)
+    # день, который не прочитался, не сравнивали — его новые интересы не добавляем вслепую
+    new = {n for n in new if _day_of(n) in by_day}
+    report.cloud_total, report.detected_total = len(cloud), len(by_name)
+    report.to_add, report.to_delete = sorted(new), sorted(missing)
+    if dry_run:
+        logger.info(f"{reg_id}: RECHECK {report.summary()}: "
+                    f"добавить {report.to_add}, удалить {report.to_delete}")
+        return report
+
+    if new:
+        to_append = [by_name[n] for n in report.to_add]
+        await add(to_append)
+        report.added = report.to_add
+
+    sem = asyncio.Semaphore(_concurrency())
+
+    async def delete(name: str) -> None:
+        day = _day_of(name)
+        folder = f"{settings.CLOUD_PATH}/{plate}/{day}/{name}"
+        async with sem:
+            try:
+                logger.info(f"{reg_id}: RECHECK: удаляем устаревший интерес с WebDAV: {folder}")
+                resp = await get_http_client().request(
+                    "DELETE", cloud_uploader._build_full_url(client, folder) + "/", auth=_auth(client))
+                if resp.status_code == 404:
+                    logger.info(f"{reg_id}: RECHECK: папка интереса уже отсутствует: {folder}")
+                else:
+                    resp.raise_for_status()
+                report.deleted.append(name)
+            except Exception as e:
+                logger.error(f"{reg_id}: RECHECK: ошибка при удалении интереса '{name}' из WebDAV: {e}")
+                report.failed.append(name)
+            finally:
+                await cloud_uploader.ainvalidate_folder(folder, meta_cache)
+
+    await asyncio.gather(*(delete(n) for n in report.to_delete))
+    if report.to_delete:
+        for day in {_day_of(n) for n in report.to_delete}:
+            await meta_cache.invalidate(cloud_uploader._cache_key_list(f"{settings.CLOUD_PATH}/{plate}/{day}"))
+    logger.info(f"{reg_id}: RECHECK {report.summary()}")
+    return report
+
+
+def _day_of(name: str) -> Optional[str]:
+    try:
+        return main_funcs._interest_name_to_interval(name)[1].strftime(DAY_FMT)
+    except Exception:
+        return None
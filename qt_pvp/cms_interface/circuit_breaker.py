@@ -0,0 +1,149 @@
+"""
+Автомат отключения (circuit breaker) по регистраторам.
+
+Оффлайн-устройство раньше снова и снова попадало в mainloop каждые 3 секунды и
+каждый раз заново проходило ретраи getVideoFileInfo. Теперь на каждое устройство —
+своё состояние:
+  - closed    — работаем как обычно;
+  - open      — устройство пропускаем до истечения паузы (экспоненциальная, с джиттером);
+  - half_open — пауза истекла, идёт одна дешёвая проба (getDeviceStatus);
+                успех — closed, провал — снова open с удвоенной паузой.
+
+Коды CMS 32/23 (устройство офлайн) размыкают сразу; 22 (device no response) и
+таймауты — после FAILURE_THRESHOLD подряд.
+"""
+from qt_pvp.data.settings import config
+from qt_pvp.logger import logger
+from typing import Callable
+import random
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+HARD_FAILURE_CODES = (32, 23)
+SOFT_FAILURE_CODES = (22,)
+
+
+class DeviceBreaker:
+    def __init__(self, device_id: str, failure_threshold: int = 3, base_delay: float = 30.0,
+                 max_delay: float = 900.0, jitter: float = 0.2, clock: Callable[[], float] = time.monotonic):
+        self.device_id = device_id
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.base_delay = float(base_delay)
+        self.max_delay = max(float(max_delay), self.base_delay)
+        self.jitter = max(0.0, float(jitter))
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0          # подряд идущие «мягкие» сбои в closed
+        self.opens = 0             # сколько раз подряд размыкались (для роста паузы)
+        self.open_until = 0.0
+        self.last_reason: str | None = None
+
+    def _delay(self) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, self.opens - 1)))
+        if self.jitter:
+            delay *= random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+        return delay
+
+    def _trip(self, reason: str) -> None:
+        self.opens += 1
+        self.failures = 0
+        self.state = OPEN
+        delay = self._delay()
+        self.open_until = self.clock() + delay
+        self.last_reason = reason
+        logger.info(f"{self.device_id}: [BREAKER] устройство отложено на {delay:.0f} с ({reason})")
+
+    def allow(self) -> str:
+        """
+        Можно ли работать с устройством:
+          CLOSED    — да;
+          HALF_OPEN — пауза истекла, вызывающий должен сделать пробу;
+          OPEN      — нет (пауза не истекла или проба уже идёт).
+        """
+        if self.state == CLOSED:
+            return CLOSED
+        if self.state == OPEN and self.clock() >= self.open_until:
+            self.state = HALF_OPEN
+            return HALF_OPEN
+        return OPEN
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info(f"{self.device_id}: [BREAKER] устройство снова доступно")
+        self.state = CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.last_reason = None
+
+    def record_failure(self, reason: str, hard: bool = False) -> None:
+        if self.state == HALF_OPEN or hard:
+            self._trip(reason)
+            return
+        if self.state == OPEN:
+            return
+        self.failures += 1
+        self.last_reason = reason
+        if self.failures >= self.failure_threshold:
+            self._trip(reason)
+
+    def record_result(self, result_code, reason: str | None = None) -> None:
+        """Учесть бизнес-код ответа CMS по этому устройству."""
+        if result_code in HARD_FAILURE_CODES:
+            self.record_failure(reason or f"result={result_code}", hard=True)
+        elif result_code in SOFT_FAILURE_CODES:
+            self.record_failure(reason or f"result={result_code}")
+
+    def snapshot(self) -> dict:
+        left = max(0.0, self.open_until - self.clock()) if self.state == OPEN else 0.0
+        return {"state": self.state, "failures": self.failures, "opens": self.opens,
+                "retry_in_sec": round(left, 1), "reason": self.last_reason}
+
+
+_breakers: dict[str, DeviceBreaker] = {}
+
+
+def _enabled() -> bool:
+    return config.getboolean("CircuitBreaker", "ENABLED", fallback=True)
+
+
+def get_breaker(device_id: str) -> DeviceBreaker:
+    br = _breakers.get(device_id)
+    if br is None:
+        br = DeviceBreaker(
+            device_id,
+            failure_threshold=config.getint("CircuitBreaker", "FAILURE_THRESHOLD", fallback=3),
+            base_delay=config.getfloat("CircuitBreaker", "BASE_DELAY_SEC", fallback=30.0),
+            max_delay=config.getfloat("CircuitBreaker", "MAX_DELAY_SEC", fallback=900.0),
+            jitter=config.getfloat("CircuitBreaker", "JITTER", fallback=0.2),
+        )
+        _breakers[device_id] = br
+    return br
+
+
+def allow(device_id: str) -> str:
+    if not _enabled():
+        return CLOSED
+    return get_breaker(device_id).allow()
+
+
+def record_success(device_id: str) -> None:
+    br = _breakers.get(device_id)
+    if br is not None:
+        br.record_success()
+
+
+def record_failure(device_id: str, reason: str, hard: bool = False) -> None:
+    if _enabled():
+        get_breaker(device_id).record_failure(reason, hard=hard)
+
+
+def record_result(device_id: str, result_code, reason: str | None = None) -> None:
+    if _enabled():
+        get_breaker(device_id).record_result(result_code, reason)
+
+
+def snapshot() -> dict:
+    return {dev: br.snapshot() for dev, br in sorted(_breakers.items()) if br.state != CLOSED or br.failures}
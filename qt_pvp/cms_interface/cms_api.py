@@ -2,12 +2,19 @@ from typing import Iterable, List, Dict, Tuple, Any
 from qt_pvp.cms_interface import functions
 from qt_pvp import functions as core_funcs
 from qt_pvp.cms_interface import cms_http
+from qt_pvp.cms_interface import circuit_breaker
+from qt_pvp.cms_interface import download_tracker
+from qt_pvp.cms_interface import file_fetch
+from qt_pvp.cms_interface import retry_policy
 from qt_pvp.cms_interface import limits
 from qt_pvp.logger import logger
 from qt_pvp.data import settings
 from httpx import Response
+import contextvars
 import subprocess
+import functools
 import datetime
+import inspect
 import asyncio
 import shutil
 import time
@@ -150,6 +157,109 @@ class DeviceOfflineError(RuntimeError):
     pass
 
 
+# --- Single-flight: склейка одновременных одинаковых запросов -------------------------
+
+_inflight: Dict[tuple, asyncio.Future] = {}
+_recent: Dict[tuple, Tuple[float, Any]] = {}
+_SINGLE_FLIGHT_SKIP = frozenset({"jsession"})
+
+
+def _memoize_json(resp):
+    """Разбираем JSON ответа один раз — его делят все ожидавшие вызовы."""
+    if not isinstance(resp, Response) or getattr(resp, "_json_memo", False):
+        return resp
+    orig = resp.json
+    parsed = []
+
+    def _json(**kwargs):
+        if kwargs:
+            return orig(**kwargs)
+        if not parsed:
+            parsed.append(orig())
+        return parsed[0]
+
+    resp.json = _json
+    resp._json_memo = True
+    return resp
+
+
+def _is_success(result) -> bool:
+    """Успешный ответ CMS (result == 0) — только такой можно отдавать из кэша."""
+    if isinstance(result, Response):
+        if not result.is_success:
+            return False
+        try:
+            data = result.json()
+        except Exception:
+            return False
+        return not isinstance(data, dict) or data.get("result", 0) == 0
+    if isinstance(result, dict):
+        return result.get("result", 0) == 0
+    return result is not None
+
+
+def single_flight(ttl: float | None = None):
+    """
+    Одновременные вызовы с одинаковыми (эндпоинт, параметры без jsession) ждут один
+    HTTP-запрос (вместе с его ретраями) и получают общий результат.
+    ttl > 0 — готовый успешный результат (result == 0) ещё столько секунд отдаётся без
+    запроса (по умолчанию [Process] CMS_RESPONSE_TTL_SEC). Исключения и ответы с кодом
+    ошибки (офлайн, истёкшая сессия, ...) не кэшируются.
+    Общий запрос идёт в пустом contextvars.Context(): дедлайн retry_policy первого вызвавшего
+    на него не распространяется, а каждый ожидающий ждёт не дольше своего дедлайна.
+    Ставится поверх cms_data_get_decorator_async.
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__name__,) + tuple(sorted(
+                (k, repr(v)) for k, v in bound.arguments.items() if k not in _SINGLE_FLIGHT_SKIP))
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+
+            ttl_sec = ttl if ttl is not None else settings.config.getfloat(
+                "Process", "CMS_RESPONSE_TTL_SEC", fallback=0.0)
+            if ttl_sec > 0:
+                hit = _recent.get(key)
+                if hit is not None and hit[0] > now:
+                    return hit[1]
+
+            fut = _inflight.get(key)
+            if fut is None or fut.get_loop() is not loop:
+                fut = loop.create_task(func(*args, **kwargs), context=contextvars.Context())
+                _inflight[key] = fut
+
+                def _done(f, key=key):
+                    if _inflight.get(key) is f:
+                        _inflight.pop(key, None)
+                    if ttl_sec > 0 and not f.cancelled() and f.exception() is None \
+                            and _is_success(_memoize_json(f.result())):
+                        _recent[key] = (loop.time() + ttl_sec, f.result())
+                        if len(_recent) > 1024:
+                            t = loop.time()
+                            for k in [k for k, (exp, _) in _recent.items() if exp <= t]:
+                                _recent.pop(k, None)
+
+                fut.add_done_callback(_done)
+            else:
+                logger.debug(f"[CMS] single-flight: ждём уже идущий {func.__name__}")
+            # shield: отмена одного из ожидающих не отменяет общий запрос
+            left = retry_policy.remaining()
+            if left is None:
+                return _memoize_json(await asyncio.shield(fut))
+            try:
+                return _memoize_json(await asyncio.wait_for(asyncio.shield(fut), timeout=left))
+            except asyncio.TimeoutError:
+                raise retry_policy.DeadlineExceeded(f"[CMS] {func.__name__}: дедлайн операции исчерпан")
+
+        return wrapper
+    return decorator
+
+
 @functions.cms_data_get_decorator_async()
 async def get_online_devices(jsession, device_id=None):
     url = f"{settings.cms_host}/StandardApiAction_getDeviceOlStatus.action?"
@@ -158,7 +268,8 @@ async def get_online_devices(jsession, device_id=None):
               "devIdno": device_id}
     async with limits.get_cms_global_sem():
         client = cms_http.get_cms_async_client()
-        return await client.get(url, params=params)
+        with limits.measure_cms_request():
+            return await client.get(url, params=params)
 
 
 @functions.cms_data_get_decorator_async()
@@ -169,7 +280,8 @@ async def get_offline_devices(jsession, device_id=None):
               "devIdno": device_id}
     async with limits.get_cms_global_sem():
         client = cms_http.get_cms_async_client()
-        return await client.get(url, params=params)
+        with limits.measure_cms_request():
+            return await client.get(url, params=params)
 
 
 @functions.cms_data_get_decorator_async()
@@ -179,9 +291,11 @@ async def login():
                 "password": settings.cms_password}
     async with limits.get_cms_global_sem():
         client = cms_http.get_cms_async_client()
-        return await client.get(url, params=params)
+        with limits.measure_cms_request():
+            return await client.get(url, params=params)
 
 
+@single_flight()
 @functions.cms_data_get_decorator_async()
 async def get_video(jsession, device_id: str, start_time_seconds: int,
                     end_time_seconds: int, year: int, month: int, day: int,
@@ -199,9 +313,11 @@ async def get_video(jsession, device_id: str, start_time_seconds: int,
     async with limits.get_cms_global_sem():
         async with limits.get_device_sem(device_id):
             client = cms_http.get_cms_async_client()
-            return await client.get(url, params=params)
+            with limits.measure_cms_request():
+                return await client.get(url, params=params)
 
 
+@single_flight()
 @functions.cms_data_get_decorator_async()
 async def get_device_track_page_async(jsession: str, device_id: str,
                                       start_time: str, end_time: str,
@@ -218,10 +334,11 @@ async def get_device_track_page_async(jsession: str, device_id: str,
     async with limits.get_cms_global_sem():
         async with limits.get_device_sem(device_id):
             client = cms_http.get_cms_async_client()
-            resp =  await client.get(url, params=params)
-            return resp
+            with limits.measure_cms_request():
+                return await client.get(url, params=params)
 
 
+@single_flight()
 @functions.cms_data_get_decorator_async()
 async def get_device_track(jsession: str, device_id: str, start_time: str,
                      stop_time: str, page: int | None = None):
@@ -238,7 +355,8 @@ async def get_device_track(jsession: str, device_id: str, start_time: str,
     async with limits.get_cms_global_sem():
         async with limits.get_device_sem(device_id):
             client = cms_http.get_cms_async_client()
-            return await client.get(url, params=params)
+            with limits.measure_cms_request():
+                return await client.get(url, params=params)
 
 
 async def get_device_track_all_pages_async(jsession: str, device_id: str, start_time: str, end_time: str) -> list[dict]:
@@ -264,8 +382,30 @@ async def get_device_status_async(jsession: str, device_id: str) -> Response:
     params={"jsession": jsession, "devIdno": device_id}
     async with limits.get_cms_global_sem():
         client = cms_http.get_cms_async_client()
-        return await client.get(url, params=params)
+        with limits.measure_cms_request():
+            return await client.get(url, params=params)
 
+
+async def probe_device_online(jsession: str, device_id: str) -> bool:
+    """
+    Дешёвая проверка перед возвратом к тяжёлой работе с устройством (circuit breaker):
+    один getDeviceStatus вместо цепочки ретраев getVideoFileInfo.
+    """
+    try:
+        response = await get_device_status_async(jsession, device_id)
+        data = response.json() or {}
+    except Exception as e:
+        logger.debug(f"{device_id}: [BREAKER] проба не удалась: {e}")
+        return False
+    if data.get("result") not in (0, None):
+        return False
+    for st in data.get("status") or []:
+        if str(st.get("id", device_id)) != str(device_id):
+            continue
+        return bool(st.get("ol", st.get("online", 0)))
+    return False
+
+@single_flight()
 @functions.cms_data_get_decorator_async()
 async def get_device_alarm_page_async(
     jsession: str,
@@ -300,7 +440,8 @@ async def get_device_alarm_page_async(
     async with limits.get_cms_global_sem():
         async with limits.get_device_sem(device_id):
             client = cms_http.get_cms_async_client()
-            return await client.get(url, params=params)
+            with limits.measure_cms_request():
+                return await client.get(url, params=params)
 
 
 async def get_device_alarm_all_pages_async(
@@ -378,41 +519,38 @@ async def execute_download_task(jsession, download_task_url: str, reg_id):
     async with limits.get_cms_global_sem():
         async with limits.get_device_sem(reg_id):
             client = cms_http.get_cms_async_client()
-            return await client.get(download_task_url)
+            with limits.measure_cms_request():
+                return await client.get(download_task_url)
 
 
 async def wait_and_get_dwn_url(jsession, download_task_url, reg_id, poll_interval=1.0, timeout=1800.0,
-                               interest_name:str = "ND", channel_id:int = 0):
+                               interest_name:str = "ND", channel_id:int = 0, size_hint: int | None = None):
+    """
+    Ждёт завершения задачи загрузки CMS и возвращает локальный путь к клипу (dph или
+    его копию, см. file_fetch). Опрос — через общий download_tracker (адаптивный
+    интервал, один планировщик на все задачи); poll_interval — первый интервал опроса.
+    """
     logger.info(f"{reg_id}:{interest_name} ch{channel_id}  Загрузка видео...")
-    started = time.monotonic()
-    count = 0
-    while True:
-        if time.monotonic() - started > timeout:
-            raise TimeoutError(f"{reg_id}:{interest_name} ch{channel_id}  download task timed out after {timeout}s")
-
-        response = await execute_download_task(jsession=jsession, download_task_url=download_task_url, reg_id=reg_id)
-        response_json = response.json()
-        if not response_json:
-            await asyncio.sleep(poll_interval); continue
-
-        result = response_json.get("result")
-        old = (response_json.get("oldTaskAll") or {})
-        dph = old.get("dph")
-
-        if result == 11 and dph:
-            logger.info(f"{reg_id}:{interest_name} ch{channel_id}. Загрузка видео завершена!")
-            logger.debug(f"Get path: {dph}")
-            if not os.path.exists(dph):
-                logger.error(f"{reg_id}:{interest_name} ch{channel_id}. При этом фактически файла нет на диске! ({response_json})")
-            return dph
-        if result == 32:
-            logger.warning(f"{reg_id}:{interest_name} ch{channel_id}. Устройство отключено! 32")
-            raise DeviceOfflineError
-
-        count += 1
-        if count % 60 == 0:
-            logger.info(f"{reg_id}:{interest_name} ch{channel_id} . Все еще грузится: {response_json}. Уже {count} сек.")
-        await asyncio.sleep(poll_interval)
+    dph = await download_tracker.get_tracker().wait(
+        jsession, download_task_url, reg_id,
+        size_hint=size_hint, timeout=timeout,
+        label=f"{reg_id}:{interest_name} ch{channel_id}",
+        initial_interval=poll_interval,
+    )
+    logger.info(f"{reg_id}:{interest_name} ch{channel_id}. Загрузка видео завершена!")
+    logger.debug(f"Get path: {dph}")
+    circuit_breaker.record_success(reg_id)
+    # CMS на другой машине — забираем файл по HTTP во временную папку интереса
+    return await file_fetch.materialize(
+        dph, jsession, os.path.join(settings.TEMP_FOLDER, interest_name),
+        size_hint=size_hint, label=f"{reg_id}:{interest_name} ch{channel_id}")
+
+
+def _int_or_none(value) -> int | None:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
 
 
 async def download_video(
@@ -493,10 +631,12 @@ async def download_video(
             # устройство реально офлайн — выходим вверх по стеку
             if result == 32 and "Device is not online" in message:
                 logger.warning(f"{reg_id}:{interest_name} ch{channel_id}  устройство офлайн")
+                circuit_breaker.record_result(reg_id, result, message)
                 raise DeviceOfflineError(message or "Device is not online!")
 
             if result == 23 and "device offline" in message:
                 logger.warning(f"{reg_id}:{interest_name} ch{channel_id}  устройство офлайн")
+                circuit_breaker.record_result(reg_id, result, message)
                 raise DeviceOfflineError(message or "Device is not online!")
 
             # наш кейс: устройство «не ответило» — НЕ двигаем окно, повторяем то же
@@ -516,6 +656,7 @@ async def download_video(
                         f"{reg_id}:{interest_name} ch{channel_id} device no response — exhausted retries on the SAME window "
                         f"[{cur_start}..{cur_end}]; move to next delta"
                     )
+                    circuit_breaker.record_result(reg_id, result, "device no response")
                     # выходим из while -> перейдём к следующему delta
                     break
 
@@ -529,9 +670,13 @@ async def download_video(
                     try:
                         file_path = await wait_and_get_dwn_url(
                             jsession=jsession, download_task_url=url, reg_id=reg_id, channel_id=channel_id,
-                            interest_name=interest_name)
+                            interest_name=interest_name, size_hint=_int_or_none(f.get("len")))
+                    except retry_policy.DeadlineExceeded:
+                        # кончился бюджет времени операции, а не связь с устройством
+                        raise
                     except TimeoutError:
                         logger.error("Timeout error!")
+                        circuit_breaker.record_failure(reg_id, "download task timeout")
                         raise DeviceOfflineError("Timeout error")
                     if file_path:
                         file_paths.append(file_path)
@@ -549,57 +694,81 @@ async def download_video(
     return None
 
 
+def frame_only_window_sec() -> int:
+    """Длина окна вокруг кадра ДО/ПОСЛЕ для каналов, которым нужен только кадр (0 — полный клип)."""
+    return max(0, settings.config.getint("Downloads", "FRAME_ONLY_WINDOW_SEC", fallback=5))
+
+
+def frame_windows(interest: dict, window_sec: int) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    """
+    Окна видео для кадров интереса: [start_time, +window_sec] и [end_time - window_sec, end_time].
+    Кадры ДО/ПОСЛЕ берутся как первый и последний кадр файла (extract_edge_frames_bytes), а полный
+    клип качается ровно [start_time, end_time] — окна привязаны к тем же границам, поэтому первый
+    кадр первого окна и последний кадр последнего совпадают с кадрами полного клипа.
+    Если окна сходятся — одно окно на весь интерес.
+    """
+    TIME_FMT = "%Y-%m-%d %H:%M:%S"
+    start = datetime.datetime.strptime(interest["start_time"], TIME_FMT)
+    end = datetime.datetime.strptime(interest["end_time"], TIME_FMT)
+    window = datetime.timedelta(seconds=window_sec)
+    if end - start <= 2 * window:
+        return [(start, end)]
+    return [(start, start + window), (end - window, end)]
+
+
 async def download_single_clip_per_channel(
     jsession: str,
     reg_id: str,
     interest: dict,
-    channels: list[int] = (0, 1, 2, 3)):
+    channels: list[int] = (0, 1, 2, 3),
+    frame_only_channels: Iterable[int] = ()):
     """
     Скачивает РОВНО ОДИН финальный видеоклип на каждый канал так,
     чтобы в нём попадали и начало, и конец интереса.
     Если CMS отдаёт несколько отрезков — конкатенируем в один файл.
+    Каналам из frame_only_channels (нужны только кадры ДО/ПОСЛЕ) качаются лишь короткие окна
+    у начала и конца интереса (FRAME_ONLY_WINDOW_SEC, см. frame_windows), склеенные в один файл.
     Возвращает: {ch: {"path": str|None, "concat_sources": list[str]|None}}
     """
     TIME_FMT = "%Y-%m-%d %H:%M:%S"
     dt_start = datetime.datetime.strptime(interest["start_time"], TIME_FMT)
     dt_end   = datetime.datetime.strptime(interest["end_time"],   TIME_FMT)
-    #raw_start = interest["start_time"]
-    #if isinstance(raw_start, datetime.datetime):
-    #    dt_start = raw_start
-    #else:
-    #    dt_start = datetime.datetime.strptime(raw_start, TIME_FMT)
-    #
-    #raw_end = interest["end_time"]
-    #if isinstance(raw_end, datetime.datetime):
-    #    dt_end = raw_end
-    #else:
-    #    dt_end = datetime.datetime.strptime(raw_end, TIME_FMT)
     interest_name = interest["name"]
 
-    start_sec = dt_start.hour * 3600 + dt_start.minute * 60 + dt_start.second
-    end_sec   = dt_end.hour   * 3600 + dt_end.minute   * 60 + dt_end.second
+    full_windows = [(dt_start, dt_end)]
+    window_sec = frame_only_window_sec()
+    frame_only = set(frame_only_channels) if window_sec > 0 else set()
+    edge_windows = frame_windows(interest, window_sec) if frame_only else full_windows
 
     out: Dict[int, Dict[str, Any]] = {}
     interest_tmp_dir = os.path.join(settings.TEMP_FOLDER, interest["name"])
     os.makedirs(interest_tmp_dir, exist_ok=True)
 
+    def _day_sec(dt: datetime.datetime) -> int:
+        return dt.hour * 3600 + dt.minute * 60 + dt.second
+
     async def _one_channel(ch: int, interest_name: str) -> Tuple[int, str | None, list[str] | None]:
-        # Скачиваем все куски на интервале, дальше сведём в один файл
-        async with limits._get_video_sem_for(reg_id):
-            videos_paths = await download_video(
-                jsession=jsession,
-                reg_id=reg_id,
-                channel_id=ch,
-                year=dt_start.year, month=dt_start.month, day=dt_start.day,
-                start_sec=start_sec,
-                end_sec=end_sec,
-                adjustment_sequence=(0, 5, 10, 15, 30),
-                interest_name=interest_name,
-            )  # уже есть в проекте  :contentReference[oaicite:1]{index=1}
-
-        if not videos_paths:
-            logger.warning(f"{reg_id}: ch={ch} клипы не получены.")
-            return ch, None, videos_paths
+        windows = edge_windows if ch in frame_only else full_windows
+        # Скачиваем все куски на интервале (интервалах), дальше сведём в один файл
+        videos_paths: list[str] = []
+        for w_start, w_end in windows:
+            async with limits._get_video_sem_for(reg_id):
+                paths = await download_video(
+                    jsession=jsession,
+                    reg_id=reg_id,
+                    channel_id=ch,
+                    year=w_start.year, month=w_start.month, day=w_start.day,
+                    start_sec=_day_sec(w_start),
+                    end_sec=_day_sec(w_end) if w_end.date() == w_start.date() else 24 * 60 * 60 - 1,
+                    adjustment_sequence=(0, 5, 10, 15, 30),
+                    interest_name=interest_name,
+                )
+            if not paths:
+                # без одного из окон первый/последний кадр файла — не кадры ДО/ПОСЛЕ
+                logger.warning(f"{reg_id}: ch={ch} клипы не получены "
+                               f"[{w_start.strftime(TIME_FMT)} → {w_end.strftime(TIME_FMT)}].")
+                return ch, None, videos_paths + list(paths or [])
+            videos_paths.extend(paths)
 
         if len(videos_paths) == 1:
             return ch, videos_paths[0], videos_paths
@@ -607,12 +776,14 @@ async def download_single_clip_per_channel(
         # конкат в один файл (mp4) тем же методом, что используешь для интересов
         merged_path = os.path.join(interest_tmp_dir, f"ch{ch}_merged.mp4")
         try:
-            await asyncio.to_thread(core_funcs.concatenate_videos, videos_paths, merged_path, reg_id, interest_name)  # :contentReference[oaicite:2]{index=2}
+            await asyncio.to_thread(core_funcs.concatenate_videos, videos_paths, merged_path, reg_id, interest_name)
             return ch, merged_path, videos_paths
         except Exception as e:
             logger.error(f"{reg_id}: {interest_name} ch={ch} concat failed: {e}")
             return ch, None, videos_paths
 
+    if frame_only:
+        logger.debug(f"{reg_id}: {interest_name} каналы только для кадров {sorted(frame_only)}: окна {edge_windows}")
     tasks = [asyncio.create_task(_one_channel(ch,  interest_name)) for ch in channels]
     for t in asyncio.as_completed(tasks):
         ch, path, videos_paths = await t
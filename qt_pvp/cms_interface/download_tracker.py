@@ -0,0 +1,215 @@
+"""
+Общий опросчик задач загрузки CMS (DownTaskUrl).
+
+Раньше каждый wait_and_get_dwn_url опрашивал свою задачу раз в секунду до 30 минут,
+и каждый опрос занимал слоты глобального и поустройственного семафоров: 8 интересов
+x 4 канала давали десятки пустых запросов в секунду. Здесь все незавершённые задачи
+живут в одном планировщике:
+  - первые опросы частые (MIN_INTERVAL_SEC), пока ответ CMS не меняется — интервал
+    растёт в BACKOFF раз до MAX_INTERVAL_SEC, при изменении ответа — снова сокращается;
+  - для небольших файлов интервал дополнительно ограничен оценкой времени загрузки
+    (размер файла / EXPECTED_BYTES_PER_SEC), чтобы не ждать лишнего;
+  - одновременно выполняется не больше MAX_CONCURRENT_POLLS опросов;
+  - ожидающие одной и той же задачи получают один общий future.
+"""
+from qt_pvp.cms_interface import circuit_breaker
+from qt_pvp.cms_interface import retry_policy
+from qt_pvp.data.settings import config
+from qt_pvp.logger import logger
+from typing import Awaitable, Callable
+import contextvars
+import asyncio
+import weakref
+import json
+import time
+
+
+class _Task:
+    def __init__(self, jsession, url: str, reg_id: str, label: str, size_hint: int | None,
+                 interval: float, deadline: float, deadline_is_operation: bool):
+        self.jsession = jsession
+        self.url = url
+        self.reg_id = reg_id
+        self.label = label
+        self.size_hint = size_hint
+        self.interval = interval
+        self.deadline = deadline
+        self.deadline_is_operation = deadline_is_operation
+        self.started = time.monotonic()
+        self.next_poll = self.started
+        self.last_payload: str | None = None
+        self.last_report = self.started
+        self.polls = 0
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+
+
+class DownloadTracker:
+    def __init__(self, poll: Callable[..., Awaitable] | None = None, min_interval: float = 1.0,
+                 max_interval: float = 15.0, backoff: float = 1.5, max_concurrent_polls: int = 4,
+                 expected_bytes_per_sec: float = 0.0):
+        self._poll_fn = poll
+        self.min_interval = max(0.01, float(min_interval))
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.backoff = max(1.0, float(backoff))
+        self.expected_bytes_per_sec = max(0.0, float(expected_bytes_per_sec))
+        self._poll_sem = asyncio.Semaphore(max(1, int(max_concurrent_polls)))
+        self._tasks: dict[str, _Task] = {}
+        self._polling: set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+        self.polls_total = 0
+
+    async def _poll(self, task: _Task):
+        if self._poll_fn is not None:
+            return await self._poll_fn(task.jsession, task.url, task.reg_id)
+        from qt_pvp.cms_interface import cms_api
+        return await cms_api.execute_download_task(jsession=task.jsession, download_task_url=task.url,
+                                                   reg_id=task.reg_id)
+
+    # --- API -------------------------------------------------------------------------
+
+    async def wait(self, jsession, url: str, reg_id: str, size_hint: int | None = None,
+                   timeout: float = 1800.0, label: str = "", initial_interval: float | None = None) -> str:
+        """Дождаться завершения задачи загрузки и вернуть dph (путь к файлу на стороне CMS)."""
+        task = self._tasks.get(url)
+        if task is None:
+            now = time.monotonic()
+            deadline = now + float(timeout)
+            left = retry_policy.remaining()
+            op_deadline = left is not None and now + left < deadline
+            if op_deadline:
+                deadline = now + left
+            interval = self.min_interval if initial_interval is None else max(0.01, float(initial_interval))
+            task = _Task(jsession, url, reg_id, label or reg_id, size_hint, interval, deadline, op_deadline)
+            self._tasks[url] = task
+            self._ensure_runner()
+            self._wakeup.set()
+        task.waiters += 1
+        try:
+            return await asyncio.shield(task.future)
+        finally:
+            task.waiters -= 1
+            if task.waiters <= 0 and not task.future.done():
+                # ждать больше некому — снимаем задачу с опроса
+                task.future.cancel()
+                self._tasks.pop(url, None)
+
+    def snapshot(self) -> dict:
+        return {"tasks": len(self._tasks), "polls_total": self.polls_total}
+
+    # --- планировщик -----------------------------------------------------------------
+
+    def _ensure_runner(self) -> None:
+        if self._runner is None or self._runner.done():
+            # чистый контекст: дедлайн первого ожидающего не должен ограничивать опросы остальных
+            self._runner = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        while self._tasks:
+            now = time.monotonic()
+            for url, task in list(self._tasks.items()):
+                if task.future.done():
+                    self._tasks.pop(url, None)
+                    continue
+                if now >= task.deadline:
+                    self._expire(task)
+                    continue
+                if url not in self._polling and task.next_poll <= now:
+                    self._polling.add(url)
+                    t = asyncio.ensure_future(self._poll_one(task))
+                    t.add_done_callback(lambda _t, u=url: self._poll_done(u))
+            times = [t.deadline for t in self._tasks.values()]
+            times += [t.next_poll for u, t in self._tasks.items() if u not in self._polling]
+            sleep_for = max(0.0, min(times) - time.monotonic()) if times else 0.0
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    def _poll_done(self, url: str) -> None:
+        self._polling.discard(url)
+        self._wakeup.set()
+
+    def _expire(self, task: _Task) -> None:
+        self._tasks.pop(task.url, None)
+        if task.deadline_is_operation:
+            exc = retry_policy.DeadlineExceeded(f"{task.label}  дедлайн операции исчерпан")
+        else:
+            exc = TimeoutError(f"{task.label}  download task timed out after {task.deadline - task.started:.0f}s")
+        task.future.set_exception(exc)
+
+    def _cap_for(self, task: _Task) -> float:
+        cap = self.max_interval
+        if task.size_hint and self.expected_bytes_per_sec:
+            cap = min(cap, max(self.min_interval, task.size_hint / self.expected_bytes_per_sec))
+        return cap
+
+    async def _poll_one(self, task: _Task) -> None:
+        async with self._poll_sem:
+            if task.future.done():
+                return
+            try:
+                response = await self._poll(task)
+                response_json = response.json() if hasattr(response, "json") else response
+            except Exception as e:
+                logger.warning(f"{task.label}  опрос задачи загрузки не удался: {e}")
+                response_json = None
+            finally:
+                self.polls_total += 1
+                task.polls += 1
+        if task.future.done():
+            return
+        self._handle(task, response_json or {})
+
+    def _handle(self, task: _Task, response_json: dict) -> None:
+        from qt_pvp.cms_interface.cms_api import DeviceOfflineError
+        result = response_json.get("result")
+        old = (response_json.get("oldTaskAll") or {})
+        dph = old.get("dph")
+        now = time.monotonic()
+
+        if result == 11 and dph:
+            self._tasks.pop(task.url, None)
+            task.future.set_result(dph)
+            return
+        if result == 32:
+            logger.warning(f"{task.label}. Устройство отключено! 32")
+            circuit_breaker.record_result(task.reg_id, result, "download task: result=32")
+            self._tasks.pop(task.url, None)
+            task.future.set_exception(DeviceOfflineError("Device is not online!"))
+            return
+
+        payload = json.dumps(old, sort_keys=True, ensure_ascii=False, default=str) if response_json else None
+        if payload is not None and payload != task.last_payload:
+            # ответ изменился — загрузка идёт, опрашиваем чаще
+            task.interval = max(self.min_interval, task.interval / self.backoff)
+        else:
+            task.interval = min(self._cap_for(task), task.interval * self.backoff)
+        task.last_payload = payload
+        task.next_poll = now + task.interval
+
+        if now - task.last_report >= 60:
+            task.last_report = now
+            logger.info(f"{task.label} . Все еще грузится: {response_json}. Уже {int(now - task.started)} сек., "
+                        f"опросов {task.polls}, интервал {task.interval:.1f} с.")
+
+
+_trackers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, DownloadTracker]" = weakref.WeakKeyDictionary()
+
+
+def get_tracker() -> DownloadTracker:
+    """Планировщик опросов текущего event loop (примитивы asyncio привязаны к циклу)."""
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = DownloadTracker(
+            min_interval=config.getfloat("Downloads", "MIN_INTERVAL_SEC", fallback=1.0),
+            max_interval=config.getfloat("Downloads", "MAX_INTERVAL_SEC", fallback=15.0),
+            backoff=config.getfloat("Downloads", "BACKOFF", fallback=1.5),
+            max_concurrent_polls=config.getint("Downloads", "MAX_CONCURRENT_POLLS", fallback=4),
+            expected_bytes_per_sec=config.getfloat("Downloads", "EXPECTED_BYTES_PER_SEC", fallback=0.0),
+        )
+        _trackers[loop] = tracker
+    return tracker
@@ -0,0 +1,161 @@
+"""
+Получение готового клипа CMS (dph) на машину оператора.
+
+wait_and_get_dwn_url возвращает dph — путь к файлу на диске CMS. Раньше оператор
+работал с этим путём напрямую, то есть мог жить только на одной машине с хранилищем
+CMS. Режимы ([CMS] FILE_FETCH_MODE):
+  - local  — как раньше, dph используется как есть;
+  - remote — файл скачивается по HTTP с файлового порта CMS ([CMS] file_port) во
+             временную папку интереса;
+  - auto   — local, если dph виден на диске, иначе remote.
+
+Скачивание потоковое, в <файл>.part; после обрыва продолжается с места остановки
+(Range), если сервер Range не поддержал — начинается заново. В конце размер
+сверяется с Content-Length/Content-Range и с размером из ответа CMS (len), и только
+потом .part переименовывается в итоговый файл.
+"""
+from qt_pvp.cms_interface import retry_policy
+from qt_pvp.cms_interface import cms_http
+from qt_pvp.data import settings
+from qt_pvp.logger import logger
+from urllib.parse import quote
+import asyncio
+import httpx
+import os
+import re
+
+CHUNK_SIZE = 1 << 20
+
+DEFAULT_URL_TEMPLATE = "/3/5?DownType=3&FLENGTH={size}&FOFFSET=0&MTYPE=1&FPATH={path}&SAVENAME={name}&jsession={jsession}"
+
+
+class FileFetchError(RuntimeError):
+    """Файл не удалось получить целиком (обрывы, несовпадение размера)."""
+    pass
+
+
+def fetch_mode() -> str:
+    mode = settings.config.get("CMS", "FILE_FETCH_MODE", fallback="local").strip().lower()
+    return mode if mode in ("local", "remote", "auto") else "local"
+
+
+def file_base_url() -> str:
+    port = (settings.config.get("CMS", "file_port", fallback="") or "").strip()
+    port = port or str(settings.config.getint("CMS", "port"))
+    return f"{settings.config.get('CMS', 'schema')}{settings.config.get('CMS', 'ip')}:{port}"
+
+
+def build_file_url(dph: str, jsession: str | None, size: int | None = None) -> str:
+    template = settings.config.get("CMS", "FILE_URL_TEMPLATE", fallback=DEFAULT_URL_TEMPLATE, raw=True)
+    return file_base_url() + template.format(
+        path=quote(dph, safe=""),
+        name=quote(os.path.basename(dph), safe=""),
+        size=size or 0,
+        jsession=jsession or "",
+    )
+
+
+def _total_from_headers(response: httpx.Response, offset: int) -> int | None:
+    """Полный размер файла по Content-Range (206) или Content-Length (200)."""
+    cr = response.headers.get("Content-Range")
+    if cr:
+        m = re.match(r"bytes\s+\d+-\d+/(\d+)", cr)
+        if m:
+            return int(m.group(1))
+    cl = response.headers.get("Content-Length")
+    if cl and cl.isdigit():
+        return int(cl) + (offset if response.status_code == 206 else 0)
+    return None
+
+
+async def _stream_once(client: httpx.AsyncClient, url: str, part_path: str, label: str) -> int | None:
+    """
+    Одна попытка докачки в part_path. Возвращает ожидаемый полный размер (если сервер
+    его сообщил) — сверка делается снаружи.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code == 416 and offset:
+            # запрошен диапазон за концом файла: .part уже полный (или битый — проверит сверка)
+            cr = response.headers.get("Content-Range", "")
+            m = re.match(r"bytes\s+\*/(\d+)", cr)
+            return int(m.group(1)) if m else offset
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            logger.info(f"{label}  сервер не поддержал Range — качаем файл заново")
+            offset = 0
+        total = _total_from_headers(response, offset)
+        mode = "ab" if offset else "wb"
+        fh = await asyncio.to_thread(open, part_path, mode)
+        try:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                await asyncio.to_thread(fh.write, chunk)
+        finally:
+            await asyncio.to_thread(fh.close)
+        return total
+
+
+async def fetch_file(url: str, dest_path: str, expected_size: int | None = None,
+                     label: str = "", max_attempts: int | None = None) -> str:
+    """Скачать url в dest_path с докачкой и сверкой размера."""
+    max_attempts = max_attempts or settings.config.getint("CMS", "FILE_FETCH_ATTEMPTS", fallback=5)
+    policy = retry_policy.RetryPolicy(max_attempts=max_attempts, base_delay=1.0, max_delay=15.0)
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    part_path = dest_path + ".part"
+    client = cms_http.get_cms_async_client()
+    last_error: Exception | None = None
+
+    for attempt in range(1, policy.max_attempts + 1):
+        try:
+            total = await _stream_once(client, url, part_path, label)
+            got = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            want = total or expected_size
+            if expected_size and total and expected_size != total:
+                logger.warning(f"{label}  размер по CMS ({expected_size}) и по HTTP ({total}) расходятся, верим HTTP")
+            if got == 0:
+                raise FileFetchError(f"{label}  получен пустой файл")
+            if want is not None and got != want:
+                if got > want:
+                    # лишние байты — .part испорчен, начинаем заново
+                    os.remove(part_path)
+                raise FileFetchError(f"{label}  получено {got} из {want} байт")
+            os.replace(part_path, dest_path)
+            logger.info(f"{label}  файл получен с CMS: {dest_path} ({got} байт)")
+            return dest_path
+        except (httpx.HTTPError, OSError, FileFetchError) as e:
+            last_error = e
+            if isinstance(e, httpx.HTTPStatusError) and not policy.should_retry_exception(e):
+                break
+            pause = policy.next_delay(attempt)
+            if pause is None:
+                break
+            logger.warning(f"{label}  скачивание прервано ({e}); попытка {attempt + 1}/{policy.max_attempts} "
+                           f"через {pause:.1f}s")
+            await asyncio.sleep(pause)
+    raise FileFetchError(f"{label}  не удалось скачать {url}: {last_error}")
+
+
+_inflight: dict[str, asyncio.Future] = {}
+
+
+async def materialize(dph: str, jsession: str | None, dest_dir: str, size_hint: int | None = None,
+                      label: str = "") -> str:
+    """
+    Вернуть локальный путь к клипу dph согласно FILE_FETCH_MODE. Одновременные
+    запросы одного и того же файла скачивают его один раз.
+    """
+    mode = fetch_mode()
+    if mode == "local" or (mode == "auto" and os.path.exists(dph)):
+        if not os.path.exists(dph):
+            logger.error(f"{label}. При этом фактически файла нет на диске! ({dph})")
+        return dph
+
+    dest_path = os.path.join(dest_dir, os.path.basename(dph))
+    fut = _inflight.get(dest_path)
+    if fut is None:
+        url = build_file_url(dph, jsession, size_hint)
+        fut = asyncio.ensure_future(fetch_file(url, dest_path, expected_size=size_hint, label=label))
+        _inflight[dest_path] = fut
+        fut.add_done_callback(lambda f, k=dest_path: _inflight.pop(k, None) if _inflight.get(k) is f else None)
+    return await asyncio.shield(fut)
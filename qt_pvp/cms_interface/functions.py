@@ -1,21 +1,34 @@
 from typing import Optional, Dict, Any, List, Tuple
+from qt_pvp.cms_interface import session as cms_session
+from qt_pvp.cms_interface import retry_policy
+from qt_pvp.cms_interface import limits
+from qt_pvp.interests_search.track_frame import TrackFrame, dt_to_ts
+from qt_pvp.interests_search.detection_params import DetectionParams
+from qt_pvp.interests_search import detection_params
 from qt_pvp.functions import get_reg_info
+from qt_pvp.interests_search import switch_runs
+from qt_pvp.interests_search import segments
 from qt_pvp import geo_funcs
+from qt_pvp import stop_search
 from qt_pvp.logger import logger
 from qt_pvp.data import settings
-from bisect import bisect_left
+import numpy as np
 import datetime
 import functools
+import inspect
 import asyncio
 import httpx
 
 
 io_to_reg_map = {1: 20, 2: 21, 3: 22, 4: 23}
+KGO_LOOKBACK_SECONDS = 1500  # глубина поиска остановки перед концевиком бункера (КГО)
 
 
 class LoadingInProgress(RuntimeError):
     """ Погрузка еще в процессе, прерываем поиск интересов """
-    pass
+    def __init__(self, index: int | None = None):
+        super().__init__("Loading in progress")
+        self.index = index  # индекс трека с концевиком незавершённой погрузки
 
 def get_interest_from_track(track, start_time: str, end_time: str,
                             photo_before_timestamp: str = None,
@@ -407,60 +420,59 @@ def estimate_stop_start_kmhps(
 
 
 def find_interests_by_lifting_switches(
-        tracks, sec_before=30, sec_after=60, start_tracks_search_time=None, reg_id=None, alarms=None):
+        tracks, sec_before=30, sec_after=60, start_tracks_search_time=None, reg_id=None, alarms=None,
+        start_index=0, first_interest=True, params: DetectionParams | None = None):
     """
-    tracks – список треков CMS (gt, s1, sp, ps и т.д.)
+    tracks – список треков CMS (gt, s1, sp, ps и т.д.) или готовый TrackFrame
+    params – параметры прохода (detection_params.for_reg(reg_cfg)); по умолчанию — текущий снимок
+             config.cfg с переопределениями регистратора reg_id из состояния
     alarms – ПОДГОТОВЛЕННЫЕ алармы: {"alarms": [...], "starts": [...]}, см. prepare_alarms(...)
              Если формат иной или None — логика по алармам будет пропущена (ничего не ломаем).
+    start_index – с какого трека искать концевики (треки до него — только история для поиска остановки)
+    first_interest – False, если истории до start_index заведомо хватает и догружать её не нужно
+
+    В ответе кроме "interests" — "next_index": первый трек, который цикл ещё не прошёл
+    (с него продолжает инкрементальный детектор), и "in_progress_index", если поиск
+    остановлен на незавершённой погрузке.
     """
+    frame = TrackFrame.of(tracks)
+    n = len(frame)
     loading_intervals = []
-    i = 0
-    first_interest = True   # Используем в случаях, когда для первого интереса не найдена начальная остановка в заданных треках
-    reg_cfg = get_reg_info(reg_id) if reg_id else None
+    i = start_index
+    if params is None:
+        params = detection_params.for_reg(get_reg_info(reg_id) if reg_id else None)
 
     try:
-        ignore_points = geo_funcs.get_ignore_points()
+        ignore_index = geo_funcs.get_ignore_index()
     except Exception as e:
         logger.warning(f"{reg_id}: [IGNORE] Не удалось загрузить ignore_points: {e}")
-        ignore_points = []
-    ignore_tolerance = settings.config.getint("Interests", "IGNORE_POINTS_TOLERANCE", fallback=0)
+        ignore_index = geo_funcs.IgnoreZoneIndex([])
+    ignore_tolerance = params.ignore_tolerance
 
     def _ignored_geo(geo: str | None) -> str | None:
-        if not geo or not ignore_points or ignore_tolerance <= 0:
+        if not geo or not len(ignore_index) or ignore_tolerance <= 0:
             return None
         try:
-            return geo_funcs.find_nearby_name(geo, ignore_points, ignore_tolerance)
+            return ignore_index.nearest_name(geo, ignore_tolerance)
         except Exception as e:
             logger.warning(f"{reg_id}: [IGNORE] Ошибка проверки точки игнора: {e}")
             return None
 
-    try:
-        euro_alarm_cfg = int((reg_cfg or {}).get("euro_container_alarm", 4))
-    except Exception:
-        euro_alarm_cfg = 4
-    try:
-        kgo_alarm_cfg_val = (reg_cfg or {}).get("kgo_container_alarm")
-        kgo_alarm_cfg = int(kgo_alarm_cfg_val) if kgo_alarm_cfg_val is not None else None
-    except Exception:
-        kgo_alarm_cfg = None
-
-    euro_bit_idx = io_to_reg_map.get(euro_alarm_cfg, 23)
-    kgo_bit_idx = io_to_reg_map.get(kgo_alarm_cfg, None) if kgo_alarm_cfg is not None else None
-
-    last_stop_started_at: datetime.datetime | None = None
-    prev_speed: int | None = None
-    min_stop_speed = settings.config.getint("Interests", "MIN_STOP_SPEED")
-    min_move_speed = settings.config.getint("Interests", "MIN_MOVE_SPEED")
-    min_stop_duration = settings.config.getint("Interests", "MIN_STOP_DURATION_SEC")
-    def _update_stop_state(cur_dt: datetime.datetime, cur_speed: int):
-        nonlocal last_stop_started_at, prev_speed
-        # старт остановки при переходе через порог вниз
-        if cur_speed <= min_stop_speed and (prev_speed is None or prev_speed > min_stop_speed):
-            last_stop_started_at = cur_dt
-        # любая устойчивая «поехали» сбрасывает маркер остановки
-        if cur_speed >= min_move_speed:
-            last_stop_started_at = None
-        prev_speed = cur_speed
+    euro_bit_idx = io_to_reg_map.get(params.euro_alarm, 23)
+    kgo_bit_idx = io_to_reg_map.get(params.kgo_alarm, None) if params.kgo_alarm is not None else None
+
+    min_stop_speed = params.min_stop_speed
+    min_move_speed = params.min_move_speed
+    min_stop_duration = params.min_stop_duration
+    GAP_THRESHOLD = params.gap_threshold
+
+    # Биты концевиков снимаются с колонки s1 разом; главный цикл идёт только по событиям —
+    # точкам с концевиком и разрывам в треках, — а маркер остановки между ними перематывается.
+    switches = switch_runs.SwitchRuns(frame, euro_bit_idx, kgo_bit_idx, min_move_speed)
+    stop_marker = switch_runs.StopStartTracker(frame, min_stop_speed, min_move_speed)
+    gap_idx = np.flatnonzero(np.diff(frame.ts) > GAP_THRESHOLD) if n > 1 else np.zeros(0, dtype=np.int64)
+    event_idx = np.union1d(switches.switch_idx, gap_idx)
+    stop_marker.advance(0, start_index - 1)
 
     # --- локальная утилита для быстрого поиска алармов в окне разрыва ---
     def _alarms_in_gap(prepared, gap_start_ts, gap_end_ts):
@@ -481,24 +493,27 @@ def find_interests_by_lifting_switches(
             logger.warning(f"{reg_id}: [ALARM GAP] Не удалось выбрать алармы в разрыве: {e}")
             return []
 
-    while i < len(tracks) - 1:
-        # Защита от выхода за границы для next_track
-        if i + 1 >= len(tracks):
+    while i < n - 1:
+        # следующее событие; точки до него влияют только на маркер остановки
+        k = int(np.searchsorted(event_idx, i, side="left"))
+        if k >= len(event_idx) or event_idx[k] >= n - 1:
+            i = n - 1
             break
-        track = tracks[i]
-        next_track = tracks[i + 1]
-        cur_speed = int(track.get("sp") or 0)
-        t_curr_dt = track.get("gt")  # строка (для логов)
-        t_next_dt = next_track.get("gt")  # строка (для логов)
+        stop_marker.advance(i, int(event_idx[k]) - 1)
+        i = int(event_idx[k])
+
+        track = frame.rows[i]
+        cur_speed = frame.speed_int(i)
+        t_curr_dt = frame.gt[i]  # строка (для логов)
+        t_next_dt = frame.gt[i + 1]  # строка (для логов)
 
         # --- вычисление разрыва между текущим треком и следующим ---
-        t_curr = datetime.datetime.strptime(t_curr_dt, "%Y-%m-%d %H:%M:%S")
-        t_next = datetime.datetime.strptime(t_next_dt, "%Y-%m-%d %H:%M:%S")
+        t_curr = frame.dt(i)
+        t_next = frame.dt(i + 1)
 
-        _update_stop_state(t_curr, cur_speed)
+        stop_marker.advance(i, i)
 
-        gap_sec = (t_next - t_curr).total_seconds()
-        GAP_THRESHOLD = settings.config.getint("Interests", "GAP_THRESHOLD_SEC", fallback=10)
+        gap_sec = float(frame.ts[i + 1] - frame.ts[i])
         if gap_sec > GAP_THRESHOLD:
             logger.debug(f"Обнаружен разрыв в треках: {t_curr} → {t_next} = {gap_sec:.1f}s")
 
@@ -541,8 +556,7 @@ def find_interests_by_lifting_switches(
                     )
                     # оценим «последнюю секунду устойчивой остановки» внутри окна (t_curr..alarm_dt)
                     # кейс 1: мы и так стояли на последнем треке — берём почти у самого аларма
-                    min_stop_speed = settings.config.getint("Interests", "MIN_STOP_SPEED")
-                    v_prev = int(track.get("sp") or 0)
+                    v_prev = cur_speed
                     eps = 0.1
                     lo = t_curr + datetime.timedelta(seconds=eps)
                     hi = alarm_dt - datetime.timedelta(seconds=eps)
@@ -557,12 +571,13 @@ def find_interests_by_lifting_switches(
                     else:
                         # кейс 2: на последнем треке мы НЕ стояли → пробуем обычный поиск по времени (он уже устойчив к дыркам)
                         time_before = find_first_stable_stop(
-                            tracks, i, alarm_dt, settings, first_interest, start_tracks_search_time, reg_id
+                            frame, i, alarm_dt, settings, first_interest, start_tracks_search_time, reg_id,
+                            params=params
                         )
                         logger.debug(f"Кейс 2. Оцененный time_before: {time_before}")
                 else:
-                    time_before = find_first_stable_stop(tracks, i, alarm_dt, settings, first_interest,
-                                                         start_tracks_search_time, reg_id)
+                    time_before = find_first_stable_stop(frame, i, alarm_dt, settings, first_interest,
+                                                         start_tracks_search_time, reg_id, params=params)
 
                 if delta_alarm_to_first_track_seconds > 30:
                     logger.warning(
@@ -586,15 +601,15 @@ def find_interests_by_lifting_switches(
                     time_after = alarm_dt + datetime.timedelta(seconds=120)
                     time_after = time_after.strftime(settings.TIME_FMT)
                 else:
-                    time_after, last_stop_idx = find_stop_after_lifting(tracks, i + 1, settings, logger, reg_id)
+                    time_after, last_stop_idx = find_stop_after_lifting(frame, i + 1, settings, logger, reg_id,
+                                                                        params=params)
                     if not time_after:
-                        time_after = tracks[i + 1].get("gt")
+                        time_after = frame.gt[i + 1]
                         last_stop_idx = i + 1
 
                 # Сдвиг фото ПОСЛЕ
                 raw_time_after = datetime.datetime.strptime(time_after, settings.TIME_FMT)
-                adjusted_time_after = raw_time_after - datetime.timedelta(
-                    seconds=settings.config.getint("Interests", "PHOTO_AFTER_SHIFT_SEC"))
+                adjusted_time_after = raw_time_after - datetime.timedelta(seconds=params.photo_after_shift)
                 time_after_adj = adjusted_time_after.strftime("%Y-%m-%d %H:%M:%S")
 
                 # «окно интереса» для выгрузки (как у тебя ниже: end_time — это time_30_after)
@@ -602,7 +617,7 @@ def find_interests_by_lifting_switches(
                 end_time = time_after or time_30_after
 
                 interval = get_interest_from_track(
-                    tracks[-1],
+                    frame.rows[-1],
                     start_time=time_before,
                     end_time=end_time,
                     photo_before_timestamp=time_before,
@@ -630,30 +645,27 @@ def find_interests_by_lifting_switches(
 
 
         # === Старая логика концевиков — без изменений ===
-        s1 = track.get("s1")
-        timestamp = track.get("gt")
-        current_dt = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-        s1_int = int(s1)
-
-        bits = list(bin(s1_int & 0xFFFFFFFF)[2:].zfill(32))
-        bits.reverse()
-        min_speed_for_switch_detect = settings.config.getint("Interests", "MIN_SPEED_FOR_SWITCH_DETECT")
-        euro_on = bits[euro_bit_idx] == '1'
-        kgo_on = (kgo_bit_idx is not None) and (bits[kgo_bit_idx] == '1')
+        timestamp = t_curr_dt
+        current_dt = t_curr
+
+        min_speed_for_switch_detect = params.min_speed_for_switch_detect
+        euro_on = bool(switches.euro[i])
+        kgo_on = bool(switches.kgo[i])
         if euro_on or kgo_on:
             cargo_type = "Бункер" if kgo_on else "Контейнер"
-            logger.info(f"{reg_id}: [SWITCH] Срабатывание концевика в {timestamp}, EuroIO(bit {euro_bit_idx})={bits[euro_bit_idx]}" + (f", KGOIO(bit {kgo_bit_idx})={bits[kgo_bit_idx]}" if kgo_bit_idx is not None else ""))
+            logger.info(f"{reg_id}: [SWITCH] Срабатывание концевика в {timestamp}, EuroIO(bit {euro_bit_idx})={int(euro_on)}" + (f", KGOIO(bit {kgo_bit_idx})={int(kgo_on)}" if kgo_bit_idx is not None else ""))
 
-            if int(track.get("sp") or 0) > min_speed_for_switch_detect:
+            if cur_speed > min_speed_for_switch_detect:
                 logger.debug(
-                    f"{reg_id}: [SWITCH] Игнор: скорость {int(track.get('sp') or 0)} > {min_speed_for_switch_detect}")
+                    f"{reg_id}: [SWITCH] Игнор: скорость {cur_speed} > {min_speed_for_switch_detect}")
                 i += 1
                 continue
 
             # 2) Предчек: стояли ли достаточно до концевика
-            # Сравниваем datetime с datetime (t_curr и last_stop_started_at)
-            if (last_stop_started_at is None) or ((t_curr - last_stop_started_at).total_seconds() < min_stop_duration):
-                dur = 0 if last_stop_started_at is None else (t_curr - last_stop_started_at).total_seconds()
+            stop_started = stop_marker.started
+            stop_dur = None if stop_started is None else float(frame.ts[i] - frame.ts[stop_started])
+            if (stop_dur is None) or (stop_dur < min_stop_duration):
+                dur = stop_dur or 0
                 logger.info(f"{reg_id} [SWITCH] Недостаточная длительность остановки перед концевиком ({dur:.1f}s < {min_stop_duration}s) — игнорируем.")
                 i += 1
                 continue
@@ -661,16 +673,17 @@ def find_interests_by_lifting_switches(
             logger.debug(f"{reg_id}: [SWITCH] Принято: {cargo_type} в {timestamp}")
             switch_events = []
 
-            if i >= len(tracks):
+            if i >= n:
                 logger.warning(f"{reg_id}: [SWITCH] Индекс {i} вне диапазона треков. Прерывание.")
                 break
 
             # Находим время для фото ДО (Последнее время в окне стабильных остановок)
             max_lookback_seconds = None
             if cargo_type == "Бункер":
-                max_lookback_seconds = 1500
+                max_lookback_seconds = KGO_LOOKBACK_SECONDS
             time_before = find_first_stable_stop(
-                tracks, i, current_dt, settings, first_interest, start_tracks_search_time, reg_id, max_lookback_seconds)
+                frame, i, current_dt, settings, first_interest, start_tracks_search_time, reg_id, max_lookback_seconds,
+                params=params)
             if not time_before:
                 logger.warning(f"{reg_id}: [BEFORE] Не найдена остановка до сработки концевика в {timestamp}")
                 if first_interest:
@@ -680,83 +693,40 @@ def find_interests_by_lifting_switches(
                     time_before = current_dt - datetime.timedelta(seconds=120)
                     time_before = time_before.strftime(settings.TIME_FMT)
 
-            lifting_end_idx = i
-            last_switch_index = i
-
             if euro_on:
                 switch_events.append({"datetime": timestamp, "switch": euro_bit_idx})
             if kgo_on:
                 switch_events.append({"datetime": timestamp, "switch": kgo_bit_idx})
 
-            # В этом цикле мы перебираем треки и ищем трек, когда погрузка закочена (по скорости и концевику)
+            # Ищем трек, когда погрузка закончена (по скорости и концевику)
             logger.debug(f"{reg_id}: [Конец интереса] Начало интереса найдено. Теперь ищем конец интереса.")
             logger.debug(f"Для начала пойдем вперед по трекам и найдем момент, когда машина двинулась")
-            move_started_at = None
-            move_started_at_str = None
-            while lifting_end_idx + 1 < len(tracks):
-                next_track = tracks[lifting_end_idx + 1]
-                next_s1 = next_track.get("s1")
-                next_spd = int(next_track.get("sp") or 0)
-                try:
-                    next_s1_int = int(next_s1)
-                except (ValueError, TypeError):
-                    break
-
-                next_bits = list(bin(next_s1_int & 0xFFFFFFFF)[2:].zfill(32))
-                next_bits.reverse()
-
-                logger.debug(f"{reg_id}: [Конец интереса] Ищем движение после погрузки."
-                             f" {next_track.get('gt')}, "
-                             f"EuroIO(bit {euro_bit_idx})={next_bits[euro_bit_idx]}" +
-                             (f", KGOIO(bit {kgo_bit_idx})={next_bits[kgo_bit_idx]}"
-                              if kgo_bit_idx is not None else "") + f", sp={next_spd}")
-
-                min_move_speed = settings.config.getint("Interests", "MIN_MOVE_SPEED")
-                min_move_duration = settings.config.getint("Interests", "MIN_MOVE_DURATION_SEC")
-                sw_time = next_track.get("gt")
-                ts = _to_ts(sw_time)
-
-                # 1) если сработал концевик — фиксируем и продолжаем расширять окно
-                if next_bits[euro_bit_idx] == '1' or (kgo_bit_idx is not None and next_bits[kgo_bit_idx] == '1'):
-                    lifting_end_idx += 1
-                    if next_bits[euro_bit_idx] == '1':
-                        switch_events.append({"datetime": sw_time, "switch": euro_bit_idx})
-                    if kgo_bit_idx is not None and next_bits[kgo_bit_idx] == '1':
-                        switch_events.append({"datetime": sw_time, "switch": kgo_bit_idx})
-                    last_switch_index = lifting_end_idx
-
-                # 2) если скорость низкая — расширяем окно, но сбрасываем накопление «движения»
-                elif next_spd < min_move_speed:
-                    lifting_end_idx += 1
-                    move_started_at = None
-
-                # 3) скорость выше порога — проверяем длительность устойчивого движения
-                else:
-                    if move_started_at is None:
-                        move_started_at = ts
-                        move_started_at_str = sw_time
-                        logger.debug(f"{reg_id}: [Конец интереса] Убедились, что машина поехала на {move_started_at_str}.")
-                    lifting_end_idx += 1
-                    logger.debug(f"{reg_id}: [Конец интереса] Проверяем достаточно прошло ли времени - {int(ts - move_started_at) >= int(min_move_duration)}. "
-                                 f"cur_time - ({sw_time}), min_move_duration - {min_move_duration}, lifting_end_idx - {lifting_end_idx}.")
-                    if ts - move_started_at >= int(min_move_duration):
-                        logger.debug(f"{reg_id}: [Конец интереса] Времени прошло достаточно")
-                        break
+            min_move_duration = params.min_move_duration
+            # Концевики расширяют окно, низкая скорость тоже (сбрасывая отсчёт движения);
+            # конец — когда движение >= MIN_MOVE_SPEED длится MIN_MOVE_DURATION_SEC. Идём по сериям.
+            lifting_end_idx, last_switch_index, next_switches, move_idx = switches.scan_lifting_end(
+                i, min_move_duration)
+            for j in next_switches:
+                if switches.euro[j]:
+                    switch_events.append({"datetime": frame.gt[j], "switch": euro_bit_idx})
+                if switches.kgo[j]:
+                    switch_events.append({"datetime": frame.gt[j], "switch": kgo_bit_idx})
+            move_started_at_str = frame.gt[move_idx] if move_idx is not None else None
 
             logger.debug(f"{reg_id}: [Конец интереса] Вышли из цикла поиска движения после последнего концевика. "
                          f"last_switch_index={last_switch_index}, move_started_at={move_started_at_str}")
-            time_after, last_stop_idx = find_stop_after_lifting(tracks, last_switch_index + 1, settings, logger, reg_id)
+            time_after, last_stop_idx = find_stop_after_lifting(frame, last_switch_index + 1, settings, logger, reg_id,
+                                                                params=params)
             used_fallback = False
 
             if not time_after:
                 # Фоллбэк ТОЛЬКО если давно нет новых треков (последний трек старше 30 минут)
-                fmt = "%Y-%m-%d %H:%M:%S"
-                last_track_dt = datetime.datetime.strptime(tracks[-1]['gt'], fmt)
+                last_track_dt = frame.dt(n - 1)
                 age_sec = (datetime.datetime.now() - last_track_dt).total_seconds()
 
                 if age_sec > 30 * 60:
                     # Телеметрия не обновляется ≥30 мин — применяем страховку
-                    time_after = fallback_photo_after_time(tracks, last_switch_index, settings, logger)
+                    time_after = fallback_photo_after_time(frame, last_switch_index, settings, logger, params=params)
                     if not time_after:
                         i = lifting_end_idx + 1
                         continue
@@ -767,9 +737,9 @@ def find_interests_by_lifting_switches(
                     logger.info(
                         f"{reg_id}: [AFTER] Пропускаем fallback: последний трек свежий ({age_min:.1f} мин назад, {last_track_dt}). Ждём движения.")
                     if loading_intervals:
-                        return {"interests": loading_intervals}
+                        return {"interests": loading_intervals, "next_index": i, "in_progress_index": i}
                     else:
-                        raise LoadingInProgress
+                        raise LoadingInProgress(i)
                     #i = lifting_end_idx + 1
                     #continue
 
@@ -778,9 +748,9 @@ def find_interests_by_lifting_switches(
                 i = lifting_end_idx + 1
                 continue
 
-            before_adjust_secs = settings.config.getint("Interests", "INTEREST_EURO_BEFORE_SHIFT_SEC")
+            before_adjust_secs = params.euro_before_shift
             if kgo_on:
-                before_adjust_secs = settings.config.getint("Interests", "INTEREST_KGO_BEFORE_SHIFT_SEC")
+                before_adjust_secs = params.kgo_before_shift
 
             if before_adjust_secs:
                 logger.debug(f"{reg_id}: Двигаем время начала интереса на {before_adjust_secs}с")
@@ -788,14 +758,14 @@ def find_interests_by_lifting_switches(
                 adjusted_time_before= raw_time_before + datetime.timedelta(seconds=before_adjust_secs)
                 time_before = adjusted_time_before.strftime(settings.TIME_FMT)
 
-            after_adjust_secs = settings.config.getint("Interests", "PHOTO_AFTER_SHIFT_SEC")
+            after_adjust_secs = params.photo_after_shift
             if after_adjust_secs:
                 raw_time_after = datetime.datetime.strptime(time_after, settings.TIME_FMT)
                 adjusted_time_after = raw_time_after - datetime.timedelta(seconds=after_adjust_secs)
                 logger.debug(f"{reg_id}: Двигаем время конца интереса на {after_adjust_secs}с")
                 time_after = adjusted_time_after.strftime(settings.TIME_FMT)
 
-            last_alarm_dt = datetime.datetime.strptime(tracks[last_switch_index].get("gt"), settings.TIME_FMT)
+            last_alarm_dt = frame.dt(last_switch_index)
             time_30_after_dt = last_alarm_dt + datetime.timedelta(seconds=sec_after)
             time_30_after = time_30_after_dt.strftime(settings.TIME_FMT)
 
@@ -803,7 +773,7 @@ def find_interests_by_lifting_switches(
             if time_before and time_after:
                 logger.info(f"{reg_id}: Интерес найден! {time_before} до {end_time}")
                 interval = get_interest_from_track(
-                    tracks[-1],
+                    frame.rows[-1],
                     start_time=time_before,
                     end_time=end_time,
                     photo_before_timestamp=time_before,
@@ -830,21 +800,10 @@ def find_interests_by_lifting_switches(
         else:
             i += 1
 
-    return {"interests": loading_intervals}
+    return {"interests": loading_intervals, "next_index": i}
 
-def _to_ts(gt):
-    """Универсально переводим поле времени в timestamp (сек)."""
-    if isinstance(gt, (int, float)):
-        return float(gt)
-    # пробуем ISO8601
-    from datetime import datetime
-    try:
-        return datetime.fromisoformat(gt).timestamp()
-    except Exception:
-        # запасной формат "YYYY-mm-dd HH:MM:SS"
-        return datetime.strptime(gt, "%Y-%m-%d %H:%M:%S").timestamp()
 
-def find_stop_after_lifting(tracks, start_idx, settings, logger=None, reg_id=None):
+def find_stop_after_lifting(tracks, start_idx, settings, logger=None, reg_id=None, params: DetectionParams | None = None):
     """
     Ищем момент НАЧАЛА ДВИЖЕНИЯ после lifting и возвращаем (t_move_str, last_stop_idx).
     Поправки:
@@ -860,140 +819,57 @@ def find_stop_after_lifting(tracks, start_idx, settings, logger=None, reg_id=Non
             def warning(self, *a, **k): pass
         logger = _N()
 
-    min_stop_speed = settings.config.getint("Interests", "MIN_STOP_SPEED")
-    min_stop_duration = settings.config.getint("Interests", "MIN_STOP_DURATION_SEC")
-    min_move_speed = settings.config.getint("Interests", "MIN_MOVE_SPEED")
-    min_move_duration = settings.config.getint("Interests", "MIN_MOVE_DURATION_SEC")
-    # ограничение вклада одного шага при очень больших дырках
-    sample_gap_cap = settings.config.getint("Interests", "SAMPLE_GAP_CAP_SEC", fallback=20)
-
-    def ts(i: int) -> datetime.datetime:
-        return datetime.datetime.strptime(tracks[i]["gt"], "%Y-%m-%d %H:%M:%S")
+    if params is None:
+        params = detection_params.for_reg(get_reg_info(reg_id) if reg_id else None)
+    min_move_speed = params.min_move_speed
 
-    def spd(i: int) -> float:
-        return float(tracks[i].get("sp") or 0)
-
-    n = len(tracks)
+    frame = TrackFrame.of(tracks)
+    n = len(frame)
     if not (0 <= start_idx < n):
         logger.warning(f"{reg_id}: [AFTER] start_idx {start_idx} вне диапазона треков")
         return None, None
 
-    # --- ключевая правка: учитывать dt от ПРЕДЫДУЩЕЙ точки, если она есть
-    prev_index_for_dt = start_idx - 1 if start_idx - 1 >= 0 else start_idx
-    prev_t = ts(prev_index_for_dt)
-
-    stop_active = False
-    stop_low_dur = 0.0
-    stop_end_idx = None
-
-    move_active = False
-    move_dur = 0.0
-    move_start_idx = None
-
-    # Для подтверждения по "двум точкам движения"
-    first_move_ts = None
-
-    i = start_idx
-    while i < n:
-        t = ts(i)
-        v = spd(i)
-        dt_raw = (t - prev_t).total_seconds()
-        dt = min(max(dt_raw, 0.0), sample_gap_cap)  # кап для сверхбольших дыр
-
-        logger.debug(f"[КОНЕЦ ИНТЕРЕСА] find_stop_after_lifting. t - {t}, v - {v}")
-
-        is_stop = (v <= min_stop_speed)
-        is_move = (v >= min_move_speed)
-
-        # --- зона остановки ---
-        if is_stop:
-            if not stop_active:
-                stop_active = True
-                stop_low_dur = 0.0
-            stop_low_dur += dt
-            stop_end_idx = i
-            # низкая скорость сбрасывает накопление "движения"
-            move_active = False
-            move_dur = 0.0
-            move_start_idx = None
-            first_move_ts = None
-
-        else:
-            # завершение «короткой» псевдо-остановки — не считаем её
-            if stop_active and stop_low_dur < min_stop_duration:
-                stop_active = False
-                stop_low_dur = 0.0
-                stop_end_idx = None
-
-            if is_move:
-                # 1) подтверждение движения "по времени" (старый критерий, но на реальном dt)
-                if not move_active:
-                    move_active = True
-                    move_dur = 0.0
-                    move_start_idx = i
-                    # первая "move"-точка для критерия "две точки"
-                    first_move_ts = t
-                move_dur += dt
-
-                # 2) подтверждение по двум точкам движения (устойчиво к редкой сетке)
-                two_points_confirm = False
-                if first_move_ts is not None:
-                    two_points_confirm = (t - first_move_ts).total_seconds() >= float(min_move_duration)
-
-                if (move_active and move_dur >= float(min_move_duration)) or two_points_confirm:
-                    # есть «последний стоп»?
-                    if stop_end_idx is None:
-                        # формально движения хватило, но валидной остановки перед ним мы не собрали
-                        # продолжим сканировать (или можно вернуть t как есть)
-                        pass
-                    else:
-                        # оценим момент старта движения между t0=последний стоп и t1=первая move-точка
-                        t0 = ts(stop_end_idx)
-                        t1 = ts(move_start_idx)
-                        v1 = spd(move_start_idx)
-                        dt_gap = (t1 - t0).total_seconds()
-
-                        if dt_gap > 1.0:
-                            # оценка внутри разрыва по твоей функции
-                            t_move = estimate_move_start_kmhps(
-                                t0=t0, t1=t1, v1_kmh=v1,
-                                min_move_speed=min_move_speed,
-                                small_gap_sec=settings.config.getint("Interests", "INTERESTS_MOVE_SMALL_GAP_SEC", fallback=5),
-                                max_gap_sec=settings.config.getint("Interests", "INTERESTS_MOVE_MAX_GAP_SEC", fallback=30),
-                                A_KMHPS=float(settings.config.get("Interests", "INTERESTS_MOVE_A_KMHPS", fallback="1.26")),
-                                clamp_eps=0.1
-                            )
-                            t_move_str = t_move.strftime("%Y-%m-%d %H:%M:%S")
-                            logger.debug(f"{reg_id}: [AFTER] Оценили момент старта движения с разрывом {dt_gap:.1f}s → {t_move_str}")
-                            return t_move_str, stop_end_idx
-                        else:
-                            # плотная сетка — старт ≈ на первой move-точке
-                            return t1.strftime("%Y-%m-%d %H:%M:%S"), stop_end_idx
-            else:
-                # промежуточная скорость — сбрасываем подтверждение движения
-                move_active = False
-                move_dur = 0.0
-                move_start_idx = None
-                first_move_ts = None
-
-        prev_t = t
-        i += 1
-
-    logger.warning(f"{reg_id}: [PHOTO AFTER] Не удалось подтвердить движение после lifting (start_idx={start_idx})")
-    #return ts(start_idx).strftime(settings.TIME_FMT), start_idx
+    # Серии стопа/движения (с капом SAMPLE_GAP_CAP_SEC на шаг) считаются один раз на фрейм:
+    # первая длинная остановка от start_idx (шаг первой точки — от start_idx-1), затем первая
+    # серия движения, набравшая MIN_MOVE_DURATION_SEC по сумме шагов или по времени между точками.
+    found = segments.get_index(frame, params).stop_then_move(start_idx)
+    if found is None:
+        logger.warning(f"{reg_id}: [PHOTO AFTER] Не удалось подтвердить движение после lifting (start_idx={start_idx})")
+        return None, None
 
-    return None, None
+    stop_end_idx, move_start_idx = found
+    # оценим момент старта движения между t0=последний стоп и t1=первая move-точка
+    t0 = frame.dt(stop_end_idx)
+    t1 = frame.dt(move_start_idx)
+    v1 = float(frame.sp[move_start_idx])
+    dt_gap = (t1 - t0).total_seconds()
+
+    if dt_gap > 1.0:
+        # оценка внутри разрыва по твоей функции
+        t_move = estimate_move_start_kmhps(
+            t0=t0, t1=t1, v1_kmh=v1,
+            min_move_speed=min_move_speed,
+            small_gap_sec=params.move_small_gap,
+            max_gap_sec=params.move_max_gap,
+            A_KMHPS=params.move_a_kmhps,
+            clamp_eps=0.1
+        )
+        t_move_str = t_move.strftime("%Y-%m-%d %H:%M:%S")
+        logger.debug(f"{reg_id}: [AFTER] Оценили момент старта движения с разрывом {dt_gap:.1f}s → {t_move_str}")
+        return t_move_str, stop_end_idx
+    # плотная сетка — старт ≈ на первой move-точке
+    return t1.strftime("%Y-%m-%d %H:%M:%S"), stop_end_idx
 
 
-def fallback_photo_after_time(tracks, last_switch_index, settings, logger=None):
+def fallback_photo_after_time(tracks, last_switch_index, settings, logger=None, params: DetectionParams | None = None):
     """
     Страховочный механизм на случай, если не удалось найти стабильную остановку.
     Если с момента последнего срабатывания концевика прошло достаточно времени,
     то возвращаем время после как last_switch_time + 60 сек.
     """
-    last_switch_time = datetime.datetime.strptime(tracks[last_switch_index]['gt'], "%Y-%m-%d %H:%M:%S")
+    last_switch_time = TrackFrame.of(tracks).dt(last_switch_index)
     now = datetime.datetime.now()
-    max_wait_sec = settings.config.getint("Interests", "MAX_WAIT_TIME_MINUTES") * 60
+    max_wait_sec = (params or DetectionParams.from_config(settings.config)).max_wait_sec
 
     if (now - last_switch_time).total_seconds() > max_wait_sec:
         fallback_time = last_switch_time + datetime.timedelta(seconds=60)
@@ -1018,6 +894,7 @@ def find_first_stable_stop(
     start_tracks_search_time=None,
     reg_id=None,
     max_lookback_seconds=None,
+    params: DetectionParams | None = None,
 ):
     """
     Возвращает:
@@ -1033,188 +910,77 @@ def find_first_stable_stop(
     """
 
     # ---- Конфигурация
-    cfg = settings.config
+    if params is None:
+        params = detection_params.for_reg(get_reg_info(reg_id) if reg_id else None)
     if not max_lookback_seconds:
-        max_lookback_seconds = cfg.getint("Interests", "MAX_LOOKBACK_SECONDS")
+        max_lookback_seconds = params.max_lookback_seconds
     cutoff_time = current_dt - datetime.timedelta(seconds=max_lookback_seconds)
 
-    min_stop_speed        = cfg.getint("Interests", "MIN_STOP_SPEED")
-    min_stop_duration_sec = cfg.getint("Interests", "MIN_STOP_DURATION_SEC")
-    min_move_speed        = cfg.getint("Interests", "MIN_MOVE_SPEED")
-    min_move_duration_sec = int(cfg.get("Interests", "MIN_MOVE_DURATION_SEC",
-                                        fallback=str(min_stop_duration_sec)))
-    sample_gap_cap        = cfg.getint("Interests", "SAMPLE_GAP_CAP_SEC", fallback=20)
-    post_window_sec       = cfg.getint("Interests", "POST_CONFIRM_MOVE_WINDOW_SEC", fallback=30)
-
-    TIME_FMT = settings.TIME_FMT
+    # пороги скорости/длительности и SAMPLE_GAP_CAP_SEC берёт segments.get_index
+    post_window_sec = params.post_confirm_window
 
-    def ts(i: int) -> datetime.datetime:
-        return datetime.datetime.strptime(tracks[i]["gt"], TIME_FMT)
-
-    def spd(i: int) -> int:
-        v = tracks[i].get("sp")
-        try:
-            return int(v or 0)
-        except Exception:
-            return 0
+    frame = TrackFrame.of(tracks)
 
     # ---- Пусто?
-    if not tracks:
+    if not len(frame):
         logger.warning(f"{reg_id}: [ОСТАНОВКА НЕ НАЙДЕНА] пустой массив треков")
         return None
 
     # ---- Окно поиска (слева: по времени, справа: по индексу концевика)
-    times = [ts(i) for i in range(len(tracks))]
-    left  = bisect_left(times, cutoff_time)
-    right = max(0, min(start_index, len(tracks) - 1))
+    times = frame.ts  # секунды, уже разобраны один раз на весь фрейм
+    gt = frame.gt
+    left  = int(np.searchsorted(times, dt_to_ts(cutoff_time), side="left"))
+    right = max(0, min(start_index, len(frame) - 1))
     if left > right:
         logger.warning(f"{reg_id}: [ОКНО ПУСТО]")
         return None
 
+    index = segments.get_index(frame, params, int_speed=True)
+
     # ---- ФАЗА 1: поиск ближайшей ПОДТВЕРЖДЁННОЙ остановки до концевика
     #
-    # Идея: проходим окно слева направо, собираем серии «стопа».
-    # - Короткая серия (< min_stop_duration_sec), как только встретилось движение (v > min_stop_speed) — СБРАСЫВАЕМ.
-    # - Длинная серия (>= min_stop_duration_sec) может быть «подтверждена», если после неё было ПРОТЯЖЁННОЕ движение
-    #   (v >= min_move_speed суммарно >= min_move_duration_sec). Храним «последнюю подтверждённую».
-    stop_active = False
-    stop_start_i = None
-    stop_low_dur = 0.0
-
-    move_after_stop_dur = 0.0  # длительность подтверждающего движения после длинной остановки
-    last_confirmed = None      # {'stop_start_i', 'confirm_i', 'confirm_t'}
-
-    prev_t = times[left]
-    for i in range(left, right + 1):
-        t = times[i]
-        dt_raw = (t - prev_t).total_seconds() if i > left else 0.0
-        dt    = min(max(dt_raw, 0.0), sample_gap_cap)
-
-        v = spd(i)
-        is_stop         = v <= min_stop_speed
-        is_move_confirm = v >= min_move_speed
-
-        logger.debug(
-            f"{reg_id}: [Поиск начала интереса] i={i}, t={t}, v={v}, "
-            f"stop_active={stop_active}, stop_low_dur={stop_low_dur:.1f}, move_dur={move_after_stop_dur:.1f}"
-        )
-
-        if is_stop:
-            # вошли/продолжаем режим "стоп"
-            if not stop_active:
-                stop_active  = True
-                stop_start_i = i
-                stop_low_dur = 0.0
-                move_after_stop_dur = 0.0
-            stop_low_dur += dt
-        else:
-            # вышли из режима "стоп"
-            if stop_active:
-                if stop_low_dur < min_stop_duration_sec:
-                    # короткая остановка — сбрасываем немедленно при любом движении > min_stop_speed
-                    stop_active = False
-                    stop_start_i = None
-                    stop_low_dur = 0.0
-                    move_after_stop_dur = 0.0
-
-                    # Если это уже «подтверждаемое» движение — начнём накапливать (на случай,
-                    # если далее встретится длинная остановка и её нужно будет закрыть).
-                    if is_move_confirm:
-                        move_after_stop_dur += dt
-                else:
-                    # остановка была длинной — ждём подтверждающее движение
-                    if is_move_confirm:
-                        move_after_stop_dur += dt
-                        if move_after_stop_dur >= min_move_duration_sec:
-                            last_confirmed = {
-                                'stop_start_i': stop_start_i,
-                                'confirm_i': i,
-                                'confirm_t': t,
-                            }
-                            logger.debug(
-                                f"{reg_id}: [CONFIRM] подтверждённая остановка: "
-                                f"start={tracks[stop_start_i]['gt']}, confirm@{t}, "
-                                f"stop_dur={stop_low_dur:.1f}, move_dur={move_after_stop_dur:.1f}"
-                            )
-                            # закрываем серию и обнуляем
-                            stop_active = False
-                            stop_start_i = None
-                            stop_low_dur = 0.0
-                            move_after_stop_dur = 0.0
-                    else:
-                        # движение недостаточно быстрое — сбрасываем накопление движения
-                        move_after_stop_dur = 0.0
-
-        prev_t = t
+    # Серии «стопа» в окне слева направо:
+    # - Короткая серия (< min_stop_duration_sec), как только встретилось движение (v > min_stop_speed) — СБРАСЫВАЕТСЯ.
+    # - Длинная серия (>= min_stop_duration_sec) «подтверждается», если после неё было ПРОТЯЖЁННОЕ движение
+    #   (v >= min_move_speed суммарно >= min_move_duration_sec). Нужна последняя подтверждённая.
+    # Автомат прогнан по всему треку один раз (SegmentIndex); окно лишь догоняет общий проход.
+    last_confirmed, active_long_start = index.last_confirmed_stop(left, right)
 
     # Если подтверждённой остановки нет — возможен фоллбек на активную длинную серию (если она есть)
     if not last_confirmed:
-        if stop_active and stop_low_dur >= min_stop_duration_sec:
-            start_gt = tracks[stop_start_i]["gt"]
+        if active_long_start is not None:
+            start_gt = gt[active_long_start]
             logger.debug(f"{reg_id}: [FALLBACK] возвращаем активную длинную остановку: {start_gt}")
             return start_gt
         logger.warning(f"{reg_id}: [ОСТАНОВКА НЕ НАЙДЕНА] подтверждений не нашли")
         return None
 
-    cand_start_i = last_confirmed['stop_start_i']
-    cand_start_gt = tracks[cand_start_i]['gt']
-    confirm_i = last_confirmed['confirm_i']
-    confirm_t = last_confirmed['confirm_t']
+    cand_start_i, confirm_i = last_confirmed
+    cand_start_gt = gt[cand_start_i]
+    confirm_t = int(times[confirm_i])
 
-    logger.debug(f"{reg_id}: [NEAREST] ближайшая подтверждённая остановка start={cand_start_gt}, confirm@{confirm_t}")
+    logger.debug(f"{reg_id}: [NEAREST] ближайшая подтверждённая остановка start={cand_start_gt}, confirm@{gt[confirm_i]}")
 
     # ---- ФАЗА 2: пост-окно после подтверждения
     # Если в течение post_window_sec после confirm_t было ЛЮБОЕ движение > min_stop_speed,
     # то ищем первую стабильную остановку после этого движения и возвращаем её начало.
-    window_end_t = confirm_t + datetime.timedelta(seconds=post_window_sec)
-
-    # Найти первое движение в пост-окне (v > min_stop_speed)
-    j_move = None
-    for j in range(confirm_i, right + 1):
-        if times[j] > window_end_t:
-            break
-        if spd(j) > min_stop_speed:
-            j_move = j
-            break
+    # Точка подтверждения сама является движением, так что первое движение в окне — она же.
+    window_end_t = confirm_t + post_window_sec
+    j_move = confirm_i if confirm_t <= window_end_t else None
 
     if j_move is None:
         logger.debug(f"{reg_id}: [WINDOW] движения в {post_window_sec}s не было — возвращаем {cand_start_gt}")
         return cand_start_gt
 
-    # После первого движения в окне ищем первую стабильную остановку (без ограничений по времени)
-    post_stop_active = False
-    post_stop_start_i = None
-    post_stop_low_dur = 0.0
-    prev_t = times[j_move]
-
-    for k in range(j_move + 1, right + 1):
-        t = times[k]
-        dt_raw = (t - prev_t).total_seconds()
-        dt     = min(max(dt_raw, 0.0), sample_gap_cap)
-        v = spd(k)
-
-        if v <= min_stop_speed:
-            if not post_stop_active:
-                post_stop_active  = True
-                post_stop_start_i = k
-                post_stop_low_dur = 0.0
-            post_stop_low_dur += dt
-
-            if post_stop_low_dur >= min_stop_duration_sec:
-                start_gt_new = tracks[post_stop_start_i]['gt']
-                logger.debug(
-                    f"{reg_id}: [SHIFT] движение в окне @ {times[j_move]} ⇒ "
-                    f"первая стабильная остановка после него: start={start_gt_new}"
-                )
-                return start_gt_new
-        else:
-            if post_stop_active:
-                # сброс, если не дотянули до стабильности
-                post_stop_active  = False
-                post_stop_start_i = None
-                post_stop_low_dur = 0.0
-
-        prev_t = t
+    # После первого движения в окне — первая стабильная остановка (без ограничений по времени)
+    post_stop_start_i = index.first_stable_stop_after(j_move, right)
+    if post_stop_start_i is not None:
+        start_gt_new = gt[post_stop_start_i]
+        logger.debug(
+            f"{reg_id}: [SHIFT] движение в окне @ {gt[j_move]} ⇒ "
+            f"первая стабильная остановка после него: start={start_gt_new}"
+        )
+        return start_gt_new
 
     # Если после движения в окне так и не нашли новую устойчивую остановку — оставляем исходную
     logger.debug(f"{reg_id}: [SHIFT] после движения в окне новая остановка не найдена — возвращаем {cand_start_gt}")
@@ -1228,28 +994,67 @@ def seconds_since_midnight(dt: datetime.datetime) -> int:
 
 
 def cms_data_get_decorator_async(
-    max_retries: int = 30,
-    delay: float = 1.0,
+    max_retries: int | None = None,
+    delay: float | None = None,
     return_json: bool = False,
     retry_results: tuple[int, ...] = (22, 24),   # «временные» коды
+    policy: "retry_policy.RetryPolicy | None" = None,
 ):
     """
     Универсальный декоратор для CMS-запросов.
     - Разбирает JSON, чтобы решить — ретраить или нет.
     - По умолчанию возвращает httpx.Response; если return_json=True — dict.
     - НЕ ретраит код 32 (offline) — отдаём наверх как есть.
+    - Повторы — по RetryPolicy ([Retry]): экспоненциальная пауза с джиттером, бюджет
+      повторов на процесс, дедлайн из retry_policy.deadline(); max_retries/delay
+      переопределяют число попыток и базовую паузу.
+    - Сессия истекла (SESSION_EXPIRED_CODES) — перелогин через общий менеджер сессий
+      и повтор с новым jsession (если у функции есть аргумент jsession).
     """
+    pol = policy or retry_policy.default_policy(max_retries, delay, retry_results)
 
     def decorator(func):
+        sig = inspect.signature(func)
+        takes_jsession = "jsession" in sig.parameters
+
+        def _with_jsession(args, kwargs, jsession):
+            bound = sig.bind_partial(*args, **kwargs)
+            bound.arguments["jsession"] = jsession
+            return bound.args, bound.kwargs
+
+        async def _call(args, kwargs):
+            left = retry_policy.remaining()
+            if left is None:
+                return await func(*args, **kwargs)
+            if left <= 0:
+                raise retry_policy.DeadlineExceeded(f"[CMS] {func.__name__}: дедлайн операции исчерпан")
+            try:
+                return await asyncio.wait_for(func(*args, **kwargs), timeout=left)
+            except asyncio.TimeoutError:
+                raise retry_policy.DeadlineExceeded(f"[CMS] {func.__name__}: дедлайн операции исчерпан")
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
             attempt = 0
             last_exc: Exception | None = None
-
-            while attempt < max_retries:
+            last_code = None
+            manager = cms_session.get_manager()
+            jsession = None
+            if takes_jsession:
+                jsession = sig.bind_partial(*args, **kwargs).arguments.get("jsession")
+                current = manager.resolve(jsession)
+                if current != jsession:
+                    # запрос пришёл с уже заменённой сессией
+                    jsession = current
+                    args, kwargs = _with_jsession(args, kwargs, jsession)
+
+            if pol.budget is not None:
+                pol.budget.on_request()
+            while attempt < pol.max_attempts:
                 attempt += 1
+                limits.begin_cms_call()
                 try:
-                    result = await func(*args, **kwargs)
+                    result = await _call(args, kwargs)
 
                     # Поддержим обе ветки: функция вернула Response или сразу dict
                     data = None
@@ -1260,42 +1065,72 @@ def cms_data_get_decorator_async(
                             data = result.json()
                         except Exception as je:
                             # кривой JSON — можно сделать ещё одну попытку
-                            logger.warning(f"[CMS] JSON parse failed on attempt {attempt}/{max_retries}: {je}")
+                            logger.warning(f"[CMS] JSON parse failed on attempt {attempt}/{pol.max_attempts}: {je}")
                             raise
                     elif isinstance(result, dict):
                         data = result
                     else:
                         # неизвестный тип — вернём как есть
                         return result
-
-                    # Если JSON получен — смотрим бизнес-код
-                    res_code = data.get("result")
-                    if res_code in retry_results:
-                        # временная ошибка → ждём и повторяем
-                        logger.warning(f"[CMS] result={res_code} → retry {attempt}/{max_retries} after {delay}s")
-                        await asyncio.sleep(delay)
-                        continue
-                    # 32 (offline) — не ретраим, отдаём как есть
-                    # остальные коды — считаем «ок» и возвращаем
-
-                    return data if return_json else result
-
                 except Exception as e:
                     last_exc = e
-                    if attempt >= max_retries:
+                    limits.report_cms_result(None, pol.retry_results, failed=True)
+                    if not pol.should_retry_exception(e):
+                        raise
+                    pause = pol.next_delay(attempt)
+                    if pause is None:
+                        break
+                    logger.warning(f"[CMS] attempt {attempt}/{pol.max_attempts} failed: {e}; retry after {pause:.1f}s")
+                    await asyncio.sleep(pause)
+                    continue
+
+                # Если JSON получен — смотрим бизнес-код
+                last_exc = None
+                res_code = data.get("result")
+                # обратная связь адаптивным лимитам, через которые прошёл запрос
+                limits.report_cms_result(res_code, pol.retry_results)
+                if takes_jsession and cms_session.is_expired_code(res_code) and attempt < pol.max_attempts:
+                    logger.info(f"[CMS] result={res_code}: сессия истекла, перелогиниваемся")
+                    jsession = await manager.refresh(stale=jsession)
+                    args, kwargs = _with_jsession(args, kwargs, jsession)
+                    continue
+                if pol.should_retry_result(res_code):
+                    # временная ошибка → ждём и повторяем
+                    last_code = res_code
+                    pause = pol.next_delay(attempt)
+                    if pause is None:
                         break
-                    logger.warning(f"[CMS] attempt {attempt}/{max_retries} failed: {e}; retry after {delay}s")
-                    await asyncio.sleep(delay)
+                    logger.warning(f"[CMS] result={res_code} → retry {attempt}/{pol.max_attempts} after {pause:.1f}s")
+                    await asyncio.sleep(pause)
+                    continue
+                # 32 (offline) — не ретраим, отдаём как есть
+                # остальные коды — считаем «ок» и возвращаем
+                return data if return_json else result
 
-            # все попытки исчерпаны
+            # все попытки исчерпаны (или их не разрешил бюджет/дедлайн)
             if last_exc:
                 raise last_exc
-            raise RuntimeError(f"[CMS] Failed after {max_retries} attempts without specific exception")
+            raise RuntimeError(f"[CMS] Failed after {attempt} attempts without specific exception "
+                               f"(last result={last_code})")
 
         return wrapper
     return decorator
 
 
+async def fetch_day_tracks(reg_id: str, date: str, jsession: str) -> list[dict]:
+    """Треки устройства за сутки date (YYYY-MM-DD); при включённом [Telemetry] — через дисковый кэш."""
+    # Ленивая зависимость, чтобы избежать циклического импорта
+    from qt_pvp.cms_interface import cms_api, telemetry_cache
+
+    start_time = f"{date} 00:00:00"
+    end_time = f"{date} 23:59:59"
+    cache = telemetry_cache.get_cache()
+    if cache is not None:
+        return await cache.get_tracks(jsession, reg_id, start_time, end_time)
+    pages = await cms_api.get_device_track_all_pages_async(jsession, reg_id, start_time, end_time)
+    return [t for page in pages for t in (page.get("tracks") or [])]
+
+
 async def find_stops_near_sites_by_date(
     reg_id: str,
     sites: list[dict],
@@ -1326,16 +1161,7 @@ async def find_stops_near_sites_by_date(
     min_stop_duration = int(min_stop_duration_sec if min_stop_duration_sec is not None
                             else settings.config.getint("Interests", "MIN_STOP_DURATION_SEC"))
 
-    prepared_sites: list[tuple[str, float, float]] = []
-    for idx, raw in enumerate(sites):
-        sid = raw.get("id") or raw.get("site_id") or f"site_{idx}"
-        try:
-            lat_site = float(raw["lat"])
-            lon_site = float(raw["lon"])
-        except Exception as e:
-            logger.warning(f"{reg_id}: [STOP SEARCH] Пропущена площадка {sid}: некорректные координаты ({e})")
-            continue
-        prepared_sites.append((sid, lat_site, lon_site))
+    prepared_sites = stop_search.prepare_sites(sites, reg_id)
 
     logger.info(
         f"{reg_id}: [STOP SEARCH] start date={date}, radius_m={radius_m}, "
@@ -1345,140 +1171,15 @@ async def find_stops_near_sites_by_date(
     if not prepared_sites:
         return []
 
-    start_time = f"{date} 00:00:00"
-    end_time = f"{date} 23:59:59"
-
-    # Ленивая зависимость, чтобы избежать циклического импорта
-    from qt_pvp.cms_interface import cms_api
-
     if jsession is None:
-        login_resp = await cms_api.login()
-        jsession = login_resp.json()["jsession"]
-
-    pages = await cms_api.get_device_track_all_pages_async(jsession, reg_id, start_time, end_time)
-    tracks_raw = [t for page in pages for t in (page.get("tracks") or [])]
-    logger.info(f"{reg_id}: [STOP SEARCH] tracks_raw={len(tracks_raw)} for {start_time} → {end_time}")
-
-    norm_tracks: list[dict] = []
-    for t in tracks_raw:
-        ts = t.get("gt")
-        geo = t.get("ps")
-        if not ts or not geo:
-            logger.debug(f"{reg_id}: [STOP SEARCH] skip track (missing ts/geo): {t}")
-            continue
-        try:
-            dt = datetime.datetime.strptime(ts, settings.TIME_FMT)
-        except Exception:
-            logger.debug(f"{reg_id}: [STOP SEARCH] skip track (bad ts): {t}")
-            continue
-        try:
-            lat, lon = geo_funcs._parse_latlon(geo)
-        except Exception:
-            logger.debug(f"{reg_id}: [STOP SEARCH] skip track (bad geo): {t}")
-            continue
-        try:
-            speed = float(t.get("sp") or 0)
-        except Exception:
-            speed = 0.0
-        norm_tracks.append({"dt": dt, "lat": lat, "lon": lon, "speed": speed})
-
-    norm_tracks.sort(key=lambda tr: tr["dt"])
-    logger.info(f"{reg_id}: [STOP SEARCH] norm_tracks={len(norm_tracks)} (after filtering)")
-
-    results = [
-        {"site_id": sid, "lat": lat_site, "lon": lon_site, "stops": []}
-        for sid, lat_site, lon_site in prepared_sites
-    ]
-    if not norm_tracks:
-        return results
-
-    states = {
-        sid: {"active": False, "start_dt": None, "last_dt": None, "last_point": None}
-        for sid, _, _ in prepared_sites
-    }
+        jsession = await cms_session.get_manager().get()
 
-    for tr in norm_tracks:
-        dt = tr["dt"]
-        lat = tr["lat"]
-        lon = tr["lon"]
-        speed = tr["speed"]
-
-        for sid, site_lat, site_lon in prepared_sites:
-            dist_m = geo_funcs._haversine_m(lat, lon, site_lat, site_lon)
-            near_site = dist_m <= radius_m
-            is_stopped = near_site and speed <= min_stop_speed
-            st = states[sid]
-
-            if is_stopped:
-                if not st["active"]:
-                    st["start_dt"] = dt
-                    st["active"] = True
-                st["last_dt"] = dt
-                st["last_point"] = (lat, lon)
-            else:
-                if st["active"]:
-                    st["active"] = False
-                    start_dt = st["start_dt"]
-                    end_dt = st["last_dt"] or dt
-                    last_point = st.get("last_point")
-                    if start_dt and end_dt:
-                        dur = (end_dt - start_dt).total_seconds()
-                        if dur >= min_stop_duration:
-                            for res in results:
-                                if res["site_id"] == sid:
-                                    dist_m = None
-                                    if last_point:
-                                        dist_m = geo_funcs._haversine_m(
-                                            last_point[0], last_point[1],
-                                            res["lat"], res["lon"]
-                                        )
-                                    res["stops"].append({
-                                        "start": start_dt.strftime(settings.TIME_FMT),
-                                        "end": end_dt.strftime(settings.TIME_FMT),
-                                        "duration_sec": dur,
-                                        "distance_m": dist_m,
-                                    })
-                                    break
-                    st["start_dt"] = None
-                    st["last_dt"] = None
-                    st["last_point"] = None
-
-    # Финализируем незакрытые остановки
-    for sid, _, _ in prepared_sites:
-        st = states[sid]
-        if st["active"] and st["start_dt"] and st["last_dt"]:
-            dur = (st["last_dt"] - st["start_dt"]).total_seconds()
-            if dur >= min_stop_duration:
-                for res in results:
-                    if res["site_id"] == sid:
-                        last_point = st.get("last_point")
-                        dist_m = None
-                        if last_point:
-                            dist_m = geo_funcs._haversine_m(
-                                last_point[0], last_point[1],
-                                res["lat"], res["lon"]
-                            )
-                        res["stops"].append({
-                            "start": st["start_dt"].strftime(settings.TIME_FMT),
-                            "end": st["last_dt"].strftime(settings.TIME_FMT),
-                            "duration_sec": dur,
-                            "distance_m": dist_m,
-                        })
-                        break
+    tracks_raw = await fetch_day_tracks(reg_id, date, jsession)
+    logger.info(f"{reg_id}: [STOP SEARCH] tracks_raw={len(tracks_raw)} for {date}")
 
-    # Оставляем по одной (самой близкой) остановке для каждой площадки
-    for res in results:
-        stops = res.get("stops") or []
-        if len(stops) <= 1:
-            continue
-        # None считаем как бесконечность, чтобы не выигрывала
-        def _key(s):
-            d = s.get("distance_m")
-            return float("inf") if d is None else d
-        best = min(stops, key=_key)
-        res["stops"] = [best]
-
-    return results
+    # разбор треков и поиск — CPU; сетка площадок и векторные расстояния, см. stop_search
+    return await asyncio.to_thread(
+        stop_search.find_stops, tracks_raw, prepared_sites, radius_m, min_stop_speed, min_stop_duration, reg_id)
 
 
 if __name__ == "__main__":
@@ -2,7 +2,11 @@
 from qt_pvp.data.settings import config
 from qt_pvp.logger import logger
 from typing import Dict
+import contextvars
+import collections
+import contextlib
 import asyncio
+import time
 
 def _safe_int(section: str, key: str, default: int) -> int:
     try:
@@ -15,6 +19,224 @@ def _safe_int(section: str, key: str, default: int) -> int:
         logger.warning(f"[{section}] {key}: ошибка чтения ({e}), fallback -> {default}")
         return default
 
+def _adaptive_enabled() -> bool:
+    return config.getboolean("Adaptive", "ENABLED", fallback=False)
+
+
+# --- Адаптивный лимит конкуренции ---------------------------------------------------
+
+# лимитеры, удерживаемые в текущем контексте (снаружи внутрь): им measure_cms_request
+# сообщает задержку самого HTTP-запроса
+_held: contextvars.ContextVar[tuple] = contextvars.ContextVar("_held", default=())
+# лимитеры, получившие замер в текущей попытке CMS-запроса: декоратор
+# cms_data_get_decorator_async сообщает им бизнес-код ответа (22/24 — «плохо»)
+_measured_in_call: contextvars.ContextVar[tuple] = contextvars.ContextVar("_measured_in_call", default=())
+
+
+class AdaptiveLimiter:
+    """
+    Замена BoundedSemaphore с лимитом, который подстраивается под CMS (AIMD):
+      - пока p95 задержки не выше baseline * p95_tolerance, доля ретраев (result 22/24,
+        исключения) не выше retry_rate_max и лимит реально упирается — +1 слот;
+      - как только задержка или ретраи деградируют — лимит * decrease_factor.
+    baseline — медленно «всплывающий» минимум p95: фоновое ускорение/замедление CMS
+    со временем становится новой нормой.
+    Используется так же, как семафор: `async with limiter: ...`; задержку сам лимитер
+    не меряет — её сообщает measure_cms_request вокруг HTTP-запроса.
+    """
+
+    def __init__(self, name: str, initial: int, min_limit: int = 1, max_limit: int | None = None,
+                 window: int = 50, p95_tolerance: float = 2.0, retry_rate_max: float = 0.05,
+                 decrease_factor: float = 0.7, baseline_drift: float = 0.02):
+        self.name = name
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit or initial))
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.window = max(5, int(window))
+        self.p95_tolerance = p95_tolerance
+        self.retry_rate_max = retry_rate_max
+        self.decrease_factor = decrease_factor
+        self.baseline_drift = baseline_drift
+        self.baseline: float | None = None
+        self._inflight = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._latencies: collections.deque[float] = collections.deque(maxlen=self.window)
+        self._outcomes: collections.deque[bool] = collections.deque(maxlen=self.window)  # True — ретрай/ошибка
+        self._since_adjust = 0
+        self._saturated = False
+        self._last_p95: float | None = None
+
+    # --- семафорная часть ------------------------------------------------------------
+
+    def _cap(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def locked(self) -> bool:
+        return self._inflight >= self._cap()
+
+    async def acquire(self) -> bool:
+        if self._inflight < self._cap() and not self._waiters:
+            self._inflight += 1
+            return True
+        self._saturated = True
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # слот уже выдали, но нас отменили — вернуть
+                self._inflight -= 1
+                self._wake()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+        return True
+
+    def release(self) -> None:
+        if self._inflight <= 0:
+            raise ValueError(f"AdaptiveLimiter {self.name} released too many times")
+        self._inflight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self._inflight < self._cap():
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._inflight += 1
+                fut.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        _held.set(_held.get() + (self,))
+        return None
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _held.set(tuple(lim for lim in _held.get() if lim is not self))
+        self.release()
+        return False
+
+    # --- обратная связь ---------------------------------------------------------------
+
+    def record(self, latency: float, failed: bool = False) -> None:
+        self._latencies.append(latency)
+        self._outcomes.append(failed)
+        self._since_adjust += 1
+        if self._since_adjust >= max(5, self.window // 5):
+            self._adjust()
+
+    def record_retry(self) -> None:
+        """Ответ CMS с временным кодом (22/24) — последний успешный замер на деле плохой."""
+        if self._outcomes:
+            self._outcomes[-1] = True
+        else:
+            self._outcomes.append(True)
+
+    def _p(self, q: float) -> float | None:
+        if not self._latencies:
+            return None
+        data = sorted(self._latencies)
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+    def retry_rate(self) -> float:
+        return (sum(self._outcomes) / len(self._outcomes)) if self._outcomes else 0.0
+
+    def _adjust(self) -> None:
+        self._since_adjust = 0
+        p95 = self._p(0.95)
+        self._last_p95 = p95
+        if p95 is None:
+            return
+        if self.baseline is None:
+            self.baseline = p95
+        else:
+            self.baseline = min(p95, self.baseline * (1.0 + self.baseline_drift))
+
+        old = self.limit
+        degraded = (p95 > self.baseline * self.p95_tolerance) or (self.retry_rate() > self.retry_rate_max)
+        if degraded:
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+            # следующее решение — только по замерам после снижения
+            self._latencies.clear()
+            self._outcomes.clear()
+        elif self._saturated:
+            self.limit = min(float(self.max_limit), self.limit + 1.0)
+        self._saturated = False
+        if int(old) != int(self.limit):
+            logger.info(f"[LIMITS] {self.name}: лимит {int(old)} -> {int(self.limit)} "
+                        f"(p95={p95:.2f}s, baseline={self.baseline:.2f}s, ретраи={self.retry_rate():.0%})")
+        self._wake()
+
+    def snapshot(self) -> dict:
+        p50 = self._p(0.5)
+        return {
+            "limit": self._cap(),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "inflight": self._inflight,
+            "waiting": len(self._waiters),
+            "p50_sec": round(p50, 3) if p50 is not None else None,
+            "p95_sec": round(self._last_p95, 3) if self._last_p95 is not None else None,
+            "baseline_p95_sec": round(self.baseline, 3) if self.baseline is not None else None,
+            "retry_rate": round(self.retry_rate(), 3),
+            "samples": len(self._latencies),
+        }
+
+
+def _make_adaptive(name: str, initial: int) -> AdaptiveLimiter:
+    mult = max(1.0, config.getfloat("Adaptive", "MAX_MULTIPLIER", fallback=4.0))
+    return AdaptiveLimiter(
+        name,
+        initial=initial,
+        min_limit=_safe_int("Adaptive", "MIN_LIMIT", 1),
+        max_limit=max(initial, int(initial * mult)),
+        window=_safe_int("Adaptive", "WINDOW", 50),
+        p95_tolerance=config.getfloat("Adaptive", "P95_TOLERANCE", fallback=2.0),
+        retry_rate_max=config.getfloat("Adaptive", "RETRY_RATE_MAX", fallback=0.05),
+        decrease_factor=config.getfloat("Adaptive", "DECREASE_FACTOR", fallback=0.7),
+    )
+
+
+def begin_cms_call() -> None:
+    """Начало попытки CMS-запроса (вызывает декоратор): сбросить список замеренных лимитеров."""
+    _measured_in_call.set(())
+
+
+def report_cms_result(res_code, retry_results: tuple = (22, 24), failed: bool = False) -> None:
+    """Сообщить лимитерам, через которые прошла попытка (см. measure_cms_request), код ответа CMS."""
+    if failed or res_code in retry_results:
+        for lim in _measured_in_call.get():
+            lim.record_retry()
+    _measured_in_call.set(())
+
+
+@contextlib.contextmanager
+def measure_cms_request():
+    """
+    Замер задержки одного HTTP-запроса к CMS (внутри самого вложенного лимитера).
+    Задержка уходит всем удерживаемым лимитерам: ожидание вложенных лимитеров и паузы
+    между ретраями в неё не попадают. Отменённый запрос не учитывается.
+    """
+    held = _held.get()
+    _measured_in_call.set(held)
+    started = time.monotonic()
+    try:
+        yield
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        latency = time.monotonic() - started
+        for lim in held:
+            lim.record(latency, failed=True)
+        raise
+    latency = time.monotonic() - started
+    for lim in held:
+        lim.record(latency)
+
+
 # ленивые синглтоны
 _global_cms_sem: asyncio.Semaphore | None = None
 _frame_sem: asyncio.Semaphore | None = None
@@ -28,14 +250,20 @@ def get_cms_global_sem() -> asyncio.Semaphore:
     global _global_cms_sem
     if _global_cms_sem is None:
         max_conc = _safe_int("Process", "MAX_CMS_CONCURRENT", 8)
-        _global_cms_sem = asyncio.BoundedSemaphore(max_conc)
+        if _adaptive_enabled():
+            _global_cms_sem = _make_adaptive("cms_global", max_conc)
+        else:
+            _global_cms_sem = asyncio.BoundedSemaphore(max_conc)
     return _global_cms_sem
 
 def get_device_sem(device_id: str) -> asyncio.Semaphore:
     sem = _device_sems.get(device_id)
     if sem is None:
         per_dev = _safe_int("Process", "MAX_CMS_PER_DEVICE", 2)
-        sem = asyncio.BoundedSemaphore(per_dev)
+        if _adaptive_enabled():
+            sem = _make_adaptive(f"device:{device_id}", per_dev)
+        else:
+            sem = asyncio.BoundedSemaphore(per_dev)
         _device_sems[device_id] = sem
     return sem
 
@@ -60,5 +288,26 @@ def _get_video_sem_for(dev_id: str) -> asyncio.Semaphore:
 def get_pages_sem() -> asyncio.Semaphore:
     global _pages_sem
     if _pages_sem is None:
-        _pages_sem = asyncio.BoundedSemaphore(_safe_int("Semafor", "tracks_page_request_max", 4))
+        max_pages = _safe_int("Semafor", "tracks_page_request_max", 4)
+        if _adaptive_enabled():
+            _pages_sem = _make_adaptive("pages", max_pages)
+        else:
+            _pages_sem = asyncio.BoundedSemaphore(max_pages)
     return _pages_sem
+
+
+def _sem_snapshot(sem) -> dict:
+    if isinstance(sem, AdaptiveLimiter):
+        return sem.snapshot()
+    # статический семафор: лимит не меняется, свободные слоты — _value
+    return {"limit": None, "free": getattr(sem, "_value", None)}
+
+
+def snapshot() -> dict:
+    """Текущие лимиты и замеры задержек (для /cms-limits и логов)."""
+    return {
+        "adaptive": _adaptive_enabled(),
+        "cms_global": _sem_snapshot(_global_cms_sem) if _global_cms_sem is not None else None,
+        "pages": _sem_snapshot(_pages_sem) if _pages_sem is not None else None,
+        "devices": {dev: _sem_snapshot(sem) for dev, sem in sorted(_device_sems.items())},
+    }
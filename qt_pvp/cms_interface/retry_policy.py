@@ -0,0 +1,178 @@
+"""
+Политика повторов CMS-запросов.
+
+Раньше cms_data_get_decorator_async повторял запрос до 30 раз с паузой ровно 1 с:
+при сбое CMS все корутины ретраили синхронно и держали слоты семафоров. Здесь:
+  - экспоненциальная пауза с полным джиттером: sleep = U(0, min(max_delay, base * 2^(n-1)));
+  - классификация: какие HTTP-статусы, коды result и исключения вообще стоит повторять;
+  - дедлайн операции в contextvar: `with deadline(60): ...` ограничивает всё, что
+    вызвано внутри (включая созданные задачи), вложенный дедлайн не может быть позже внешнего;
+  - бюджет повторов (token bucket): каждый первичный запрос кладёт BUDGET_RATIO токена,
+    каждый повтор забирает один — повторов не больше заданной доли трафика.
+"""
+from qt_pvp.data.settings import config
+from qt_pvp.logger import logger
+import contextvars
+import contextlib
+import threading
+import asyncio
+import random
+import httpx
+import time
+
+
+class DeadlineExceeded(TimeoutError):
+    """Бюджет времени операции исчерпан — дальнейшие повторы бессмысленны."""
+    pass
+
+
+# --- дедлайн операции ------------------------------------------------------------------
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("cms_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float | None):
+    """
+    Ограничить время всех CMS-вызовов внутри блока. None/0 — без ограничения
+    (внешний дедлайн, если есть, продолжает действовать).
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+    new = time.monotonic() + float(seconds)
+    outer = _deadline.get()
+    token = _deadline.set(new if outer is None else min(outer, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """Сколько секунд осталось до дедлайна (None — дедлайна нет)."""
+    dl = _deadline.get()
+    if dl is None:
+        return None
+    return max(0.0, dl - time.monotonic())
+
+
+# --- бюджет повторов -------------------------------------------------------------------
+
+class RetryBudget:
+    """
+    Token bucket повторов: первичный запрос кладёт `ratio` токена, повтор забирает один.
+    `per_sec` — небольшое пополнение по времени, чтобы при редком трафике повторы
+    совсем не пропадали.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 10.0, max_tokens: float | None = None,
+                 per_sec: float = 0.0, clock=time.monotonic):
+        self.ratio = max(0.0, float(ratio))
+        self.min_tokens = max(0.0, float(min_tokens))
+        self.max_tokens = float(max_tokens) if max_tokens else max(self.min_tokens, 100.0)
+        self.per_sec = max(0.0, float(per_sec))
+        self.clock = clock
+        self._tokens = self.min_tokens
+        self._refilled_at = clock()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.denied = 0
+
+    def on_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_retry(self) -> bool:
+        with self._lock:
+            if self.per_sec:
+                now = self.clock()
+                self._tokens = min(self.max_tokens, self._tokens + (now - self._refilled_at) * self.per_sec)
+                self._refilled_at = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self.retries += 1
+                return True
+            self.denied += 1
+            return False
+
+    def snapshot(self) -> dict:
+        return {"tokens": round(self._tokens, 2), "requests": self.requests,
+                "retries": self.retries, "denied": self.denied}
+
+
+# --- политика --------------------------------------------------------------------------
+
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 8, base_delay: float = 0.5, max_delay: float = 15.0,
+                 retry_results: tuple = (22, 24), retry_statuses: tuple = RETRY_STATUSES,
+                 budget: RetryBudget | None = None):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = max(self.base_delay, float(max_delay))
+        self.retry_results = tuple(retry_results)
+        self.retry_statuses = tuple(retry_statuses)
+        self.budget = budget
+
+    def backoff(self, attempt: int) -> float:
+        """Пауза перед повтором после attempt-й попытки (full jitter)."""
+        cap = min(self.max_delay, self.base_delay * (2 ** max(0, attempt - 1)))
+        return random.uniform(0.0, cap)
+
+    def should_retry_result(self, res_code) -> bool:
+        return res_code in self.retry_results
+
+    def should_retry_exception(self, exc: BaseException) -> bool:
+        if isinstance(exc, (asyncio.CancelledError, DeadlineExceeded)):
+            return False
+        if isinstance(exc, httpx.HTTPStatusError):
+            return exc.response.status_code in self.retry_statuses
+        # таймауты, сетевые ошибки, кривой JSON — временные
+        return True
+
+    def next_delay(self, attempt: int) -> float | None:
+        """
+        Пауза перед следующей попыткой или None, если попытки кончились или бюджет
+        повторов исчерпан. Если пауза не влезает в дедлайн — DeadlineExceeded.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        left = remaining()
+        if left is not None and left <= delay:
+            raise DeadlineExceeded(f"[CMS] до дедлайна {left:.1f}s — повтор не успеет")
+        if self.budget is not None and not self.budget.try_retry():
+            logger.warning("[CMS] Бюджет повторов исчерпан — повтор пропущен")
+            return None
+        return delay
+
+
+_budget: RetryBudget | None = None
+
+
+def get_budget() -> RetryBudget:
+    """Общий на процесс бюджет повторов CMS."""
+    global _budget
+    if _budget is None:
+        _budget = RetryBudget(
+            ratio=config.getfloat("Retry", "BUDGET_RATIO", fallback=0.2),
+            min_tokens=config.getfloat("Retry", "BUDGET_MIN_TOKENS", fallback=10.0),
+            per_sec=config.getfloat("Retry", "BUDGET_REFILL_PER_SEC", fallback=0.5),
+        )
+    return _budget
+
+
+def default_policy(max_attempts: int | None = None, base_delay: float | None = None,
+                   retry_results: tuple = (22, 24)) -> RetryPolicy:
+    return RetryPolicy(
+        max_attempts=max_attempts or config.getint("Retry", "MAX_ATTEMPTS", fallback=8),
+        base_delay=base_delay if base_delay is not None else config.getfloat("Retry", "BASE_DELAY_SEC", fallback=0.5),
+        max_delay=config.getfloat("Retry", "MAX_DELAY_SEC", fallback=15.0),
+        retry_results=retry_results,
+        budget=get_budget(),
+    )
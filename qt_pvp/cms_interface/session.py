@@ -0,0 +1,113 @@
+"""
+Общая на процесс сессия CMS (jsession).
+
+Раньше Main.login сохранял jsession навсегда, а API логинился на каждый HTTP-запрос.
+Здесь:
+  - логин один на процесс, одновременные логины склеиваются (single-flight);
+  - cms_data_get_decorator_async, увидев ответ «сессия истекла» ([CMS] SESSION_EXPIRED_CODES),
+    вызывает refresh(stale) и повторяет запрос с новым jsession;
+  - запросы, пришедшие со старым (уже заменённым) jsession, подменяются на текущий
+    без лишнего похода в CMS;
+  - если задан [CMS] SESSION_MAX_AGE_SEC, сессия обновляется в фоне заранее —
+    запросы продолжают идти со старой, пока новая не готова.
+"""
+from qt_pvp.data.settings import config
+from qt_pvp.logger import logger
+import asyncio
+import time
+
+
+_expired_codes_cache: tuple | None = None
+
+
+def _expired_codes() -> tuple:
+    global _expired_codes_cache
+    if _expired_codes_cache is None:
+        raw = config.get("CMS", "SESSION_EXPIRED_CODES", fallback="5")
+        _expired_codes_cache = tuple(int(p) for p in raw.split(",") if p.strip().lstrip("-").isdigit())
+    return _expired_codes_cache
+
+
+def _log_background_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"[CMS] Фоновое обновление сессии не удалось: {task.exception()}")
+
+
+class CMSSessionManager:
+    def __init__(self, max_age: float = 0.0):
+        self.max_age = float(max_age or 0.0)
+        self._jsession: str | None = None
+        self._obtained_at = 0.0
+        self._retired: set[str] = set()
+        self._login_task: asyncio.Task | None = None
+
+    @property
+    def jsession(self) -> str | None:
+        return self._jsession
+
+    def set_jsession(self, jsession: str | None) -> None:
+        if self._jsession and jsession != self._jsession:
+            self._retired.add(self._jsession)
+        self._jsession = jsession
+        self._obtained_at = time.monotonic()
+
+    async def _login(self) -> str:
+        from qt_pvp.cms_interface import cms_api
+        response = await cms_api.login()
+        jsession = response.json()["jsession"]
+        self.set_jsession(jsession)
+        logger.info("[CMS] Получена новая сессия CMS")
+        return jsession
+
+    def _start_login(self) -> asyncio.Task:
+        task = self._login_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self._login())
+            self._login_task = task
+        return task
+
+    async def get(self) -> str:
+        """Текущий jsession; логинится, если сессии ещё нет."""
+        if self._jsession is None:
+            return await asyncio.shield(self._start_login())
+        if self.max_age and time.monotonic() - self._obtained_at > self.max_age:
+            # заранее обновляем в фоне, текущий запрос идёт со старой сессией
+            self._start_login().add_done_callback(_log_background_failure)
+        return self._jsession
+
+    async def refresh(self, stale: str | None = None) -> str:
+        """
+        Перелогиниться, потому что `stale` отвергнут CMS. Если сессию уже заменили
+        (другой запрос успел перелогиниться) — просто вернуть текущую.
+        """
+        if self._jsession is not None and stale is not None and stale != self._jsession:
+            return self._jsession
+        if self._jsession is not None and self._jsession == stale:
+            self._retired.add(stale)
+        return await asyncio.shield(self._start_login())
+
+    def resolve(self, jsession: str | None) -> str | None:
+        """Подменить уже заменённый jsession на текущий (без похода в CMS)."""
+        if jsession is not None and jsession in self._retired and self._jsession:
+            return self._jsession
+        return jsession
+
+
+_manager: CMSSessionManager | None = None
+
+
+def get_manager() -> CMSSessionManager:
+    global _manager
+    if _manager is None:
+        _manager = CMSSessionManager(max_age=config.getfloat("CMS", "SESSION_MAX_AGE_SEC", fallback=0.0))
+    return _manager
+
+
+def set_manager(manager: CMSSessionManager | None) -> None:
+    """Подменить менеджер сессий (тесты)."""
+    global _manager
+    _manager = manager
+
+
+def is_expired_code(res_code) -> bool:
+    return res_code in _expired_codes()
@@ -0,0 +1,389 @@
+"""
+Дисковый кэш телеметрии CMS (треки и сырые алармы) с индексом по времени.
+
+Одно и то же окно запрашивается из CMS многократно: прямой проход, recheck
+(VERIFIED_RECHECK_HOURS), суточный recheck, ручки /get-interests и /compare-interests.
+Кэш хранит по каждому устройству:
+  - tracks   — точки трека (ts = время gt в секундах),
+  - alarms   — сырые алармы (по ключу дедупа, с интервалом [start_ts, end_ts]),
+  - coverage — уже загруженные интервалы [start, end] (включительно, в секундах) с
+               временем загрузки fetched_at и lag = fetched_at - end: насколько данные
+               были старыми, когда их скачали,
+и на запрос [a, b] догружает из CMS только непокрытые куски.
+
+Данные старше SETTLE_HORIZON_SEC считаются устоявшимися (регистратор их уже не
+досылает). Хвост окна моложе горизонта всегда берётся из CMS, но тоже пишется в кэш —
+как неустоявшийся (lag < горизонта). Обычные запросы читают любое покрытие; recheck'и
+(refresh=True) перекачивают только куски, закэшированные до того, как они устоялись, —
+скачанное уже устоявшимся отдаётся из кэша и им. Покрытие ставится только до последней
+полученной точки (или до конца куска, если точка ближе TAIL_SLACK_SEC к нему): пустой
+ответ или ответ, оборвавшийся раньше конца куска, не закрывает остаток — его
+перезапросят, когда CMS дошлёт данные.
+
+Время — локальное «наивное» время CMS ("%Y-%m-%d %H:%M:%S"), в базе — целые секунды
+от 1970-01-01 без учёта часового пояса.
+"""
+from qt_pvp.cms_interface.functions import _parse_alarm_time
+from qt_pvp.cms_interface import cms_api
+from qt_pvp.logger import logger
+from qt_pvp.data import settings
+from typing import Awaitable, Callable
+import contextlib
+import threading
+import datetime
+import asyncio
+import sqlite3
+import json
+import time
+import os
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+# последняя точка не дальше стольких секунд от конца куска — кусок получен целиком
+TAIL_SLACK_SEC = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    reg_id  TEXT NOT NULL,
+    ts      INTEGER NOT NULL,
+    ord     INTEGER NOT NULL,
+    data    TEXT NOT NULL,
+    PRIMARY KEY (reg_id, ts, ord)
+);
+CREATE TABLE IF NOT EXISTS alarms (
+    reg_id    TEXT NOT NULL,
+    kind      TEXT NOT NULL,
+    akey      TEXT NOT NULL,
+    start_ts  INTEGER NOT NULL,
+    end_ts    INTEGER NOT NULL,
+    data      TEXT NOT NULL,
+    PRIMARY KEY (reg_id, kind, akey)
+);
+CREATE INDEX IF NOT EXISTS idx_alarms_range ON alarms(reg_id, kind, start_ts);
+CREATE TABLE IF NOT EXISTS coverage (
+    reg_id      TEXT NOT NULL,
+    kind        TEXT NOT NULL,
+    start       INTEGER NOT NULL,
+    "end"       INTEGER NOT NULL,
+    fetched_at  INTEGER,
+    lag         INTEGER,
+    PRIMARY KEY (reg_id, kind, start)
+);
+"""
+
+
+def to_key(value: str | datetime.datetime) -> int:
+    """Время CMS -> целые секунды (наивные, без часового пояса)."""
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value, settings.TIME_FMT)
+    return int((value - _EPOCH).total_seconds())
+
+
+def from_key(key: int) -> str:
+    return (_EPOCH + datetime.timedelta(seconds=key)).strftime(settings.TIME_FMT)
+
+
+def find_gaps(covered: list[tuple[int, int]], a: int, b: int) -> list[tuple[int, int]]:
+    """
+    Непокрытые куски [a, b] при отсортированном покрытии covered (интервалы включительно).
+    """
+    gaps = []
+    cur = a
+    for s, e in covered:
+        if e < cur:
+            continue
+        if s > b:
+            break
+        if s > cur:
+            gaps.append((cur, s - 1))
+        cur = max(cur, e + 1)
+        if cur > b:
+            break
+    if cur <= b:
+        gaps.append((cur, b))
+    return gaps
+
+
+def covered_until(b: int, last: int | None) -> int | None:
+    """До какого времени кусок, заканчивающийся в b, считать загруженным (None — никак)."""
+    if last is None:
+        return None
+    return b if last >= b - TAIL_SLACK_SEC else last
+
+
+def _alarm_key(a: dict) -> str:
+    # тот же ключ дедупа, что и в cms_api.flatten_alarms_pages
+    guid = a.get("guid")
+    if guid:
+        return str(guid)
+    return json.dumps([a.get("atp"), a.get("stm"), a.get("etm"), a.get("chn") or a.get("channel") or 0])
+
+
+def _alarm_span(a: dict) -> tuple[int, int] | None:
+    start_dt, _ = _parse_alarm_time(a, "stm", "bTimeStr")
+    if start_dt is None:
+        return None
+    end_dt, _ = _parse_alarm_time(a, "etm", "eTimeStr")
+    s = to_key(start_dt)
+    e = to_key(end_dt) if end_dt is not None else s
+    return s, max(s, e)
+
+
+class TelemetryCache:
+    def __init__(self, db_path: str, settle_horizon_sec: int = 3600,
+                 retention_days: int = 14, max_gaps: int = 4):
+        self.db_path = db_path
+        self.settle_horizon_sec = int(settle_horizon_sec)
+        self.retention_days = int(retention_days)
+        self.max_gaps = max(1, int(max_gaps))
+        self._local = threading.local()
+        self._range_locks: dict[tuple, asyncio.Lock] = {}
+        self._last_purge = 0.0
+        self.stats = {"requests": 0, "cms_fetches": 0, "cached_seconds": 0, "fetched_seconds": 0}
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        # покрытие из кэша прошлой версии: без времени загрузки — считается неустоявшимся
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(coverage)")}
+        for column in ("fetched_at", "lag"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE coverage ADD COLUMN {column} INTEGER")
+
+    # --- SQLite ----------------------------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _coverage(self, reg_id: str, kind: str, a: int, b: int,
+                  settled_only: bool = False) -> list[tuple[int, int]]:
+        """Покрытие [a, b]; settled_only — только куски, скачанные уже устоявшимися."""
+        min_lag = self.settle_horizon_sec if settled_only else None
+        return self._conn().execute(
+            'SELECT start, "end" FROM coverage WHERE reg_id=? AND kind=? AND "end">=? AND start<=? '
+            'AND (? IS NULL OR COALESCE(lag, -1) >= ?) ORDER BY start',
+            (reg_id, kind, a, b, min_lag, min_lag)).fetchall()
+
+    def _add_coverage(self, conn, reg_id: str, kind: str, a: int, b: int, fetched_at: int) -> None:
+        """
+        Покрытие [a, b], скачанное в fetched_at. Сливается с соседями того же статуса
+        (устоявшееся / нет); соседи другого статуса обрезаются по [a, b] — там теперь наши данные.
+        """
+        lag = fetched_at - b
+        settled = lag >= self.settle_horizon_sec
+        rows = conn.execute(
+            'SELECT start, "end", fetched_at, COALESCE(lag, -1) FROM coverage '
+            'WHERE reg_id=? AND kind=? AND "end">=? AND start<=?',
+            (reg_id, kind, a - 1, b + 1)).fetchall()
+        conn.execute('DELETE FROM coverage WHERE reg_id=? AND kind=? AND "end">=? AND start<=?',
+                     (reg_id, kind, a - 1, b + 1))
+        keep = []
+        for s, e, row_fetched, row_lag in rows:
+            if (row_lag >= self.settle_horizon_sec) == settled:
+                a, b, lag = min(a, s), max(b, e), min(lag, row_lag)
+                fetched_at = max(fetched_at, row_fetched or 0)
+                continue
+            if s < a:
+                keep.append((s, a - 1, row_fetched, row_lag))
+            if e > b:
+                keep.append((b + 1, e, row_fetched, row_lag))
+        conn.executemany(
+            'INSERT INTO coverage(reg_id, kind, start, "end", fetched_at, lag) VALUES (?, ?, ?, ?, ?, ?)',
+            [(reg_id, kind, a, b, fetched_at, lag)] + [(reg_id, kind) + row for row in keep])
+
+    def _store_tracks(self, reg_id: str, a: int, b: int, tracks: list[dict]) -> None:
+        """Точки [a, b]; покрытие — от a до последней полученной точки (covered_until)."""
+        rows, skipped = [], 0
+        for ordinal, t in enumerate(tracks):
+            try:
+                ts = to_key(t["gt"])
+            except Exception:
+                skipped += 1
+                continue
+            if a <= ts <= b:
+                rows.append((reg_id, ts, ordinal, json.dumps(t, ensure_ascii=False)))
+        with self._tx() as conn:
+            conn.execute("DELETE FROM tracks WHERE reg_id=? AND ts BETWEEN ? AND ?", (reg_id, a, b))
+            conn.executemany("INSERT OR REPLACE INTO tracks(reg_id, ts, ord, data) VALUES (?, ?, ?, ?)", rows)
+            until = covered_until(b, max((r[1] for r in rows), default=None))
+            if until is not None:
+                self._add_coverage(conn, reg_id, "tracks", a, until, to_key(datetime.datetime.now()))
+        if skipped:
+            logger.warning(f"{reg_id}: [TELEMETRY] Точек трека без валидного gt: {skipped}")
+
+    def _read_tracks(self, reg_id: str, a: int, b: int) -> list[dict]:
+        rows = self._conn().execute(
+            "SELECT data FROM tracks WHERE reg_id=? AND ts BETWEEN ? AND ? ORDER BY ts, ord",
+            (reg_id, a, b)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def _store_alarms(self, reg_id: str, kind: str, a: int, b: int, alarms: list[dict]) -> None:
+        """Алармы куска [a, b]; покрытие — от a до начала последнего полученного аларма (covered_until)."""
+        rows = []
+        for al in alarms:
+            span = _alarm_span(al)
+            if span is None:
+                continue
+            rows.append((reg_id, kind, _alarm_key(al), span[0], span[1], json.dumps(al, ensure_ascii=False)))
+        with self._tx() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO alarms(reg_id, kind, akey, start_ts, end_ts, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            until = covered_until(b, max((r[3] for r in rows if a <= r[3] <= b), default=None))
+            if until is not None:
+                self._add_coverage(conn, reg_id, kind, a, until, to_key(datetime.datetime.now()))
+
+    def _read_alarms(self, reg_id: str, kind: str, a: int, b: int) -> list[dict]:
+        rows = self._conn().execute(
+            "SELECT data FROM alarms WHERE reg_id=? AND kind=? AND start_ts<=? AND end_ts>=? "
+            "ORDER BY start_ts, end_ts", (reg_id, kind, b, a)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def purge_old(self) -> None:
+        """Удалить всё старше RETENTION_DAYS (раз в час, не чаще)."""
+        now = time.monotonic()
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        border = to_key(datetime.datetime.now() - datetime.timedelta(days=self.retention_days))
+        with self._tx() as conn:
+            conn.execute("DELETE FROM tracks WHERE ts < ?", (border,))
+            conn.execute("DELETE FROM alarms WHERE end_ts < ?", (border,))
+            conn.execute('DELETE FROM coverage WHERE "end" < ?', (border,))
+            conn.execute('UPDATE coverage SET start=? WHERE start < ?', (border, border))
+
+    # --- общий алгоритм ----------------------------------------------------------------
+
+    def _range_lock(self, reg_id: str, kind: str) -> asyncio.Lock:
+        key = (reg_id, kind)
+        lock = self._range_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._range_locks[key] = lock
+        return lock
+
+    async def _get(self, reg_id: str, kind: str, start_time: str, end_time: str,
+                   fetch: Callable[[str, str], Awaitable[list[dict]]],
+                   store: Callable[[int, int, list[dict]], None],
+                   read: Callable[[int, int], list[dict]],
+                   refresh: bool = False) -> tuple[list[dict], list[dict]]:
+        """
+        Возвращает (данные из устоявшейся части окна, свежий хвост окна из CMS).
+        refresh (recheck) — покрытие, скачанное до того, как данные устоялись, не считается:
+        такие куски перекачиваются, остальное отдаётся из кэша.
+        """
+        self.stats["requests"] += 1
+        a, b = to_key(start_time), to_key(end_time)
+        horizon = to_key(datetime.datetime.now()) - self.settle_horizon_sec
+        stable_end = min(b, horizon)
+
+        cached: list[dict] = []
+        if a <= stable_end:
+            # один догрузчик на (устройство, вид данных), чтобы параллельные запросы
+            # одного окна не тянули одни и те же куски
+            async with self._range_lock(reg_id, kind):
+                covered = await asyncio.to_thread(self._coverage, reg_id, kind, a, stable_end, refresh)
+                gaps = find_gaps(covered, a, stable_end)
+                if len(gaps) > self.max_gaps:
+                    gaps = [(gaps[0][0], gaps[-1][1])]
+                for g1, g2 in gaps:
+                    data = await fetch(from_key(g1), from_key(g2))
+                    self.stats["cms_fetches"] += 1
+                    self.stats["fetched_seconds"] += g2 - g1 + 1
+                    await asyncio.to_thread(store, g1, g2, data)
+                self.stats["cached_seconds"] += (stable_end - a + 1) - sum(g2 - g1 + 1 for g1, g2 in gaps)
+                if gaps:
+                    logger.debug(f"{reg_id}: [TELEMETRY] {kind}: догружено кусков {len(gaps)} "
+                                 f"в окне {from_key(a)} → {from_key(stable_end)}")
+                cached = await asyncio.to_thread(read, a, stable_end)
+            await asyncio.to_thread(self.purge_old)
+
+        fresh: list[dict] = []
+        if b > stable_end:
+            fresh_start = max(a, stable_end + 1)
+            fresh = await fetch(from_key(fresh_start), from_key(b))
+            self.stats["cms_fetches"] += 1
+            # в кэш — неустоявшимся: recheck его перекачает, обычные запросы прочитают
+            await asyncio.to_thread(store, fresh_start, b, fresh)
+        return cached, fresh
+
+    # --- публичные методы --------------------------------------------------------------
+
+    async def get_tracks(self, jsession: str, reg_id: str, start_time: str, end_time: str,
+                         refresh: bool = False) -> list[dict]:
+        """Плоский список точек трека за [start_time, end_time] в порядке времени."""
+        async def _fetch(s: str, e: str) -> list[dict]:
+            pages = await cms_api.get_device_track_all_pages_async(jsession, reg_id, s, e)
+            return [t for page in pages for t in (page.get("tracks") or [])]
+
+        cached, fresh = await self._get(
+            reg_id, "tracks", start_time, end_time, _fetch,
+            store=lambda a, b, data: self._store_tracks(reg_id, a, b, data),
+            read=lambda a, b: self._read_tracks(reg_id, a, b),
+            refresh=refresh,
+        )
+        return cached + fresh
+
+    async def get_alarms(self, jsession: str, reg_id: str, begin_time: str, end_time: str,
+                         arm_types: str = "19,20,69,70", refresh: bool = False) -> list[dict]:
+        """Сырые алармы за [begin_time, end_time] (без дублей, по времени начала)."""
+        kind = f"alarms:{arm_types}"
+
+        async def _fetch(s: str, e: str) -> list[dict]:
+            pages = await cms_api.get_device_alarm_all_pages_async(jsession, reg_id, s, e, arm_types)
+            return cms_api.flatten_alarms_pages(pages)
+
+        cached, fresh = await self._get(
+            reg_id, kind, begin_time, end_time, _fetch,
+            store=lambda a, b, data: self._store_alarms(reg_id, kind, a, b, data),
+            read=lambda a, b: self._read_alarms(reg_id, kind, a, b),
+            refresh=refresh,
+        )
+        return cms_api.flatten_alarms_pages([{"alarms": cached + fresh}])
+
+
+_cache: TelemetryCache | None = None
+_cache_resolved = False
+
+
+def get_cache() -> TelemetryCache | None:
+    """Глобальный кэш; None — кэш выключен ([Telemetry] ENABLED = false)."""
+    global _cache, _cache_resolved
+    if not _cache_resolved:
+        if settings.config.getboolean("Telemetry", "ENABLED", fallback=False):
+            path = settings.config.get("Telemetry", "DB_PATH", fallback="telemetry.sqlite3")
+            if not os.path.isabs(path):
+                path = os.path.join(settings.DATA_FOLDER, path)
+            _cache = TelemetryCache(
+                path,
+                settle_horizon_sec=settings.config.getint("Telemetry", "SETTLE_HORIZON_SEC", fallback=3600),
+                retention_days=settings.config.getint("Telemetry", "RETENTION_DAYS", fallback=14),
+                max_gaps=settings.config.getint("Telemetry", "MAX_GAPS_PER_REQUEST", fallback=4),
+            )
+        _cache_resolved = True
+    return _cache
+
+
+def set_cache(cache: TelemetryCache | None) -> None:
+    """Подменить глобальный кэш (тесты); None — выключить."""
+    global _cache, _cache_resolved
+    _cache = cache
+    _cache_resolved = True
@@ -23,6 +23,7 @@ LOGS_DIR = os.path.join(CUR_DIR, "logs")
 CONFIG_PATH = os.path.join(DATA_FOLDER, "config.cfg")
 CLOUD_PATH = posixpath.join("/Tracker", "Видео выгрузок")
 states = os.sep.join((DATA_FOLDER, "states.json"))
+PENDING_JOURNAL_FOLDER = os.path.join(DATA_FOLDER, "pending")
 
 config = configparser.ConfigParser(
     inline_comment_prefixes='#',
@@ -96,19 +96,20 @@ class FileLock:
 
 # --- Safe load/save of states -----------------------------------------------------
 
-def _load_states() -> dict:
+def _load_states(path: str | None = None) -> dict:
     """
     Безопасная загрузка JSON-состояний.
     Если файл отсутствует — вернём минимальную структуру.
+    path — альтернативный файл (по умолчанию STATES_PATH).
     """
     try:
-        with open(STATES_PATH, "r", encoding="utf-8") as f:
+        with open(path or STATES_PATH, "r", encoding="utf-8") as f:
             return json.load(f)
     except FileNotFoundError:
         return {"regs": {}}
     except json.JSONDecodeError as e:
         # Коррупт. Логируем и пробуем не дать упасть — отдаём пустую структуру.
-        logger.error("states.json is corrupted: %s", e)
+        logger.error("%s is corrupted: %s", os.path.basename(path or STATES_PATH), e)
         return {"regs": {}}
 
 
@@ -142,15 +143,17 @@ def _sanitize_for_json(obj):
     return obj
 
 
-def _atomic_save_states(states: dict) -> None:
+def _atomic_save_states(states: dict, path: str | None = None) -> None:
     """
     Атомарная запись JSON:
       1) приводим к сериализуемому виду (без datetime)
       2) пишем во временный файл в той же директории
       3) fsync
       4) os.replace -> атомарная подмена целевого файла
+    path — альтернативный файл (по умолчанию STATES_PATH).
     """
-    dir_ = os.path.dirname(STATES_PATH) or "."
+    path = path or STATES_PATH
+    dir_ = os.path.dirname(path) or "."
     os.makedirs(dir_, exist_ok=True)
 
     safe_states = _sanitize_for_json(states)
@@ -161,7 +164,7 @@ def _atomic_save_states(states: dict) -> None:
             json.dump(safe_states, tmp, indent=4, ensure_ascii=False)
             tmp.flush()
             os.fsync(tmp.fileno())
-        os.replace(tmp_path, STATES_PATH)
+        os.replace(tmp_path, path)
     finally:
         # если replace не сработал — подчистим tmp
         try:
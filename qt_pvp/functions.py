@@ -1,6 +1,7 @@
 from qt_pvp.logger import logger
 from qt_pvp.data import settings
-from qt_pvp.filelocker import FileLock, _load_states, _atomic_save_states, LOCK_PATH
+from qt_pvp import state_store
+from qt_pvp import pending_journal
 from typing import Iterable, Iterator, Tuple, Dict, Any, Optional
 from typing import List
 import subprocess
@@ -8,7 +9,6 @@ import datetime
 import zipfile
 import ffmpeg
 import shutil
-import json
 import uuid
 import time
 import os
@@ -193,21 +193,29 @@ def convert_video_file(input_video_path: str, output_dir: str = None,
     return output_video_path
 
 
+def _ensure_reg_fields(reg: dict) -> bool:
+    """Дополняет одну запись регистратора недостающими полями. True — что-то поменяли."""
+    changed = False
+    if "euro_container_alarm" not in reg:
+        reg["euro_container_alarm"] = 4
+        changed = True
+    if "verified_until_long" not in reg:
+        vt = reg.get("verified_until")
+        if vt:
+            reg["verified_until_long"] = vt
+        else:
+            last_upload = datetime.datetime.today() - datetime.timedelta(days=7)
+            reg["verified_until_long"] = last_upload.strftime("%Y-%m-%d %H:%M:%S")
+        changed = True
+    return changed
+
+
 def _ensure_alarms_fields(regs: dict, reg_id: str = None) -> bool:
     changed = False
     target_ids = [reg_id] if reg_id else list(regs.keys())
     for rid in target_ids:
         reg = regs.get(rid) or {}
-        if "euro_container_alarm" not in reg:
-            reg["euro_container_alarm"] = 4
-            changed = True
-        if "verified_until_long" not in reg:
-            vt = reg.get("verified_until")
-            if vt:
-                reg["verified_until_long"] = vt
-            else:
-                last_upload = datetime.datetime.today() - datetime.timedelta(days=7)
-                reg["verified_until_long"] = last_upload.strftime("%Y-%m-%d %H:%M:%S")
+        if _ensure_reg_fields(reg):
             changed = True
         regs[rid] = reg
     return changed
@@ -228,38 +236,45 @@ def ensure_alarms_structure_inplace(regs: dict, reg_id: str | None = None) -> bo
         return _ensure_alarms_fields(regs, reg_id)
 
 
+def _update_reg(reg_id: str, mutator=None, plate=None) -> dict:
+    """
+    Атомарное изменение одного регистратора через хранилище состояний.
+    mutator(reg) -> bool правит запись in-place; запись сохраняется, только если
+    она создана, дополнена недостающими полями или mutator вернул True.
+    Возвращает копию итогового состояния.
+    """
+    def _apply(reg: dict, created: bool) -> bool:
+        changed = _ensure_reg_fields(reg) or created
+        if mutator is not None and mutator(reg):
+            changed = True
+        return changed
+
+    return state_store.get_store().update_reg(
+        reg_id, _apply, factory=lambda: _default_new_reg_info(plate=plate))
+
+
 def save_new_interests(reg_id, interests):
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        if reg_id not in regs:
-            regs[reg_id] = _default_new_reg_info()
-        ensure_alarms_structure_inplace(regs, reg_id)
-        regs[reg_id]["interests"] = interests  # <-- тут был баг: раньше писалось в "states"
-        _atomic_save_states(states)
+    def _set(reg):
+        reg["interests"] = interests
+        return True
+    _update_reg(reg_id, _set)
 
 def _get_processed_set(reg_id: str) -> set[str]:
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        reg = states.setdefault("regs", {}).setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(states["regs"], reg_id)
-        processed = reg.get("processed_interests", [])
-        return set(processed)
+    reg = _update_reg(reg_id)
+    return set(reg.get("processed_interests", []))
 
 def _save_processed(reg_id: str, name: str, keep_last: int = 1000):
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
+    def _add(reg):
         arr = reg.get("processed_interests", [])
-        if name not in arr:
-            arr.append(name)
-            # ограничим размер кольцевым буфером
-            if len(arr) > keep_last:
-                arr = arr[-keep_last:]
-            reg["processed_interests"] = arr
-        _atomic_save_states(states)
+        if name in arr:
+            return False
+        arr.append(name)
+        # ограничим размер кольцевым буфером
+        if len(arr) > keep_last:
+            arr = arr[-keep_last:]
+        reg["processed_interests"] = arr
+        return True
+    _update_reg(reg_id, _add)
 
 def filter_already_processed(reg_id: str, interests: list[dict]) -> list[dict]:
     done = _get_processed_set(reg_id)
@@ -273,83 +288,69 @@ def filter_already_processed(reg_id: str, interests: list[dict]) -> list[dict]:
     return out
 
 def clean_interests(reg_id):
-    with FileLock(LOCK_PATH):
-        logger.debug("Cleaning interests in states.json")
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        if reg_id not in regs:
-            regs[reg_id] = _default_new_reg_info()
-        ensure_alarms_structure_inplace(regs, reg_id)
-        regs[reg_id]["interests"] = []
-        _atomic_save_states(states)
+    logger.debug("Cleaning interests in state store")
+    def _clean(reg):
+        reg["interests"] = []
+        return True
+    _update_reg(reg_id, _clean)
 
 
 
 def get_reg_info(reg_id: str):
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        created = False
-        if reg_id not in regs:
-            regs[reg_id] = _default_new_reg_info()
-            created = True
-        changed = ensure_alarms_structure_inplace(regs, reg_id) or created
-        if changed:
-            _atomic_save_states(states)
-        return json.loads(json.dumps(regs[reg_id]))
+    return _update_reg(reg_id)
 
 
 
 def create_new_reg(reg_id, plate):
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        if reg_id in regs:
-            return json.loads(json.dumps(regs[reg_id]))
-        regs[reg_id] = _default_new_reg_info(plate=plate)
-        # ensure — только in-place
-        ensure_alarms_structure_inplace(regs, reg_id)
-        _atomic_save_states(states)
-        return json.loads(json.dumps(regs[reg_id]))
+    return _update_reg(reg_id, plate=plate)
 
 
-def save_reg_verified_until(reg_id: str, timestamp: str):
+def _advance_reg_time_field(reg_id: str, field: str, timestamp: str, allow_equal: bool) -> None:
     """
-    Обновляет поле verified_until у регистратора.
-    Логика похожа на last_upload_time:
-      - парсим timestamp;
-      - не даём откатываться назад.
+    Двигает временную метку регистратора (last_upload_time / verified_until / ...)
+    только вперёд. allow_equal — разрешать ли запись того же самого времени.
     """
     try:
         new_dt = datetime.datetime.strptime(timestamp, settings.TIME_FMT)
     except Exception:
-        logger.warning(f"{reg_id}. Некорректный формат verified_until: {timestamp} — игнор.")
+        logger.warning(f"{reg_id}. Некорректный формат {field}: {timestamp} — игнор.")
         return
 
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
+    result = {}
 
-        cur_str = reg.get("verified_until")
+    def _advance(reg):
+        cur_str = reg.get(field)
+        result["cur"] = cur_str
         cur_dt = None
         if cur_str:
             try:
                 cur_dt = datetime.datetime.strptime(cur_str, settings.TIME_FMT)
             except Exception:
                 pass
+        if cur_dt is None or new_dt > cur_dt or (allow_equal and new_dt == cur_dt):
+            reg[field] = timestamp
+            result["updated"] = True
+            return True
+        return False
+
+    _update_reg(reg_id, _advance)
+    if result.get("updated"):
+        logger.info(f"{reg_id}. Обновлен `{field}`: {timestamp}")
+    else:
+        sign = "<" if allow_equal else "<="
+        logger.debug(f"{reg_id}. Пропуск обновления {field} "
+                     f"(новое {timestamp} {sign} текущее {result.get('cur')}).")
 
-        # Разрешаем только вперёд (или на то же самое время)
-        if cur_dt is None or new_dt >= cur_dt:
-            reg["verified_until"] = timestamp
-            _atomic_save_states(states)
-            logger.info(f"{reg_id}. Обновлен `verified_until`: {timestamp}")
-        else:
-            logger.debug(
-                f"{reg_id}. Пропуск обновления verified_until "
-                f"(новое {timestamp} < текущее {cur_str})."
-            )
+
+def save_reg_verified_until(reg_id: str, timestamp: str):
+    """
+    Обновляет поле verified_until у регистратора.
+    Логика похожа на last_upload_time:
+      - парсим timestamp;
+      - не даём откатываться назад.
+    """
+    # Разрешаем только вперёд (или на то же самое время)
+    _advance_reg_time_field(reg_id, "verified_until", timestamp, allow_equal=True)
 
 
 def save_reg_verified_until_long(reg_id: str, timestamp: str):
@@ -357,64 +358,11 @@ def save_reg_verified_until_long(reg_id: str, timestamp: str):
     Независимый маркер длинного recheck. Позволяем ему идти вперёд независимо от
     verified_until, чтобы окна короткой/длинной проверок не блокировали друг друга.
     """
-    try:
-        new_dt = datetime.datetime.strptime(timestamp, settings.TIME_FMT)
-    except Exception:
-        logger.warning(f"{reg_id}. Некорректный формат verified_until_long: {timestamp} — игнор.")
-        return
-
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
-
-        cur_str = reg.get("verified_until_long")
-        cur_dt = None
-        if cur_str:
-            try:
-                cur_dt = datetime.datetime.strptime(cur_str, settings.TIME_FMT)
-            except Exception:
-                pass
-
-        if cur_dt is None or new_dt >= cur_dt:
-            reg["verified_until_long"] = timestamp
-            _atomic_save_states(states)
-            logger.info(f"{reg_id}. Обновлен `verified_until_long`: {timestamp}")
-        else:
-            logger.debug(
-                f"{reg_id}. Пропуск обновления verified_until_long "
-                f"(новое {timestamp} < текущее {cur_str})."
-            )
+    _advance_reg_time_field(reg_id, "verified_until_long", timestamp, allow_equal=True)
 
 
 def save_new_reg_last_upload_time(reg_id: str, timestamp: str):
-    try:
-        new_dt = datetime.datetime.strptime(timestamp, settings.TIME_FMT)
-    except Exception:
-        logger.warning(f"{reg_id}. Некорректный формат last_upload_time: {timestamp} — игнор.")
-        return
-
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
-
-        cur_str = reg.get("last_upload_time")
-        cur_dt = None
-        if cur_str:
-            try:
-                cur_dt = datetime.datetime.strptime(cur_str, settings.TIME_FMT)
-            except Exception:
-                pass
-
-        if cur_dt is None or new_dt > cur_dt:
-            reg["last_upload_time"] = timestamp
-            _atomic_save_states(states)
-            logger.info(f"{reg_id}. Обновлен `last_upload_time`: {timestamp}")
-        else:
-            logger.debug(f"{reg_id}. Пропуск обновления last_upload_time (новое {timestamp} <= текущее {cur_str}).")
+    _advance_reg_time_field(reg_id, "last_upload_time", timestamp, allow_equal=False)
 
 
 def _interest_name_to_interval(name: str) -> tuple[str, datetime.datetime, datetime.datetime]:
@@ -602,118 +550,73 @@ def build_interest_name(plate: str, date_str: str, start_str: str, end_str: str,
     return name
 
 def merge_overlapping_interests(interests: List[dict]) -> List[dict]:
-    if not interests:
-        return []
-    # Сортируем по началу
-    sorted_interests = sorted(interests, key=lambda x: x['beg_sec'])
-    merged = []
-
-    current = sorted_interests[0].copy()
-    for next_interest in sorted_interests[1:]:
-        # Пересекаются, если начало следующего раньше конца текущего
-        if next_interest['beg_sec'] <= current['end_sec']:
-            logger.info(
-                f"{current['reg_id']}: Обнаружение пересечение интересов {current['name']} и {next_interest['name']}. "
-                f"Объединение...")
-            # Объединяем интервалы
-            current['beg_sec'] = min(current['beg_sec'], next_interest['beg_sec'])
-            current['end_sec'] = max(current['end_sec'], next_interest['end_sec'])
-
-            # Объединяем временные метки
-            current['start_time'] = min(current['start_time'], next_interest['start_time'])
-            current['end_time'] = max(current['end_time'], next_interest['end_time'])
-            current['photo_before_timestamp'] = min(
-                current.get('photo_before_timestamp', current['start_time']),
-                next_interest.get('photo_before_timestamp', next_interest['start_time'])
-            )
-            current['photo_after_timestamp'] = max(
-                current.get('photo_after_timestamp', current['end_time']),
-                next_interest.get('photo_after_timestamp', next_interest['end_time'])
-            )
-
-            # Объединяем фото в секундах
-            current['photo_before_sec'] = min(current.get('photo_before_sec', current['beg_sec']),
-                                              next_interest.get('photo_before_sec', next_interest['beg_sec']))
-            current['photo_after_sec'] = max(current.get('photo_after_sec', current['end_sec']),
-                                             next_interest.get('photo_after_sec', next_interest['end_sec']))
-
-            # Объединяем события переключателей
-            if 'report' in current and 'report' in next_interest:
-                current_switches = current['report'].get('switch_events', [])
-                next_switches = next_interest['report'].get('switch_events', [])
-                merged_switches = current_switches + next_switches
-                merged_switches.sort(key=lambda x: x['datetime'])
-                current['report']['switch_events'] = merged_switches
-                current['report']['switches_amount'] = len(merged_switches)
-
-            # Меняем имя интереса
-            plate, date, start, _ = parse_interest_name(current['name'])
-            _, _, _, end = parse_interest_name(next_interest['name'])
-            new_name = build_interest_name(plate, date, start, end)
-            current['name'] = new_name
-
-            logger.info(f"{current['reg_id']}: Объединенный интерес - {current['name']}")
-        else:
-            merged.append(current)
-            current = next_interest.copy()
-
-    merged.append(current)
-    return merged
+    """Оставлено для совместимости: слияние живёт в interest_merge_funcs."""
+    # interest_merge_funcs импортирует этот модуль, поэтому импорт — здесь
+    from qt_pvp.interest_merge_funcs import merge_overlapping_interests as _merge
+    return _merge(interests)
 
 def get_pending_interests(reg_id: str) -> list[dict]:
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-
-        reg = regs.get(reg_id)
-        if reg is None:
-            # Жёсткая ситуация: в файле нет такого регистратора.
-            # Мы не создаём дефолт (чтобы не потерять данные молча),
-            # а возвращаем пустой список. Логируем warning.
-            logger.warning(f"{reg_id}: get_pending_interests -> регистратор не найден в states.json")
-            return []
-
-        ensure_alarms_structure_inplace(regs, reg_id)
-        return list(reg.get("pending_interests", []))
+    journal = pending_journal.get_journal()
+    if journal is not None:
+        return journal.get_pending(reg_id)
+    pending = state_store.get_store().get_pending(reg_id)
+    if pending is None:
+        # Жёсткая ситуация: в хранилище нет такого регистратора.
+        # Мы не создаём дефолт (чтобы не потерять данные молча),
+        # а возвращаем пустой список. Логируем warning.
+        logger.warning(f"{reg_id}: get_pending_interests -> регистратор не найден в хранилище состояний")
+        return []
+    return pending
 
 
 def set_pending_interests(reg_id: str, interests: list[dict]) -> None:
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
-        reg["pending_interests"] = list(interests)
-        _atomic_save_states(states)
+    journal = pending_journal.get_journal()
+    if journal is not None:
+        journal.set(reg_id, list(interests))
+        return
+    state_store.get_store().set_pending(
+        reg_id, list(interests), factory=_default_new_reg_info)
 
 def append_pending_interests(reg_id: str, interests: list[dict]) -> None:
     if not interests:
         return
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
-        cur = reg.get("pending_interests", [])
-        # дедуп по имени интереса
-        seen = {it.get("name") for it in cur if isinstance(it, dict)}
-        for it in interests:
-            nm = (it or {}).get("name")
-            if nm and nm not in seen:
-                cur.append(it)
-                seen.add(nm)
-        reg["pending_interests"] = cur
-        _atomic_save_states(states)
+    # дедуп по имени интереса — на стороне хранилища/журнала
+    journal = pending_journal.get_journal()
+    if journal is not None:
+        journal.append(reg_id, interests)
+        return
+    state_store.get_store().append_pending(
+        reg_id, interests, factory=_default_new_reg_info)
 
 def remove_pending_interest(reg_id: str, interest_name: str) -> None:
-    with FileLock(LOCK_PATH):
-        states = _load_states()
-        regs = states.setdefault("regs", {})
-        reg = regs.setdefault(reg_id, _default_new_reg_info())
-        ensure_alarms_structure_inplace(regs, reg_id)
-        cur = reg.get("pending_interests", [])
-        reg["pending_interests"] = [it for it in cur if it.get("name") != interest_name]
-        _atomic_save_states(states)
+    journal = pending_journal.get_journal()
+    if journal is not None:
+        journal.complete(reg_id, interest_name)
+        return
+    state_store.get_store().remove_pending(
+        reg_id, interest_name, factory=_default_new_reg_info)
+
+def claim_pending_interest(reg_id: str, interest_name: str) -> bool:
+    """
+    Пометить интерес взятым в работу. Имеет смысл только для журнала
+    ([State] PENDING_QUEUE = journal); для хранилища состояний — no-op (True).
+    """
+    journal = pending_journal.get_journal()
+    if journal is None:
+        return True
+    return journal.claim(reg_id, interest_name)
+
+def fail_pending_interest(reg_id: str, interest_name: str, error: str | None = None) -> None:
+    """Обработка интереса упала — вернуть его в очередь (журнал считает попытки)."""
+    journal = pending_journal.get_journal()
+    if journal is not None:
+        journal.fail(reg_id, interest_name, error)
+
+def release_pending_interest(reg_id: str, interest_name: str) -> None:
+    """Снять claim без попытки (интерес не начинали обрабатывать)."""
+    journal = pending_journal.get_journal()
+    if journal is not None:
+        journal.release(reg_id, interest_name)
 
 
 
@@ -1,7 +1,13 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from qt_pvp.logger import logger
 from qt_pvp.data import settings
+import numpy as np
+import threading
 import math
 import json
+import os
+
+EARTH_RADIUS_M = 6_371_008.8  # средний радиус Земли, м
 
 
 def _parse_latlon(s: str) -> tuple[float, float]:
@@ -17,7 +23,7 @@ def _parse_latlon(s: str) -> tuple[float, float]:
 
 def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Расстояние между точками (в метрах) по формуле хаверсина."""
-    R = 6_371_008.8  # средний радиус Земли, м
+    R = EARTH_RADIUS_M
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlmb = math.radians(lon2 - lon1)
@@ -54,10 +60,97 @@ def find_nearby_name(
 
 
 def get_ignore_points(ignore_file_path=settings.IGNORE_POINTS_JSON):
-    return json.load(open(ignore_file_path, encoding="utf-8"))["ignore_points"]
+    with open(ignore_file_path, encoding="utf-8") as f:
+        return json.load(f)["ignore_points"]
+
+
+class IgnoreZoneIndex:
+    """
+    Точки игнора (ДЕПО, МПЗ) с разобранными координатами и сеткой-индексом.
+
+    Раньше каждая проверка интереса заново разбирала строки 'lat,lon' всех точек и
+    считала хаверсин до каждой. Здесь координаты разобраны один раз, точки разложены
+    по ячейкам сетки cell_deg × cell_deg градусов; запрос радиуса берёт только ячейки,
+    которые задевает круг, и уточняет кандидатов векторным хаверсином.
+    Ответ совпадает с find_nearby_name: ближайшая точка в пределах радиуса, при равенстве —
+    первая по списку.
+    """
+
+    def __init__(self, items: List[Dict[str, str]], cell_deg: float = 0.01,
+                 name_key: str = "name", geo_key: str = "geo"):
+        names, coords = [], []
+        for item in items:
+            try:
+                coords.append(_parse_latlon(item[geo_key]))
+                names.append(item[name_key])
+            except (KeyError, ValueError) as e:
+                logger.warning(f"[IGNORE] Пропускаем точку игнора {item!r}: {e}")
+        self.names = names
+        self.cell_deg = cell_deg
+        self._lon_cells = int(round(360.0 / cell_deg))
+        latlon = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        self.lat = np.radians(latlon[:, 0])
+        self.lon = np.radians(latlon[:, 1])
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+        for k, (lat, lon) in enumerate(coords):
+            self._cells.setdefault(self._cell(lat, lon), []).append(k)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg) % self._lon_cells
+
+    def _candidates(self, lat: float, lon: float, radius_m: float) -> np.ndarray:
+        """Индексы точек из ячеек, которые задевает круг радиуса radius_m вокруг (lat, lon)."""
+        r_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+        cos_lat = math.cos(math.radians(min(89.0, abs(lat) + r_lat)))
+        r_lon = r_lat / cos_lat
+        d_lat = math.ceil(r_lat / self.cell_deg)
+        d_lon = math.ceil(r_lon / self.cell_deg)
+        if (2 * d_lat + 1) * (2 * d_lon + 1) >= len(self._cells):
+            # круг шире сетки — дешевле проверить все точки
+            return np.arange(len(self.names))
+        c_lat, c_lon = self._cell(lat, lon)
+        found: List[int] = []
+        for i in range(c_lat - d_lat, c_lat + d_lat + 1):
+            for j in range(c_lon - d_lon, c_lon + d_lon + 1):
+                found.extend(self._cells.get((i, j % self._lon_cells), ()))
+        return np.array(sorted(found), dtype=np.int64)
+
+    def nearest_name(self, reference_geo: str, tolerance_m: float) -> Optional[str]:
+        """Имя ближайшей точки игнора в пределах tolerance_m от 'lat,lon' или None."""
+        if not self.names or tolerance_m <= 0:
+            return None
+        lat, lon = _parse_latlon(reference_geo)
+        idx = self._candidates(lat, lon, tolerance_m)
+        if not len(idx):
+            return None
+        phi1, lmb1 = math.radians(lat), math.radians(lon)
+        phi2, lmb2 = self.lat[idx], self.lon[idx]
+        a = np.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin((lmb2 - lmb1) / 2) ** 2
+        dist = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        best = int(np.argmin(dist))
+        return self.names[idx[best]] if dist[best] <= tolerance_m else None
+
+
+_ignore_lock = threading.Lock()
+_ignore_index: Optional[IgnoreZoneIndex] = None
+_ignore_key: Optional[Tuple[str, float]] = None
+
+
+def get_ignore_index(ignore_file_path=settings.IGNORE_POINTS_JSON) -> IgnoreZoneIndex:
+    """IgnoreZoneIndex по ignore_points.json; файл перечитывается, только если изменилось его mtime."""
+    global _ignore_index, _ignore_key
+    key = (ignore_file_path, os.path.getmtime(ignore_file_path))
+    with _ignore_lock:
+        if _ignore_index is None or key != _ignore_key:
+            _ignore_index = IgnoreZoneIndex(get_ignore_points(ignore_file_path))
+            _ignore_key = key
+        return _ignore_index
 
 
 
 if __name__ == "__main__":
-    res = find_nearby_name("53.656833,55.959151",get_ignore_points(), 50)
+    res = get_ignore_index().nearest_name("53.656833,55.959151", 50)
     print(res)
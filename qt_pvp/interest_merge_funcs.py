@@ -1,6 +1,8 @@
-from typing import List, Optional
+from typing import Iterable, List, Optional, Tuple
 from qt_pvp import functions as main_funcs
+from qt_pvp.data import settings
 import datetime
+import bisect
 import logging
 
 logger = logging.getLogger(__name__)
@@ -130,6 +132,10 @@ def _merge_two(cur: dict, nxt: dict) -> None:
     cur["_start_dt"] = min(cur["_start_dt"], nxt["_start_dt"])
     cur["_end_dt"] = max(cur["_end_dt"], nxt["_end_dt"])
 
+    # имена исходных интересов (для очереди pending)
+    if "_sources" in cur or "_sources" in nxt:
+        cur["_sources"] = cur.get("_sources", []) + nxt.get("_sources", [])
+
     # фото-границы
     pb_candidates = [cur.get("_pb_dt"), nxt.get("_pb_dt")]
     pb_candidates = [x for x in pb_candidates if x is not None]
@@ -211,17 +217,94 @@ def _finalize_interest(cur: dict) -> None:
         cur["name"] = f"{plate}_{date_str} {start_str}-{end_str}"
 
     # чистим техполя
-    for k in ("_start_dt", "_end_dt", "_pb_dt", "_pa_dt"):
+    for k in ("_start_dt", "_end_dt", "_pb_dt", "_pa_dt", "_sources"):
         cur.pop(k, None)
 
 
+class InterestIntervalSet:
+    """
+    Интересы одного регистратора, упорядоченные по началу (_start_dt) и слитые при вставке.
+
+    Раньше очередь интересов каждый раз склеивалась заново: вся пачка нормализовалась,
+    сортировалась и проходилась целиком — после каждого дня прямого прохода и ещё раз
+    перед выгрузкой. Здесь хранятся уже слитые интервалы (соседние не пересекаются и не
+    соприкасаются с допуском eps), поэтому:
+      - add() ищет место бинарным поиском и сливает интерес только с соседями;
+      - oldest(n) и between(start, end) отдают интересы без пересортировки.
+    switch_events сливаются вместе с интервалами (_merge_two), как и имена исходных
+    интересов — слитый интерес получает новое имя, а в очереди pending лежат исходные
+    (oldest_with_sources).
+    """
+
+    def __init__(self, interests: Iterable[dict] = (), eps: Optional[float] = None):
+        if eps is None:
+            eps = settings.config.getfloat("Interests", "CLIP_EPS_SEC", fallback=CLIP_EPS_SEC)
+        self._eps = datetime.timedelta(seconds=eps)
+        self._starts: List[datetime.datetime] = []  # ключи: _start_dt слитых интервалов
+        self._items: List[dict] = []                # нормализованные интервалы в том же порядке
+        self.update(interests)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _touch(self, a: dict, b: dict) -> bool:
+        """a начинается не позже b: b начинается до конца a (с допуском eps)."""
+        return b["_start_dt"] <= a["_end_dt"] + self._eps
+
+    def add(self, interest: dict) -> None:
+        item = _normalize_interest(interest)
+        item["_sources"] = [interest["name"]] if interest.get("name") else []
+        i = bisect.bisect_right(self._starts, item["_start_dt"])
+        if i and self._touch(self._items[i - 1], item):
+            i -= 1
+            cur = self._items[i]
+            _merge_two(cur, item)
+        else:
+            cur = item
+            self._starts.insert(i, cur["_start_dt"])
+            self._items.insert(i, cur)
+        # расширенный интервал может дотянуться до следующих
+        while i + 1 < len(self._items) and self._touch(cur, self._items[i + 1]):
+            _merge_two(cur, self._items.pop(i + 1))
+            del self._starts[i + 1]
+        self._starts[i] = cur["_start_dt"]
+
+    def update(self, interests: Iterable[dict]) -> None:
+        # по началу: тогда каждая вставка идёт в хвост и порядок слияния — как у прохода по списку
+        for interest in sorted(interests, key=lambda x: _get_start_dt(x)):
+            self.add(interest)
+
+    @staticmethod
+    def _export(item: dict) -> dict:
+        out = dict(item)
+        _finalize_interest(out)
+        return out
+
+    def oldest(self, n: int) -> List[dict]:
+        """n самых ранних интересов."""
+        return [self._export(it) for it in self._items[:max(n, 0)]]
+
+    def oldest_with_sources(self, n: int) -> List[Tuple[dict, List[str]]]:
+        """n самых ранних интересов и имена исходных интересов, из которых каждый слит."""
+        return [(self._export(it), list(it["_sources"])) for it in self._items[:max(n, 0)]]
+
+    def between(self, start: datetime.datetime, end: datetime.datetime) -> List[dict]:
+        """Интересы, пересекающиеся с [start, end]."""
+        hi = bisect.bisect_right(self._starts, end)
+        # интервалы не пересекаются, так что концы тоже возрастают
+        lo = bisect.bisect_left(self._items, start, hi=hi, key=lambda it: it["_end_dt"])
+        return [self._export(it) for it in self._items[lo:hi]]
+
+    def to_list(self) -> List[dict]:
+        return [self._export(it) for it in self._items]
+
+
 def merge_overlapping_interests(interests: List[dict]) -> List[dict]:
     """
     Простое и предсказуемое объединение интересов:
     - приводим все времена к datetime;
-    - сортируем по началу;
-    - последовательно склеиваем все пересекающиеся или соприкасающиеся (<= CLIP_EPS_SEC) интервалы
-      внутри одного reg_id;
+    - внутри одного reg_id склеиваем все пересекающиеся или соприкасающиеся (<= CLIP_EPS_SEC)
+      интервалы (InterestIntervalSet);
     - объединяем switch_events, пересчитываем switches_amount;
     - пересобираем start_time/end_time, photo_* и name.
 
@@ -231,22 +314,11 @@ def merge_overlapping_interests(interests: List[dict]) -> List[dict]:
     if not interests:
         return []
 
-    # нормализуем и сортируем по времени начала
-    norm = [_normalize_interest(i) for i in interests]
-    norm.sort(key=lambda x: (x.get("reg_id"), x["_start_dt"], float(x["beg_sec"])))
+    by_reg: dict = {}
+    for interest in interests:
+        by_reg.setdefault(interest.get("reg_id"), []).append(interest)
 
     merged: List[dict] = []
-    cur = norm[0]
-
-    for nxt in norm[1:]:
-        same_reg = cur.get("reg_id") == nxt.get("reg_id")
-        if same_reg and _intervals_touch_or_overlap(cur, nxt):
-            _merge_two(cur, nxt)
-        else:
-            _finalize_interest(cur)
-            merged.append(cur)
-            cur = nxt
-
-    _finalize_interest(cur)
-    merged.append(cur)
+    for reg_id in sorted(by_reg, key=lambda r: "" if r is None else str(r)):
+        merged.extend(InterestIntervalSet(by_reg[reg_id]).to_list())
     return merged
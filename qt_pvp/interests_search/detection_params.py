@@ -0,0 +1,128 @@
+"""
+Параметры детектора интересов одним неизменяемым снимком.
+
+Детектор раньше читал пороги через settings.config.getint(...) прямо в циклах по трекам
+и на каждом вызове брал настройки регистратора через get_reg_info (чтение states.json
+под блокировкой). DetectionParams собирается один раз на проход: [Interests] из
+config.cfg плюс переопределения регистратора (номера тревожных входов и сдвиги),
+и передаётся в детектор явно.
+
+current() держит снимок конфига и перечитывает config.cfg, если изменилось его mtime, —
+правка порогов подхватывается без перезапуска. Файл разбирается в отдельный
+ConfigParser: глобальный settings.config из рабочих потоков не трогаем.
+"""
+from dataclasses import dataclass, replace
+from qt_pvp.logger import logger
+from qt_pvp.data import settings
+from typing import Any, Dict, Optional
+import configparser
+import threading
+import os
+
+
+@dataclass(frozen=True)
+class DetectionParams:
+    min_stop_speed: int                  # MIN_STOP_SPEED
+    min_stop_duration: int               # MIN_STOP_DURATION_SEC
+    min_move_speed: int                  # MIN_MOVE_SPEED
+    min_move_duration: int               # MIN_MOVE_DURATION_SEC
+    min_speed_for_switch_detect: int     # MIN_SPEED_FOR_SWITCH_DETECT
+    gap_threshold: int                   # GAP_THRESHOLD_SEC
+    sample_gap_cap: int                  # SAMPLE_GAP_CAP_SEC
+    max_lookback_seconds: int            # MAX_LOOKBACK_SECONDS
+    post_confirm_window: int             # POST_CONFIRM_MOVE_WINDOW_SEC
+    max_wait_sec: int                    # MAX_WAIT_TIME_MINUTES, в секундах
+    photo_after_shift: int               # PHOTO_AFTER_SHIFT_SEC
+    euro_before_shift: int               # INTEREST_EURO_BEFORE_SHIFT_SEC
+    kgo_before_shift: int                # INTEREST_KGO_BEFORE_SHIFT_SEC
+    ignore_tolerance: int                # IGNORE_POINTS_TOLERANCE
+    move_small_gap: int                  # INTERESTS_MOVE_SMALL_GAP_SEC
+    move_max_gap: int                    # INTERESTS_MOVE_MAX_GAP_SEC
+    move_a_kmhps: float                  # INTERESTS_MOVE_A_KMHPS
+    euro_alarm: int = 4                  # тревожный вход концевика контейнера
+    kgo_alarm: Optional[int] = None      # тревожный вход концевика бункера (КГО)
+
+    @classmethod
+    def from_config(cls, cfg) -> "DetectionParams":
+        min_stop_duration = cfg.getint("Interests", "MIN_STOP_DURATION_SEC")
+        return cls(
+            min_stop_speed=cfg.getint("Interests", "MIN_STOP_SPEED"),
+            min_stop_duration=min_stop_duration,
+            min_move_speed=cfg.getint("Interests", "MIN_MOVE_SPEED"),
+            min_move_duration=cfg.getint("Interests", "MIN_MOVE_DURATION_SEC", fallback=min_stop_duration),
+            min_speed_for_switch_detect=cfg.getint("Interests", "MIN_SPEED_FOR_SWITCH_DETECT"),
+            gap_threshold=cfg.getint("Interests", "GAP_THRESHOLD_SEC", fallback=10),
+            sample_gap_cap=cfg.getint("Interests", "SAMPLE_GAP_CAP_SEC", fallback=20),
+            max_lookback_seconds=cfg.getint("Interests", "MAX_LOOKBACK_SECONDS"),
+            post_confirm_window=cfg.getint("Interests", "POST_CONFIRM_MOVE_WINDOW_SEC", fallback=30),
+            max_wait_sec=cfg.getint("Interests", "MAX_WAIT_TIME_MINUTES") * 60,
+            photo_after_shift=cfg.getint("Interests", "PHOTO_AFTER_SHIFT_SEC"),
+            euro_before_shift=cfg.getint("Interests", "INTEREST_EURO_BEFORE_SHIFT_SEC"),
+            kgo_before_shift=cfg.getint("Interests", "INTEREST_KGO_BEFORE_SHIFT_SEC"),
+            ignore_tolerance=cfg.getint("Interests", "IGNORE_POINTS_TOLERANCE", fallback=0),
+            move_small_gap=cfg.getint("Interests", "INTERESTS_MOVE_SMALL_GAP_SEC", fallback=5),
+            move_max_gap=cfg.getint("Interests", "INTERESTS_MOVE_MAX_GAP_SEC", fallback=30),
+            move_a_kmhps=float(cfg.get("Interests", "INTERESTS_MOVE_A_KMHPS", fallback="1.26")),
+        )
+
+    def for_reg(self, reg_cfg: Optional[Dict[str, Any]]) -> "DetectionParams":
+        """
+        Переопределения регистратора из states.json: euro_container_alarm, kgo_container_alarm
+        и сдвиги interest_euro_before_shift_sec / interest_kgo_before_shift_sec / photo_after_shift_sec.
+        Нечисловые значения игнорируются.
+        """
+        if not reg_cfg:
+            return self
+        changes = {}
+        try:
+            changes["euro_alarm"] = int(reg_cfg.get("euro_container_alarm", 4))
+        except (TypeError, ValueError):
+            changes["euro_alarm"] = 4
+        try:
+            kgo = reg_cfg.get("kgo_container_alarm")
+            changes["kgo_alarm"] = int(kgo) if kgo is not None else None
+        except (TypeError, ValueError):
+            changes["kgo_alarm"] = None
+        for key, field in (("interest_euro_before_shift_sec", "euro_before_shift"),
+                           ("interest_kgo_before_shift_sec", "kgo_before_shift"),
+                           ("photo_after_shift_sec", "photo_after_shift")):
+            if reg_cfg.get(key) is None:
+                continue
+            try:
+                changes[field] = int(reg_cfg[key])
+            except (TypeError, ValueError):
+                logger.warning(f"[PARAMS] Некорректное значение {key}={reg_cfg[key]!r} — берём из конфига")
+        return replace(self, **changes)
+
+
+_lock = threading.Lock()
+_snapshot: Optional[DetectionParams] = None
+_mtime: Optional[float] = None
+
+
+def _config_mtime() -> Optional[float]:
+    try:
+        return os.path.getmtime(settings.CONFIG_PATH)
+    except OSError:
+        return None
+
+
+def current() -> DetectionParams:
+    """Снимок параметров из config.cfg; при изменении файла конфиг перечитывается."""
+    global _snapshot, _mtime
+    mtime = _config_mtime()
+    with _lock:
+        if _snapshot is None or mtime != _mtime:
+            cfg = settings.config
+            if _snapshot is not None:
+                cfg = configparser.ConfigParser(inline_comment_prefixes="#", allow_no_value=True)
+                cfg.read(settings.CONFIG_PATH, encoding="utf-8")
+                logger.info("[PARAMS] config.cfg изменился — параметры детектора перечитаны")
+            _snapshot = DetectionParams.from_config(cfg)
+            _mtime = mtime
+        return _snapshot
+
+
+def for_reg(reg_cfg: Optional[Dict[str, Any]]) -> DetectionParams:
+    """Параметры на проход по регистратору: текущий снимок конфига + его переопределения."""
+    return current().for_reg(reg_cfg)
@@ -0,0 +1,187 @@
+"""
+Инкрементальный поиск интересов по устройству.
+
+Прямой проход раньше на каждом опросе заново качал треки и алармы от
+last_upload_time и сканировал всё окно, а если у первого концевика не находилась
+остановка — сдвигал начало на минуту и перекачивал всё окно заново (до 8 раз).
+IncrementalInterestDetector живёт между опросами и хранит:
+  - буфер треков и сырых алармов: историю за history_sec() до точки продолжения
+    (её хватает find_first_stable_stop) и всё, что пришло после;
+  - scan_from — с какого трека продолжать: всё до него уже разобрано и отдано;
+  - fetched_until — до какого времени буфер загружен из CMS.
+Первое окно после сброса качается одним запросом сразу с запасом истории
+lookback_pad_sec() перед ним. На новом опросе догружается только хвост после
+fetched_until, а если истории всё же не хватило — только недостающий префикс перед буфером. Незавершённая погрузка (LoadingInProgress)
+не теряется: scan_from остаётся на её концевике, и следующий опрос начинает с него.
+"""
+from qt_pvp.cms_interface import functions as cms_funcs
+from qt_pvp.cms_interface import cms_api
+from qt_pvp.interests_search.track_frame import TrackFrame, dt_to_ts
+from qt_pvp.interests_search.detection_params import DetectionParams
+from qt_pvp.interests_search import detection_params
+from qt_pvp.logger import logger
+from qt_pvp.data import settings
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+import datetime
+
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+class DetectionResult(NamedTuple):
+    interests: List[dict]       # окончательные интересы (дальше не изменятся)
+    in_progress: bool           # в хвосте незавершённая погрузка — ждём новых треков
+    need_history: bool          # у первого концевика не хватило истории — нужен префикс
+
+
+def history_sec() -> int:
+    """Сколько истории до точки продолжения нужно поиску остановки перед концевиком."""
+    return max(detection_params.current().max_lookback_seconds, cms_funcs.KGO_LOOKBACK_SECONDS)
+
+
+def lookback_pad_sec() -> int:
+    """
+    Запас истории перед окном, который качается вместе с окном. LOOKBACK_PAD_SEC из конфига,
+    а если он не задан — глубина поиска остановки плюс сдвиг начала интереса КГО.
+    """
+    pad = settings.config.getint("Interests", "LOOKBACK_PAD_SEC", fallback=0)
+    if pad > 0:
+        return pad
+    return history_sec() + detection_params.current().kgo_before_shift
+
+
+def prepare_detector_alarms(raw_alarms: List[dict], reg_cfg: Dict[str, Any], reg_id=None,
+                            params: DetectionParams | None = None) -> Dict[str, Any]:
+    """Подготовка сырых алармов для детектора (те же параметры, что и у прямого поиска)."""
+    params = params or detection_params.for_reg(reg_cfg)
+    return cms_funcs.prepare_alarms(
+        raw_alarms=raw_alarms,
+        reg_cfg=reg_cfg,
+        allowed_atp=frozenset({19, 20, 21, 22}),
+        min_stop_speed_kmh=params.min_stop_speed / 10.0,
+        merge_gap_sec=15,
+        reg_id=reg_id,
+    )
+
+
+def _shift(time_str: str, seconds: int) -> str:
+    return (datetime.datetime.strptime(time_str, TIME_FMT) + datetime.timedelta(seconds=seconds)).strftime(TIME_FMT)
+
+
+def _alarm_end(a: dict) -> datetime.datetime | None:
+    end_dt, _ = cms_funcs._parse_alarm_time(a, "etm", "eTimeStr")
+    if end_dt is None:
+        end_dt, _ = cms_funcs._parse_alarm_time(a, "stm", "bTimeStr")
+    return end_dt
+
+
+class IncrementalInterestDetector:
+    def __init__(self, reg_id: str):
+        self.reg_id = reg_id
+        self.reset(None)
+
+    def reset(self, start_time: str | None) -> None:
+        """Начать с чистого буфера с момента start_time."""
+        self.tracks: List[dict] = []
+        self.raw_alarms: List[dict] = []
+        self.origin = start_time          # начало первого окна после сброса
+        # с какого времени буфер полный: первое окно качается сразу с историей перед ним
+        self.buffer_start = _shift(start_time, -lookback_pad_sec()) if start_time else None
+        self.scan_from = start_time       # с какого времени концевики ещё не разобраны
+        self.fetched_until: str | None = None
+
+    def continues(self, start_time: str) -> bool:
+        """
+        Можно ли продолжить с накопленного буфера для окна, начинающегося в start_time.
+        Отставание start_time от scan_from нормально (last_upload_time — конец последнего
+        интереса); окно раньше origin или с разрывом после fetched_until — повод начать заново.
+        """
+        if self.fetched_until is None or self.origin is None:
+            return False
+        return self.origin <= start_time <= _shift(self.fetched_until, 1)
+
+    def fetch_from(self) -> str:
+        """С какого времени догружать хвост."""
+        return _shift(self.fetched_until, 1) if self.fetched_until else self.buffer_start
+
+    def missing_history(self) -> Optional[Tuple[str, str]]:
+        """Недостающий кусок истории перед буфером [since, until] (None — истории хватает)."""
+        need_from = _shift(self.scan_from, -history_sec())
+        if need_from >= self.buffer_start:
+            return None
+        return need_from, _shift(self.buffer_start, -1)
+
+    # --- буфер ------------------------------------------------------------------------
+
+    def extend(self, tracks: List[dict], alarms: List[dict], until: str) -> None:
+        """Добавить новые точки после буфера (до until включительно)."""
+        last_gt = self.tracks[-1].get("gt") if self.tracks else None
+        self.tracks.extend(t for t in tracks if last_gt is None or (t.get("gt") or "") > last_gt)
+        self._merge_alarms(alarms)
+        self.fetched_until = max(self.fetched_until or until, until)
+
+    def prepend(self, tracks: List[dict], alarms: List[dict], since: str) -> None:
+        """Добавить историю перед буфером (с since)."""
+        first_gt = self.tracks[0].get("gt") if self.tracks else None
+        head = [t for t in tracks if first_gt is None or (t.get("gt") or "") < first_gt]
+        self.tracks[:0] = head
+        self._merge_alarms(alarms)
+        self.buffer_start = min(self.buffer_start, since) if self.buffer_start else since
+
+    def _merge_alarms(self, alarms: List[dict]) -> None:
+        if alarms:
+            self.raw_alarms = cms_api.flatten_alarms_pages([{"alarms": self.raw_alarms + list(alarms)}])
+
+    def _advance(self, frame: TrackFrame, next_index: int) -> None:
+        """Сдвинуть точку продолжения и выбросить историю, которая больше не понадобится."""
+        n = len(frame)
+        if n == 0:
+            return
+        if next_index >= n:
+            self.scan_from = _shift(frame.gt[n - 1], 1)
+        else:
+            self.scan_from = max(self.scan_from, frame.gt[next_index])
+        keep_from = _shift(self.scan_from, -history_sec())
+        if keep_from > (self.buffer_start or ""):
+            cut = int(np.searchsorted(frame.ts, dt_to_ts(datetime.datetime.strptime(keep_from, TIME_FMT)), "left"))
+            del self.tracks[:cut]
+            keep_dt = datetime.datetime.strptime(keep_from, TIME_FMT)
+            self.raw_alarms = [a for a in self.raw_alarms if (_alarm_end(a) or keep_dt) >= keep_dt]
+            self.buffer_start = keep_from
+
+    # --- поиск ------------------------------------------------------------------------
+
+    def detect(self, reg_cfg: Dict[str, Any], allow_partial_history: bool = False) -> DetectionResult:
+        """
+        Разобрать концевики начиная со scan_from. allow_partial_history — искать даже если
+        истории перед scan_from меньше history_sec() (догружать её больше не будем).
+        Параметры детектора снимаются один раз на вызов: конфиг + настройки регистратора reg_cfg.
+        """
+        frame = TrackFrame.of(self.tracks)
+        if len(frame) == 0:
+            return DetectionResult([], False, False)
+        params = detection_params.for_reg(reg_cfg)
+        scan_dt = datetime.datetime.strptime(self.scan_from, TIME_FMT)
+        start_index = int(np.searchsorted(frame.ts, dt_to_ts(scan_dt), "left"))
+        first_interest = self.missing_history() is not None and not allow_partial_history
+        try:
+            res = cms_funcs.find_interests_by_lifting_switches(
+                tracks=frame,
+                start_tracks_search_time=datetime.datetime.strptime(self.buffer_start, TIME_FMT),
+                reg_id=self.reg_id,
+                alarms=prepare_detector_alarms(self.raw_alarms, reg_cfg, self.reg_id, params),
+                start_index=start_index,
+                first_interest=first_interest,
+                params=params,
+            )
+        except cms_funcs.LoadingInProgress as e:
+            self._advance(frame, e.index if e.index is not None else start_index)
+            logger.info(f"{self.reg_id}: [INCREMENTAL] Погрузка ещё идёт, продолжим с {self.scan_from}")
+            return DetectionResult([], True, False)
+
+        if "error" in res:
+            return DetectionResult([], False, True)
+
+        in_progress = res.get("in_progress_index") is not None
+        self._advance(frame, res.get("next_index", len(frame)))
+        return DetectionResult(res.get("interests") or [], in_progress, False)
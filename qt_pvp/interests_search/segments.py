@@ -0,0 +1,245 @@
+"""
+Сегментация трека на серии «стоп / движение» для поиска границ интереса.
+
+find_first_stable_stop и find_stop_after_lifting раньше на каждый концевик заново
+проходили треки по одному (до MAX_LOOKBACK_SECONDS назад и до конца вперёд), то есть
+на день с сотнями срабатываний работа росла почти квадратично. SegmentIndex строится
+один раз на TrackFrame (и набор порогов) и хранит:
+  - классы точек: STOP (v <= MIN_STOP_SPEED), MOVE (v >= MIN_MOVE_SPEED), MID — между;
+  - серии (run-length) одинаковых классов и префиксные суммы шагов времени,
+    ограниченных SAMPLE_GAP_CAP_SEC;
+  - «стабильные» серии стопа (набрали MIN_STOP_DURATION_SEC) и серии движения,
+    подтверждающие старт (MIN_MOVE_DURATION_SEC);
+  - проход автомата фазы 1 find_first_stable_stop по всему треку с начала.
+
+Запросы — bisect по этим массивам. Поведение совпадает с прежними поточечными
+циклами: окно поиска назад, обрезанное по времени, может начаться посреди серии —
+тогда автомат окна проходится по сериям (с прыжками), пока не совпадёт с общим
+проходом, а дальше ответ берётся из общего прохода.
+"""
+from qt_pvp.interests_search.track_frame import TrackFrame
+from bisect import bisect_left, bisect_right
+from typing import Optional, Tuple
+import numpy as np
+
+STOP, MID, MOVE = 0, 1, 2
+
+
+class SegmentIndex:
+    def __init__(self, frame: TrackFrame, min_stop_speed, min_stop_duration: int, min_move_speed,
+                 min_move_duration: int, sample_gap_cap: int, int_speed: bool = False):
+        self.frame = frame
+        self.min_stop_duration = min_stop_duration
+        self.min_move_duration = min_move_duration
+        n = len(frame)
+        self.n = n
+        # int_speed: int(sp), как в find_first_stable_stop; иначе float(sp), как в find_stop_after_lifting
+        sp = np.trunc(frame.sp) if int_speed else frame.sp
+        self.cls = np.where(sp <= min_stop_speed, STOP, np.where(sp >= min_move_speed, MOVE, MID)).astype(np.int8)
+
+        # шаг времени к точке i от предыдущей (с капом), целые секунды; csum[k] = сумма dtc[:k]
+        dtc = np.zeros(n, dtype=np.int64)
+        if n > 1:
+            dtc[1:] = np.clip(np.diff(frame.ts), 0, sample_gap_cap)
+        self.dtc = dtc
+        self.csum = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(dtc)))
+
+        # серии одинаковых классов
+        if n:
+            change = np.flatnonzero(np.diff(self.cls)) + 1
+            self.run_start = np.concatenate(([0], change)).astype(np.int64)
+            self.run_end = np.concatenate((change - 1, [n - 1])).astype(np.int64)
+        else:
+            self.run_start = self.run_end = np.zeros(0, dtype=np.int64)
+        self.run_cls = self.cls[self.run_start]
+        self.run_of = np.repeat(np.arange(len(self.run_start)), self.run_end - self.run_start + 1)
+
+        idx = np.arange(n)
+        stop_idx = np.where(self.cls == STOP, idx, -1)
+        self.last_stop_at = np.maximum.accumulate(stop_idx) if n else stop_idx
+        nxt = np.where(self.cls == STOP, idx, n)
+        self.next_stop_at = np.minimum.accumulate(nxt[::-1])[::-1] if n else nxt
+
+        self._build_stop_runs()
+        self._build_move_runs()
+        self._build_global_scan()
+
+    # --- серии ----------------------------------------------------------------------------
+
+    def _stop_hit(self, a: int, b: int) -> int:
+        """Первая точка серии стопа [a, b], на которой набрана MIN_STOP_DURATION_SEC (-1 — нет)."""
+        j = a + int(np.searchsorted(self.csum[a + 1:b + 2], self.csum[a] + self.min_stop_duration, side="left"))
+        return j if j <= b else -1
+
+    def _build_stop_runs(self) -> None:
+        """Стабильные серии стопа: сумма шагов от первой точки серии (шаг первой — от предыдущей)."""
+        starts, hits = [], []
+        for r in np.flatnonzero(self.run_cls == STOP):
+            a, b = int(self.run_start[r]), int(self.run_end[r])
+            hit = self._stop_hit(a, b)
+            if hit >= 0:
+                starts.append(a)
+                hits.append(hit)
+        self.stable_stop_starts = starts
+        self.stable_stop_hits = hits
+
+    def _build_move_runs(self) -> None:
+        """Серии движения, подтверждающие старт: по сумме шагов или по времени от первой точки."""
+        ts = self.frame.ts
+        starts = []
+        for r in np.flatnonzero(self.run_cls == MOVE):
+            a, b = int(self.run_start[r]), int(self.run_end[r])
+            by_dur = a + int(np.searchsorted(self.csum[a + 1:b + 2], self.csum[a] + self.min_move_duration, side="left"))
+            by_time = a + int(np.searchsorted(ts[a:b + 1], ts[a] + self.min_move_duration, side="left"))
+            c = min(by_dur, by_time)
+            if c <= b:
+                starts.append(a)
+        self.move_confirm_starts = starts
+
+    # --- фаза 1 find_first_stable_stop: общий проход с начала трека ------------------------
+
+    def _build_global_scan(self) -> None:
+        """
+        Автомат фазы 1 с left = 0. Для каждой точки: свободен ли автомат после неё,
+        начало активной серии стопа и набрана ли она; плюс все подтверждения.
+        """
+        n = self.n
+        cls, dtc = self.cls.tolist(), self.dtc.tolist()
+        ds, dm = self.min_stop_duration, self.min_move_duration
+        idle = np.zeros(n, dtype=bool)
+        act_start = np.full(n, -1, dtype=np.int64)
+        is_long = np.zeros(n, dtype=bool)
+        conf_i, conf_start = [], []
+
+        active, start, low, move = False, -1, 0, 0
+        for i in range(n):
+            c = cls[i]
+            dt = dtc[i]
+            if c == STOP:
+                if not active:
+                    active, start, low, move = True, i, 0, 0
+                low += dt
+            elif active:
+                if low < ds:
+                    active, start, low, move = False, -1, 0, 0
+                elif c == MOVE:
+                    move += dt
+                    if move >= dm:
+                        conf_i.append(i)
+                        conf_start.append(start)
+                        active, start, low, move = False, -1, 0, 0
+                else:
+                    move = 0
+            if active:
+                act_start[i] = start
+                is_long[i] = low >= ds
+            else:
+                idle[i] = True
+        self.g_idle = idle
+        self.g_start = act_start
+        self.g_long = is_long
+        self.g_conf_i = conf_i
+        self.g_conf_start = conf_start
+        nxt = np.where(idle, np.arange(n), n)
+        self.g_next_idle = np.minimum.accumulate(nxt[::-1])[::-1] if n else nxt
+
+    def last_confirmed_stop(self, left: int, right: int) -> Tuple[Optional[Tuple[int, int]], Optional[int]]:
+        """
+        Фаза 1 на окне [left, right]: ((stop_start_i, confirm_i) последней подтверждённой
+        остановки или None, начало активной длинной серии на конце окна или None).
+        Шаг первой точки окна считается нулевым — как в поточечном цикле.
+        """
+        cls, dtc, csum = self.cls, self.dtc, self.csum
+        ds, dm = self.min_stop_duration, self.min_move_duration
+        active, start, low, move = False, -1, 0, 0
+        last = None
+        synced = None
+
+        i = left
+        while i <= right:
+            dt = 0 if i == left else int(dtc[i])
+            c = cls[i]
+            if c == STOP:
+                if not active:
+                    active, start, low, move = True, i, 0, 0
+                # внутри серии стопа меняется только накопленная длительность
+                end = min(int(self.run_end[self.run_of[i]]), right)
+                low += dt + int(csum[end + 1] - csum[i + 1])
+                i = end + 1
+                continue
+            if active:
+                if low < ds:
+                    active, start, low, move = False, -1, 0, 0
+                elif c == MOVE:
+                    move += dt
+                    if move >= dm:
+                        last = (start, i)
+                        active, start, low, move = False, -1, 0, 0
+                else:
+                    move = 0
+            if not active:
+                # свободны до следующего стопа: совпадаем с общим проходом, если он тоже свободен
+                stop_at = min(int(self.next_stop_at[i]), right + 1)
+                idle_at = int(self.g_next_idle[i])
+                if idle_at < stop_at:
+                    synced = idle_at
+                    break
+                i = stop_at
+                continue
+            i += 1
+
+        if synced is None:
+            return last, (start if active and low >= ds else None)
+
+        k = bisect_right(self.g_conf_i, right) - 1
+        if k >= 0 and self.g_conf_i[k] > synced:
+            last = (self.g_conf_start[k], self.g_conf_i[k])
+        tail = int(self.g_start[right]) if self.g_long[right] else None
+        return last, tail
+
+    # --- запросы --------------------------------------------------------------------------
+
+    def first_stable_stop_after(self, index: int, right: int) -> Optional[int]:
+        """Начало первой серии стопа после index, набравшей длительность не позже right."""
+        k = bisect_right(self.stable_stop_starts, index)
+        if k < len(self.stable_stop_starts) and self.stable_stop_hits[k] <= right:
+            return self.stable_stop_starts[k]
+        return None
+
+    def stop_then_move(self, start_idx: int) -> Optional[Tuple[int, int]]:
+        """
+        Для find_stop_after_lifting: (индекс последней точки стопа, начало серии движения)
+        для первого подтверждённого движения после первой длинной остановки от start_idx.
+        """
+        r = int(self.run_of[start_idx])
+        if self.run_cls[r] == STOP and self._stop_hit(start_idx, int(self.run_end[r])) >= 0:
+            # серия, в которую попал start_idx, считается с start_idx (шаг — от предыдущей точки)
+            stop_end = int(self.run_end[r])
+        else:
+            k = bisect_right(self.stable_stop_starts, start_idx)
+            if k >= len(self.stable_stop_starts):
+                return None
+            stop_end = int(self.run_end[self.run_of[self.stable_stop_starts[k]]])
+        k = bisect_left(self.move_confirm_starts, stop_end + 1)
+        if k >= len(self.move_confirm_starts):
+            return None
+        move_start = self.move_confirm_starts[k]
+        return int(self.last_stop_at[move_start - 1]), move_start
+
+
+def get_index(frame: TrackFrame, params, int_speed: bool = False,
+              min_move_duration: int | None = None) -> SegmentIndex:
+    """SegmentIndex для порогов из DetectionParams; кешируется на фрейме."""
+    key = (
+        int_speed,
+        params.min_stop_speed,
+        params.min_stop_duration,
+        params.min_move_speed,
+        min_move_duration if min_move_duration is not None else params.min_move_duration,
+        params.sample_gap_cap,
+    )
+    index = frame.segments.get(key)
+    if index is None:
+        index = SegmentIndex(frame, key[1], key[2], key[3], key[4], key[5], int_speed=int_speed)
+        frame.segments[key] = index
+    return index
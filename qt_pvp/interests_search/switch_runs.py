@@ -0,0 +1,139 @@
+"""
+Серии срабатываний концевиков по колонке s1 TrackFrame.
+
+Раньше детектор на каждой точке делал list(bin(s1)[2:].zfill(32)) и разворачивал
+строку, чтобы проверить один-два бита, — и то же самое во вложенном поиске конца
+интереса. Здесь биты euro/KGO снимаются с колонки s1 целиком (сдвиг и маска NumPy),
+а точки размечаются за один проход:
+  SW   — сработал концевик (euro или KGO);
+  LOW  — концевика нет, скорость < MIN_MOVE_SPEED;
+  MOVE — концевика нет, скорость >= MIN_MOVE_SPEED;
+  BAD  — s1 не разобрался (старый цикл на такой точке останавливался).
+Поиск конца интереса идёт по сериям этих классов, а не по точкам.
+
+StopStartTracker — маркер «с какой точки стоим» для предчека концевика. Он
+перематывается через участки без событий за O(1), так что главный цикл детектора
+переходит от события к событию (концевик, разрыв в треках).
+"""
+from qt_pvp.interests_search.track_frame import TrackFrame
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+
+SW, LOW, MOVE, BAD = 0, 1, 2, 3
+
+
+class Run(NamedTuple):
+    kind: int
+    start: int
+    end: int
+
+
+def bit_mask(frame: TrackFrame, bit_idx: int | None) -> np.ndarray:
+    """Бит bit_idx колонки s1 (False там, где s1 не разобрался или бит не задан)."""
+    if bit_idx is None:
+        return np.zeros(len(frame), dtype=bool)
+    return (((frame.s1 >> np.uint32(bit_idx)) & np.uint32(1)) == 1) & frame.s1_ok
+
+
+class SwitchRuns:
+    def __init__(self, frame: TrackFrame, euro_bit_idx: int, kgo_bit_idx: int | None, min_move_speed: int):
+        self.frame = frame
+        self.euro = bit_mask(frame, euro_bit_idx)
+        self.kgo = bit_mask(frame, kgo_bit_idx)
+        on = self.euro | self.kgo
+        speed = np.trunc(frame.sp)
+        self.kind = np.where(~frame.s1_ok, BAD,
+                             np.where(on, SW, np.where(speed < min_move_speed, LOW, MOVE))).astype(np.int8)
+        # индексы точек со сработавшим концевиком — кандидаты главного цикла
+        self.switch_idx = np.flatnonzero(on)
+
+        n = len(frame)
+        if n:
+            change = np.flatnonzero(np.diff(self.kind)) + 1
+            starts = np.concatenate(([0], change))
+            ends = np.concatenate((change - 1, [n - 1]))
+        else:
+            starts = ends = np.zeros(0, dtype=np.int64)
+        self.runs: List[Run] = [Run(int(self.kind[a]), int(a), int(b)) for a, b in zip(starts, ends)]
+        self.run_of = np.repeat(np.arange(len(self.runs)), ends - starts + 1)
+
+    def scan_lifting_end(self, start_idx: int, min_move_duration: int) -> Tuple[int, int, List[int], Optional[int]]:
+        """
+        Расширение окна погрузки вперёд от концевика в start_idx (как прежний поточечный цикл):
+          - концевик — окно расширяется, это последний концевик;
+          - скорость ниже MIN_MOVE_SPEED — окно расширяется, отсчёт движения сбрасывается;
+          - движение — отсчёт от первой такой точки, стоп, когда набралось min_move_duration;
+          - неразобранный s1 — стоп.
+        Возвращает (lifting_end_idx, last_switch_index, индексы концевиков после start_idx,
+        индекс начала движения или None).
+        """
+        ts = self.frame.ts
+        n = len(self.frame)
+        end = start_idx
+        last_switch = start_idx
+        switches: List[int] = []
+        move_start: Optional[int] = None
+
+        r = int(self.run_of[start_idx + 1]) if start_idx + 1 < n else len(self.runs)
+        while r < len(self.runs):
+            kind, a, b = self.runs[r]
+            a = max(a, end + 1)
+            if kind == BAD:
+                break
+            if kind == SW:
+                switches.extend(range(a, b + 1))
+                last_switch = end = b
+            elif kind == LOW:
+                move_start = None
+                end = b
+            else:
+                if move_start is None:
+                    move_start = a
+                # первая точка серии, к которой движение длится min_move_duration
+                k = a + int(np.searchsorted(ts[a:b + 1], ts[move_start] + int(min_move_duration), side="left"))
+                if k <= b:
+                    end = k
+                    break
+                end = b
+            r += 1
+        return end, last_switch, switches, move_start
+
+
+class StopStartTracker:
+    """
+    Начало текущей остановки по точкам, которые прошёл главный цикл: точка, где скорость
+    опустилась до MIN_STOP_SPEED (после скорости выше неё), пока после неё не было
+    скорости >= MIN_MOVE_SPEED. Скорость — int(sp), как в детекторе.
+    """
+
+    def __init__(self, frame: TrackFrame, min_stop_speed: int, min_move_speed: int):
+        self.speed = np.trunc(frame.sp).astype(np.int64)
+        self.min_stop_speed = min_stop_speed
+        stop = self.speed <= min_stop_speed
+        n = len(frame)
+        idx = np.arange(n)
+        cross = np.zeros(n, dtype=bool)
+        if n > 1:
+            cross[1:] = stop[1:] & ~stop[:-1]
+        self._stop = stop
+        self._last_cross = np.maximum.accumulate(np.where(cross, idx, -1)) if n else idx
+        self._last_move = np.maximum.accumulate(np.where(self.speed >= min_move_speed, idx, -1)) if n else idx
+        self.started: Optional[int] = None
+        self.prev_speed: Optional[int] = None
+
+    def advance(self, a: int, b: int) -> None:
+        """Пройти подряд точки a..b включительно."""
+        if a > b:
+            return
+        c = int(self._last_cross[b])
+        if c <= a:
+            # переход на первой точке участка считается от предыдущей ПРОЙДЕННОЙ точки
+            c = a if self._stop[a] and (self.prev_speed is None or self.prev_speed > self.min_stop_speed) else -1
+        m = int(self._last_move[b])
+        if m < a:
+            m = -1
+        if c >= 0 and m < c:
+            self.started = c
+        elif c >= 0 or m >= 0:
+            self.started = None
+        self.prev_speed = int(self.speed[b])
@@ -0,0 +1,117 @@
+"""
+Колоночное представление треков CMS для детектора интересов.
+
+Треки приходят списком dict ("gt", "sp", "s1", "ps", ...). Раньше детектор на каждом
+обращении заново делал strptime(gt) и int(sp) — в том числе во вложенных
+обратных сканах (ts(i)/spd(i)), то есть O(n·lookback) разборов строк. TrackFrame
+разбирает треки один раз (O(n)) в массивы NumPy:
+  - ts      — секунды «локального» времени CMS (наивное время, как в gt), int64;
+  - sp      — скорость, float64 (исходное значение, 0 для пустых);
+  - s1      — битовое поле s1 (uint32), s1_ok — удалось ли разобрать s1;
+  - lat/lon — координаты из "ps" ("lat,lon"), NaN если нет;
+  - geo_idx — индекс строки "ps" в geo_values (-1 — нет), сами строки без копий.
+Исходные dict доступны через rows/row(i) — для полей, которые детектору нужны редко.
+"""
+from typing import Any, Dict, List, Sequence
+import numpy as np
+import datetime
+
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _parse_gt(values: Sequence[Any]) -> np.ndarray:
+    """gt ('%Y-%m-%d %H:%M:%S' или ISO) -> секунды наивного времени."""
+    try:
+        return np.array([str(v).replace(" ", "T", 1) for v in values], dtype="datetime64[s]").astype(np.int64)
+    except ValueError:
+        # нестандартные строки — медленный, но строгий путь
+        return np.array([int((datetime.datetime.strptime(v, TIME_FMT) - _EPOCH).total_seconds())
+                         for v in values], dtype=np.int64)
+
+
+def _num(value, default=0.0) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class TrackFrame:
+    __slots__ = ("rows", "gt", "ts", "sp", "s1", "s1_ok", "lat", "lon", "geo_idx", "geo_values", "segments")
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.rows = rows
+        n = len(rows)
+        self.gt: List[str] = [r.get("gt") for r in rows]
+        self.ts = _parse_gt(self.gt) if n else np.zeros(0, dtype=np.int64)
+        self.sp = np.fromiter((_num(r.get("sp")) for r in rows), dtype=np.float64, count=n)
+
+        s1 = np.zeros(n, dtype=np.uint32)
+        s1_ok = np.zeros(n, dtype=bool)
+        lat = np.full(n, np.nan)
+        lon = np.full(n, np.nan)
+        geo_idx = np.full(n, -1, dtype=np.int32)
+        geo_values: List[str] = []
+        geo_pos: Dict[str, int] = {}
+        for i, r in enumerate(rows):
+            raw = r.get("s1")
+            try:
+                s1[i] = int(raw) & 0xFFFFFFFF
+                s1_ok[i] = True
+            except (TypeError, ValueError):
+                pass
+            ps = r.get("ps")
+            if ps:
+                k = geo_pos.get(ps)
+                if k is None:
+                    k = geo_pos[ps] = len(geo_values)
+                    geo_values.append(ps)
+                geo_idx[i] = k
+                try:
+                    la, lo = ps.split(",")
+                    lat[i], lon[i] = float(la), float(lo)
+                except ValueError:
+                    pass
+        self.s1, self.s1_ok = s1, s1_ok
+        self.lat, self.lon = lat, lon
+        self.geo_idx, self.geo_values = geo_idx, geo_values
+        # производные индексы (segments.SegmentIndex) по набору порогов
+        self.segments: Dict[tuple, Any] = {}
+
+    @classmethod
+    def of(cls, tracks) -> "TrackFrame":
+        """TrackFrame как есть или построенный из списка треков."""
+        return tracks if isinstance(tracks, TrackFrame) else cls(list(tracks or []))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return self.rows[i]
+
+    def dt(self, i: int) -> datetime.datetime:
+        """Время i-го трека как наивный datetime (то же, что strptime(gt))."""
+        return _EPOCH + datetime.timedelta(seconds=int(self.ts[i]))
+
+    def speed_int(self, i: int) -> int:
+        """int(sp), как в старом коде детектора."""
+        return int(self.sp[i])
+
+    def geo(self, i: int) -> str | None:
+        k = int(self.geo_idx[i])
+        return self.geo_values[k] if k >= 0 else None
+
+    def bit(self, i: int, bit_idx: int | None) -> bool:
+        if bit_idx is None:
+            return False
+        return bool((int(self.s1[i]) >> bit_idx) & 1)
+
+
+def ts_to_dt(ts: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(seconds=int(ts))
+
+
+def dt_to_ts(dt: datetime.datetime) -> float:
+    """Наивный datetime -> секунды в шкале TrackFrame.ts (доли секунды сохраняются)."""
+    return (dt - _EPOCH).total_seconds()
@@ -0,0 +1,395 @@
+"""
+Очередь pending-интересов в виде журнала на каждое устройство.
+
+Файл data/pending/<reg_id>.journal — JSONL, только дописывание (имя файла — reg_id с
+заменой недопустимых символов, настоящий reg_id — в первой строке):
+  {"op": "device",   "reg_id": ...}                     — заголовок: чей это журнал
+  {"op": "enqueue",  "name": ..., "interest": {...}}   — интерес поставлен в очередь
+  {"op": "claim",    "name": ...}                       — взят в работу
+  {"op": "complete", "name": ...}                       — обработан, из очереди убран
+  {"op": "fail",     "name": ..., "error": ...}         — обработка упала, вернулся в очередь
+  {"op": "release",  "name": ...}                       — claim снят без попытки, снова в очереди
+  {"op": "reset"}                                       — очередь очищена (set_pending_interests)
+
+При старте журналы проигрываются в in-memory индекс (OrderedDict по имени интереса,
+порядок — порядок постановки). Незавершённые claim после рестарта снова считаются
+ожидающими. Постановка и снятие — O(1) дописывание строки, дедуп — по индексу.
+Фоновый поток переписывает журнал, когда мёртвых записей становится больше живых.
+
+Журнал принадлежит процессу оператора (один писатель). При первом обращении к
+устройству без журнала очередь переносится из хранилища состояний.
+"""
+from qt_pvp.filelocker import _sanitize_for_json
+from qt_pvp.data import settings
+from qt_pvp.logger import logger
+from collections import OrderedDict
+from typing import Callable, Optional
+import threading
+import tempfile
+import atexit
+import json
+import re
+import os
+
+
+JOURNAL_SUFFIX = ".journal"
+
+
+def _journal_file_name(reg_id: str) -> str:
+    return re.sub(r"[^\w.-]", "_", str(reg_id)) + JOURNAL_SUFFIX
+
+
+class DeviceJournal:
+    """Журнал pending-интересов одного устройства."""
+
+    def __init__(self, path: str, fsync: bool = False, compact_min_records: int = 200,
+                 reg_id: Optional[str] = None):
+        self.path = path
+        self.reg_id = reg_id          # из заголовка журнала, если он есть
+        self.fsync = fsync
+        self.compact_min_records = compact_min_records
+        self._lock = threading.RLock()
+        self._index: "OrderedDict[str, dict]" = OrderedDict()
+        self._records = 0
+        self._fh = None
+        self._replay()
+
+    # --- replay / запись --------------------------------------------------------------
+
+    def _replay(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        bad = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    # недописанная строка при падении — пропускаем
+                    bad += 1
+                    continue
+                self._apply(rec)
+                self._records += 1
+        # claim живёт только в памяти процесса: после рестарта — снова в очереди
+        for entry in self._index.values():
+            entry["state"] = "queued"
+        if bad:
+            logger.warning(f"[PENDING] {os.path.basename(self.path)}: пропущено битых записей: {bad}")
+
+    def _apply(self, rec: dict) -> None:
+        op = rec.get("op")
+        name = rec.get("name")
+        if op == "device":
+            self.reg_id = rec.get("reg_id")
+        elif op == "enqueue":
+            if name and name not in self._index:
+                self._index[name] = {
+                    "interest": rec.get("interest") or {},
+                    "state": "queued",
+                    "attempts": int(rec.get("attempts", 0)),
+                }
+        elif op == "claim":
+            if name in self._index:
+                self._index[name]["state"] = "claimed"
+        elif op == "complete":
+            self._index.pop(name, None)
+        elif op == "fail":
+            entry = self._index.get(name)
+            if entry is not None:
+                entry["state"] = "queued"
+                entry["attempts"] += 1
+        elif op == "release":
+            entry = self._index.get(name)
+            if entry is not None:
+                entry["state"] = "queued"
+        elif op == "reset":
+            self._index.clear()
+
+    def _open(self):
+        if self._fh is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._fh = open(self.path, "a", encoding="utf-8")
+            if self._fh.tell() == 0 and self.reg_id is not None:
+                self._fh.write(json.dumps(self._header(), ensure_ascii=False) + "\n")
+                self._records += 1
+        return self._fh
+
+    def _header(self) -> dict:
+        return {"op": "device", "reg_id": self.reg_id}
+
+    def _append(self, rec: dict) -> None:
+        # в индекс кладём ту же (сериализуемую) форму, что и в файл
+        rec = _sanitize_for_json(rec)
+        fh = self._open()
+        fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        fh.flush()
+        if self.fsync:
+            os.fsync(fh.fileno())
+        self._records += 1
+        self._apply(rec)
+
+    # --- операции очереди ------------------------------------------------------------
+
+    def enqueue(self, interests: list[dict]) -> int:
+        added = 0
+        with self._lock:
+            for it in interests:
+                name = (it or {}).get("name")
+                if not name or name in self._index:
+                    continue
+                self._append({"op": "enqueue", "name": name, "interest": it})
+                added += 1
+        return added
+
+    def claim(self, name: str) -> bool:
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None or entry["state"] == "claimed":
+                return False
+            self._append({"op": "claim", "name": name})
+            return True
+
+    def complete(self, name: str) -> bool:
+        with self._lock:
+            if name not in self._index:
+                return False
+            self._append({"op": "complete", "name": name})
+            return True
+
+    def fail(self, name: str, error: str | None = None) -> bool:
+        with self._lock:
+            if name not in self._index:
+                return False
+            rec = {"op": "fail", "name": name}
+            if error:
+                rec["error"] = str(error)[:500]
+            self._append(rec)
+            return True
+
+    def release(self, name: str) -> bool:
+        """Снять claim, не считая попытку (интерес так и не начали обрабатывать)."""
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None or entry["state"] != "claimed":
+                return False
+            self._append({"op": "release", "name": name})
+            return True
+
+    def reset(self, interests: list[dict]) -> None:
+        with self._lock:
+            self._append({"op": "reset"})
+            for it in interests:
+                name = (it or {}).get("name")
+                if name and name not in self._index:
+                    self._append({"op": "enqueue", "name": name, "interest": it})
+
+    def items(self) -> list[dict]:
+        """Живые интересы (ожидающие и взятые в работу) в порядке постановки."""
+        with self._lock:
+            return [json.loads(json.dumps(e["interest"], ensure_ascii=False)) for e in self._index.values()]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    # --- компактификация -------------------------------------------------------------
+
+    def needs_compaction(self) -> bool:
+        return self._records >= self.compact_min_records and self._records > 2 * len(self._index)
+
+    def compact(self) -> None:
+        """Переписать журнал только живыми записями (атомарно, через os.replace)."""
+        with self._lock:
+            dir_ = os.path.dirname(self.path) or "."
+            os.makedirs(dir_, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".pending.", suffix=".tmp", dir=dir_)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+                    if self.reg_id is not None:
+                        tmp.write(json.dumps(self._header(), ensure_ascii=False) + "\n")
+                    for name, entry in self._index.items():
+                        rec = {"op": "enqueue", "name": name, "interest": entry["interest"]}
+                        if entry["attempts"]:
+                            rec["attempts"] = entry["attempts"]
+                        tmp.write(json.dumps(_sanitize_for_json(rec), ensure_ascii=False) + "\n")
+                        if entry["state"] == "claimed":
+                            tmp.write(json.dumps({"op": "claim", "name": name}, ensure_ascii=False) + "\n")
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                self.close()
+                os.replace(tmp_path, self.path)
+            finally:
+                if os.path.exists(tmp_path):
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+            before = self._records
+            self._records = len(self._index) + sum(1 for e in self._index.values() if e["state"] == "claimed") \
+                + (self.reg_id is not None)
+            logger.debug(f"[PENDING] {os.path.basename(self.path)}: компактификация {before} -> {self._records}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                try:
+                    self._fh.close()
+                finally:
+                    self._fh = None
+
+
+class PendingJournal:
+    """
+    Набор журналов по устройствам + фоновая компактификация.
+    seed(reg_id) -> list[dict] вызывается для устройства без журнала (перенос старой очереди).
+    """
+
+    def __init__(self, folder: str, fsync: bool = False, compact_interval: float = 60.0,
+                 compact_min_records: int = 200, seed: Optional[Callable[[str], list]] = None):
+        self.folder = folder
+        self.fsync = fsync
+        self.compact_min_records = compact_min_records
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._devices: dict[str, DeviceJournal] = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._load_existing()
+        if compact_interval and compact_interval > 0:
+            self._thread = threading.Thread(target=self._compact_loop, args=(float(compact_interval),),
+                                            name="pending-compact", daemon=True)
+            self._thread.start()
+
+    def _load_existing(self) -> None:
+        if not os.path.isdir(self.folder):
+            return
+        for fn in sorted(os.listdir(self.folder)):
+            if fn.endswith(JOURNAL_SUFFIX):
+                dev = DeviceJournal(os.path.join(self.folder, fn), fsync=self.fsync,
+                                    compact_min_records=self.compact_min_records)
+                if dev.reg_id is None:
+                    # журнал без заголовка (старый формат): reg_id — из имени файла
+                    dev.reg_id = fn[:-len(JOURNAL_SUFFIX)]
+                self._devices[dev.reg_id] = dev
+        if self._devices:
+            total = sum(len(d) for d in self._devices.values())
+            logger.info(f"[PENDING] Проиграно журналов: {len(self._devices)}, интересов в очереди: {total}")
+
+    def _new_device(self, reg_id: str) -> DeviceJournal:
+        return DeviceJournal(os.path.join(self.folder, _journal_file_name(reg_id)),
+                             fsync=self.fsync, compact_min_records=self.compact_min_records, reg_id=reg_id)
+
+    def device(self, reg_id: str) -> DeviceJournal:
+        dev = self._devices.get(reg_id)
+        if dev is not None:
+            return dev
+        with self._lock:
+            dev = self._devices.get(reg_id)
+            if dev is None:
+                dev = self._new_device(reg_id)
+                if self.seed is not None and not os.path.exists(dev.path):
+                    seeded = self.seed(reg_id) or []
+                    if seeded:
+                        dev.enqueue(seeded)
+                        logger.info(f"{reg_id}: [PENDING] Очередь перенесена в журнал: {len(dev)} интерес(ов)")
+                self._devices[reg_id] = dev
+        return dev
+
+    # --- API очереди -----------------------------------------------------------------
+
+    def get_pending(self, reg_id: str) -> list[dict]:
+        return self.device(reg_id).items()
+
+    def append(self, reg_id: str, interests: list[dict]) -> int:
+        return self.device(reg_id).enqueue(interests)
+
+    def set(self, reg_id: str, interests: list[dict]) -> None:
+        self.device(reg_id).reset(list(interests))
+
+    def claim(self, reg_id: str, name: str) -> bool:
+        return self.device(reg_id).claim(name)
+
+    def complete(self, reg_id: str, name: str) -> bool:
+        return self.device(reg_id).complete(name)
+
+    def fail(self, reg_id: str, name: str, error: str | None = None) -> bool:
+        return self.device(reg_id).fail(name, error)
+
+    def release(self, reg_id: str, name: str) -> bool:
+        return self.device(reg_id).release(name)
+
+    # --- обслуживание ----------------------------------------------------------------
+
+    def compact_due(self) -> int:
+        n = 0
+        for dev in list(self._devices.values()):
+            if dev.needs_compaction():
+                try:
+                    dev.compact()
+                    n += 1
+                except Exception as e:
+                    logger.warning(f"[PENDING] Ошибка компактификации {dev.path}: {e}")
+        return n
+
+    def _compact_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.compact_due()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5.0)
+        for dev in list(self._devices.values()):
+            dev.close()
+
+
+def _seed_from_state_store(reg_id: str) -> list[dict]:
+    """Забрать очередь из хранилища состояний (разово, при появлении журнала)."""
+    from qt_pvp import state_store
+    store = state_store.get_store()
+    items = store.get_pending(reg_id) or []
+    if items:
+        store.set_pending(reg_id, [], factory=dict)
+    return items
+
+
+_journal: PendingJournal | None = None
+_journal_resolved = False
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> PendingJournal | None:
+    """Глобальный журнал; None — очередь хранится в хранилище состояний ([State] PENDING_QUEUE = store)."""
+    global _journal, _journal_resolved
+    if _journal_resolved:
+        return _journal
+    with _journal_lock:
+        if _journal_resolved:
+            return _journal
+        mode = settings.config.get("State", "PENDING_QUEUE", fallback="store").strip().lower()
+        if mode == "journal":
+            _journal = PendingJournal(
+                settings.PENDING_JOURNAL_FOLDER,
+                fsync=settings.config.getboolean("State", "JOURNAL_FSYNC", fallback=False),
+                compact_interval=settings.config.getfloat("State", "JOURNAL_COMPACT_INTERVAL_SEC", fallback=60.0),
+                compact_min_records=settings.config.getint("State", "JOURNAL_COMPACT_MIN_RECORDS", fallback=200),
+                seed=_seed_from_state_store,
+            )
+            atexit.register(_journal.close)
+        _journal_resolved = True
+    return _journal
+
+
+def set_journal(journal: PendingJournal | None) -> None:
+    """Подменить глобальный журнал (тесты); None — очередь в хранилище состояний."""
+    global _journal, _journal_resolved
+    with _journal_lock:
+        if _journal is not None and _journal is not journal:
+            _journal.close()
+        _journal = journal
+        _journal_resolved = True
@@ -0,0 +1,1119 @@
+"""
+Хранилище состояний регистраторов.
+
+Исторически всё состояние жило в одном states.json: любое изменение одного поля
+(pending, last_upload_time, verified_until ...) брало глобальный FileLock, читало
+файл целиком и переписывало его с fsync. Здесь это спрятано за StateStore:
+
+  - JsonStateStore   — прежний формат (states.json целиком под FileLock);
+  - ShardedJsonStateStore — файл и lock на каждый регистратор + индекс госномеров;
+  - SqliteStateStore — SQLite в WAL-режиме: строка на регистратор и строка на
+                       pending-интерес, изменение трогает только свои строки,
+                       читатели не блокируют писателя (API и оператор живут рядом).
+
+Бэкенд выбирается в config.cfg: [State] BACKEND = json | sharded | sqlite.
+[State] DURABILITY = interval | shutdown включает write-behind кэш (CachedStateStore):
+изменения копятся в памяти и сбрасываются одной пачкой; strict — запись сразу.
+При первом открытии пустой базы SQLite (или пустой папки шардов) состояние
+импортируется из states.json;
+вручную: python -m qt_pvp.state_store import [--src states.json] [--db states.sqlite3]
+"""
+from qt_pvp.filelocker import FileLock, _load_states, _atomic_save_states, _sanitize_for_json
+from qt_pvp.data import settings
+from qt_pvp.logger import logger
+from typing import Any, Callable, Iterator, Optional
+import contextlib
+import abc
+import atexit
+import threading
+import sqlite3
+import json
+import time
+import re
+import os
+
+
+# mutator(reg, created) -> bool: правит reg in-place, True — есть что сохранять
+RegMutator = Callable[[dict, bool], bool]
+RegFactory = Callable[[], dict]
+
+
+def _copy(obj):
+    """Глубокая копия через JSON — наружу не отдаём живые объекты хранилища."""
+    return json.loads(json.dumps(_sanitize_for_json(obj), ensure_ascii=False))
+
+
+def _plate_key(plate) -> Optional[str]:
+    """Нормализованный госномер для поиска: верхний регистр, без пробелов."""
+    if not plate:
+        return None
+    return str(plate).upper().replace(" ", "")
+
+
+def _dedup_append(cur: list, interests: list[dict]) -> int:
+    """Добавляет интересы в cur с дедупом по имени. Возвращает число добавленных."""
+    seen = {it.get("name") for it in cur if isinstance(it, dict)}
+    added = 0
+    for it in interests:
+        nm = (it or {}).get("name")
+        if nm and nm not in seen:
+            cur.append(it)
+            seen.add(nm)
+            added += 1
+    return added
+
+
+def _diff(old: Optional[dict], new: dict) -> dict:
+    """Правка записи регистратора: какие поля поставить и какие убрать, чтобы из old получить new."""
+    old = old or {}
+    return {"set": {k: v for k, v in new.items() if k not in old or old[k] != v},
+            "unset": [k for k in old if k not in new]}
+
+
+def _apply_fields(reg: dict, change: dict) -> bool:
+    """Применить правку _diff к reg in-place. True — что-то поменялось."""
+    changed = False
+    for k, v in change.get("set", {}).items():
+        if reg.get(k, object()) != v:
+            reg[k] = v
+            changed = True
+    for k in change.get("unset", []):
+        if k in reg:
+            del reg[k]
+            changed = True
+    return changed
+
+
+def _apply_pending_op(cur: list, op: tuple) -> list:
+    """Операция над очередью pending: ("append", items) | ("remove", name) | ("set", items)."""
+    kind, arg = op
+    if kind == "append":
+        cur = list(cur)
+        _dedup_append(cur, arg)
+        return cur
+    if kind == "remove":
+        return [it for it in cur if it.get("name") != arg]
+    return list(arg)
+
+
+class StateStore(abc.ABC):
+    """
+    Общий интерфейс хранилища. Все методы потокобезопасны и атомарны
+    относительно других процессов, работающих с тем же хранилищем.
+    Бэкенд без какого-то из абстрактных методов не создаётся (TypeError).
+    """
+
+    @abc.abstractmethod
+    def get_reg(self, reg_id: str) -> Optional[dict]:
+        """Копия состояния регистратора (без pending_interests) или None."""
+        ...
+
+    @abc.abstractmethod
+    def update_reg(self, reg_id: str, mutator: RegMutator, factory: RegFactory) -> dict:
+        """
+        Атомарно: достать рег (или создать через factory), применить mutator,
+        сохранить, если mutator вернул True. Возвращает копию итогового состояния.
+        """
+        ...
+
+    @abc.abstractmethod
+    def iter_regs(self) -> Iterator[tuple[str, dict]]:
+        ...
+
+    def find_reg_id_by_plate(self, plate: str) -> Optional[str]:
+        """reg_id по госномеру (сравнение без учёта регистра и пробелов)."""
+        key = _plate_key(plate)
+        if key is None:
+            return None
+        for reg_id, reg in self.iter_regs():
+            if _plate_key(reg.get("plate")) == key:
+                return reg_id
+        return None
+
+    @abc.abstractmethod
+    def get_pending(self, reg_id: str) -> Optional[list[dict]]:
+        """Список pending-интересов; None — регистратора нет в хранилище."""
+        ...
+
+    @abc.abstractmethod
+    def set_pending(self, reg_id: str, interests: list[dict], factory: RegFactory) -> None:
+        ...
+
+    @abc.abstractmethod
+    def append_pending(self, reg_id: str, interests: list[dict], factory: RegFactory) -> int:
+        ...
+
+    @abc.abstractmethod
+    def remove_pending(self, reg_id: str, interest_name: str, factory: RegFactory) -> bool:
+        ...
+
+    def bulk_write(self, regs: dict[str, dict], pending: dict[str, list[dict]]) -> None:
+        """
+        Записать пачку изменений: regs — полные записи регистраторов (без pending),
+        pending — полные списки pending-интересов. Бэкенды делают это одной
+        атомарной операцией; здесь — поштучный запасной вариант.
+        """
+        def _replace_with(new: dict) -> RegMutator:
+            def _replace(cur: dict, created: bool) -> bool:
+                cur.clear()
+                cur.update(new)
+                return True
+            return _replace
+
+        for reg_id, reg in regs.items():
+            self.update_reg(reg_id, _replace_with(reg), factory=dict)
+        for reg_id, items in pending.items():
+            self.set_pending(reg_id, items, factory=dict)
+
+    def merge_write(self, regs: dict[str, dict], pending: dict[str, list[tuple]]) -> dict[str, tuple]:
+        """
+        Наложить пачку правок на то, что сейчас лежит в хранилище (а не перезаписать его):
+        regs — правки полей {"set": {...}, "unset": [...]} (см. _diff), pending — операции
+        над очередями (_apply_pending_op). Поля и интересы, которые правил другой процесс,
+        сохраняются. Возвращает {reg_id: (итоговая запись, итоговая очередь pending)}.
+        Здесь — поштучно через атомарные методы хранилища.
+        """
+        for reg_id, change in regs.items():
+            self.update_reg(reg_id, lambda cur, created, ch=change: _apply_fields(cur, ch) or created, factory=dict)
+        for reg_id, ops in pending.items():
+            for kind, arg in ops:
+                if kind == "append":
+                    self.append_pending(reg_id, arg, factory=dict)
+                elif kind == "remove":
+                    self.remove_pending(reg_id, arg, factory=dict)
+                else:
+                    self.set_pending(reg_id, arg, factory=dict)
+        return {reg_id: (self.get_reg(reg_id), self.get_pending(reg_id) or [])
+                for reg_id in set(regs) | set(pending)}
+
+    def checkpoint(self) -> None:
+        """Сбросить отложенные изменения на диск (для хранилищ с write-behind)."""
+        pass
+
+    @abc.abstractmethod
+    def import_states(self, states: dict) -> int:
+        """Залить состояние в формате states.json ({"regs": {...}}). Возвращает число регов."""
+        ...
+
+    def export_states(self) -> dict:
+        """Обратное преобразование в формат states.json (для бэкапов и отладки)."""
+        regs = {}
+        for reg_id, reg in self.iter_regs():
+            reg["pending_interests"] = self.get_pending(reg_id) or []
+            regs[reg_id] = reg
+        return {"regs": regs}
+
+    def close(self) -> None:
+        pass
+
+
+class JsonStateStore(StateStore):
+    """Прежнее поведение: states.json целиком под межпроцессным FileLock."""
+
+    def __init__(self, path: str | None = None):
+        self.path = path or settings.states
+        self.lock_path = self.path + ".lock"
+
+    def _load(self) -> dict:
+        states = _load_states(self.path)
+        states.setdefault("regs", {})
+        return states
+
+    def _save(self, states: dict) -> None:
+        _atomic_save_states(states, self.path)
+
+    def get_reg(self, reg_id):
+        with FileLock(self.lock_path):
+            reg = self._load()["regs"].get(reg_id)
+        if reg is None:
+            return None
+        reg = _copy(reg)
+        reg.pop("pending_interests", None)
+        return reg
+
+    def update_reg(self, reg_id, mutator, factory):
+        with FileLock(self.lock_path):
+            states = self._load()
+            regs = states["regs"]
+            created = reg_id not in regs
+            if created:
+                regs[reg_id] = factory()
+            if mutator(regs[reg_id], created):
+                self._save(states)
+            reg = _copy(regs[reg_id])
+        reg.pop("pending_interests", None)
+        return reg
+
+    def iter_regs(self):
+        with FileLock(self.lock_path):
+            regs = self._load()["regs"]
+        for reg_id, reg in regs.items():
+            reg = _copy(reg)
+            reg.pop("pending_interests", None)
+            yield reg_id, reg
+
+    def get_pending(self, reg_id):
+        with FileLock(self.lock_path):
+            reg = self._load()["regs"].get(reg_id)
+        if reg is None:
+            return None
+        return list(reg.get("pending_interests", []))
+
+    def set_pending(self, reg_id, interests, factory):
+        with FileLock(self.lock_path):
+            states = self._load()
+            reg = states["regs"].setdefault(reg_id, factory())
+            reg["pending_interests"] = list(interests)
+            self._save(states)
+
+    def append_pending(self, reg_id, interests, factory):
+        with FileLock(self.lock_path):
+            states = self._load()
+            reg = states["regs"].setdefault(reg_id, factory())
+            cur = reg.get("pending_interests", [])
+            added = _dedup_append(cur, interests)
+            reg["pending_interests"] = cur
+            self._save(states)
+            return added
+
+    def remove_pending(self, reg_id, interest_name, factory):
+        with FileLock(self.lock_path):
+            states = self._load()
+            reg = states["regs"].setdefault(reg_id, factory())
+            cur = reg.get("pending_interests", [])
+            left = [it for it in cur if it.get("name") != interest_name]
+            reg["pending_interests"] = left
+            self._save(states)
+            return len(left) != len(cur)
+
+    def bulk_write(self, regs, pending):
+        if not regs and not pending:
+            return
+        with FileLock(self.lock_path):
+            states = self._load()
+            cur_regs = states["regs"]
+            for reg_id, reg in regs.items():
+                new = dict(reg)
+                new["pending_interests"] = cur_regs.get(reg_id, {}).get("pending_interests", [])
+                cur_regs[reg_id] = new
+            for reg_id, items in pending.items():
+                cur_regs.setdefault(reg_id, {})["pending_interests"] = list(items)
+            self._save(states)
+
+    def merge_write(self, regs, pending):
+        if not regs and not pending:
+            return {}
+        out = {}
+        with FileLock(self.lock_path):
+            states = self._load()
+            cur_regs = states["regs"]
+            for reg_id, change in regs.items():
+                _apply_fields(cur_regs.setdefault(reg_id, {}), change)
+            for reg_id, ops in pending.items():
+                reg = cur_regs.setdefault(reg_id, {})
+                cur = reg.get("pending_interests", [])
+                for op in ops:
+                    cur = _apply_pending_op(cur, op)
+                reg["pending_interests"] = cur
+            self._save(states)
+            for reg_id in set(regs) | set(pending):
+                reg = _copy(cur_regs[reg_id])
+                out[reg_id] = (reg, reg.pop("pending_interests", None) or [])
+        return out
+
+    def import_states(self, states):
+        regs = (states or {}).get("regs", {})
+        with FileLock(self.lock_path):
+            self._save({"regs": regs})
+        return len(regs)
+
+    def export_states(self):
+        with FileLock(self.lock_path):
+            return _copy(self._load())
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS regs (
+    reg_id      TEXT PRIMARY KEY,
+    plate       TEXT,               -- нормализованный госномер (_plate_key)
+    data        TEXT NOT NULL,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_regs_plate ON regs(plate);
+CREATE TABLE IF NOT EXISTS pending_interests (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    reg_id      TEXT NOT NULL,
+    name        TEXT,
+    data        TEXT NOT NULL,
+    UNIQUE (reg_id, name)
+);
+CREATE INDEX IF NOT EXISTS idx_pending_reg ON pending_interests(reg_id, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value       TEXT
+);
+"""
+
+
+class SqliteStateStore(StateStore):
+    """
+    SQLite (WAL). Таблицы:
+      regs(reg_id, plate, data JSON)          — строка на регистратор;
+      pending_interests(reg_id, name, data)   — строка на pending-интерес (порядок — по id);
+      meta(key, value)                        — служебные отметки (например, откуда импортировали).
+    Соединение — своё на каждый поток, запись — в BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, db_path: str, import_from: str | None = None):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conns: list[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+        if import_from:
+            self._auto_import(import_from)
+
+    # --- соединения / транзакции ---------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _dumps(obj) -> str:
+        return json.dumps(_sanitize_for_json(obj), ensure_ascii=False)
+
+    def _write_reg(self, conn, reg_id: str, reg: dict) -> None:
+        conn.execute(
+            "INSERT INTO regs(reg_id, plate, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(reg_id) DO UPDATE SET plate=excluded.plate, data=excluded.data, "
+            "updated_at=excluded.updated_at",
+            (reg_id, _plate_key(reg.get("plate")), self._dumps(reg), time.time()),
+        )
+
+    def _ensure_reg(self, conn, reg_id: str, factory: RegFactory) -> None:
+        row = conn.execute("SELECT 1 FROM regs WHERE reg_id=?", (reg_id,)).fetchone()
+        if row is None:
+            self._write_reg(conn, reg_id, factory())
+
+    def _insert_pending(self, conn, reg_id: str, interests: list[dict]) -> int:
+        added = 0
+        for it in interests:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO pending_interests(reg_id, name, data) VALUES (?, ?, ?)",
+                (reg_id, (it or {}).get("name"), self._dumps(it)),
+            )
+            added += cur.rowcount
+        return added
+
+    # --- регистраторы ----------------------------------------------------------------
+
+    def get_reg(self, reg_id):
+        row = self._conn().execute("SELECT data FROM regs WHERE reg_id=?", (reg_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_reg(self, reg_id, mutator, factory):
+        with self._tx() as conn:
+            row = conn.execute("SELECT data FROM regs WHERE reg_id=?", (reg_id,)).fetchone()
+            created = row is None
+            reg = factory() if created else json.loads(row[0])
+            reg.pop("pending_interests", None)
+            if mutator(reg, created):
+                self._write_reg(conn, reg_id, reg)
+        return _copy(reg)
+
+    def iter_regs(self):
+        rows = self._conn().execute("SELECT reg_id, data FROM regs ORDER BY reg_id").fetchall()
+        for reg_id, data in rows:
+            yield reg_id, json.loads(data)
+
+    def find_reg_id_by_plate(self, plate):
+        row = self._conn().execute(
+            "SELECT reg_id FROM regs WHERE plate=? ORDER BY reg_id LIMIT 1", (_plate_key(plate),)
+        ).fetchone()
+        return row[0] if row else None
+
+    # --- pending ---------------------------------------------------------------------
+
+    def get_pending(self, reg_id):
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM regs WHERE reg_id=?", (reg_id,)).fetchone() is None:
+            return None
+        rows = conn.execute(
+            "SELECT data FROM pending_interests WHERE reg_id=? ORDER BY id", (reg_id,)
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def set_pending(self, reg_id, interests, factory):
+        with self._tx() as conn:
+            self._ensure_reg(conn, reg_id, factory)
+            conn.execute("DELETE FROM pending_interests WHERE reg_id=?", (reg_id,))
+            self._insert_pending(conn, reg_id, list(interests))
+
+    def append_pending(self, reg_id, interests, factory):
+        # дедуп по имени делает UNIQUE(reg_id, name); безымянные не добавляем (как раньше)
+        interests = [it for it in interests if (it or {}).get("name")]
+        with self._tx() as conn:
+            self._ensure_reg(conn, reg_id, factory)
+            return self._insert_pending(conn, reg_id, interests)
+
+    def remove_pending(self, reg_id, interest_name, factory):
+        with self._tx() as conn:
+            self._ensure_reg(conn, reg_id, factory)
+            cur = conn.execute(
+                "DELETE FROM pending_interests WHERE reg_id=? AND name=?", (reg_id, interest_name)
+            )
+            return cur.rowcount > 0
+
+    def bulk_write(self, regs, pending):
+        if not regs and not pending:
+            return
+        with self._tx() as conn:
+            for reg_id, reg in regs.items():
+                self._write_reg(conn, reg_id, reg)
+            for reg_id, items in pending.items():
+                conn.execute("DELETE FROM pending_interests WHERE reg_id=?", (reg_id,))
+                self._insert_pending(conn, reg_id, list(items))
+
+    def merge_write(self, regs, pending):
+        if not regs and not pending:
+            return {}
+        out = {}
+        with self._tx() as conn:
+            for reg_id, change in regs.items():
+                row = conn.execute("SELECT data FROM regs WHERE reg_id=?", (reg_id,)).fetchone()
+                reg = json.loads(row[0]) if row else {}
+                if _apply_fields(reg, change) or row is None:
+                    self._write_reg(conn, reg_id, reg)
+            for reg_id, ops in pending.items():
+                self._ensure_reg(conn, reg_id, dict)
+                for kind, arg in ops:
+                    if kind == "append":
+                        self._insert_pending(conn, reg_id, [it for it in arg if (it or {}).get("name")])
+                    elif kind == "remove":
+                        conn.execute("DELETE FROM pending_interests WHERE reg_id=? AND name=?", (reg_id, arg))
+                    else:
+                        conn.execute("DELETE FROM pending_interests WHERE reg_id=?", (reg_id,))
+                        self._insert_pending(conn, reg_id, list(arg))
+            for reg_id in set(regs) | set(pending):
+                row = conn.execute("SELECT data FROM regs WHERE reg_id=?", (reg_id,)).fetchone()
+                rows = conn.execute(
+                    "SELECT data FROM pending_interests WHERE reg_id=? ORDER BY id", (reg_id,)
+                ).fetchall()
+                out[reg_id] = (json.loads(row[0]) if row else None, [json.loads(r[0]) for r in rows])
+        return out
+
+    # --- импорт ----------------------------------------------------------------------
+
+    def import_states(self, states):
+        regs = (states or {}).get("regs", {})
+        with self._tx() as conn:
+            for reg_id, reg in regs.items():
+                reg = dict(reg or {})
+                pending = reg.pop("pending_interests", None) or []
+                self._write_reg(conn, reg_id, reg)
+                conn.execute("DELETE FROM pending_interests WHERE reg_id=?", (reg_id,))
+                self._insert_pending(conn, reg_id, pending)
+        return len(regs)
+
+    def _auto_import(self, json_path: str) -> None:
+        """Разовый импорт states.json в пустую базу (повторно не выполняется)."""
+        if not os.path.exists(json_path):
+            return
+        with self._tx() as conn:
+            if conn.execute("SELECT value FROM meta WHERE key='imported_from'").fetchone():
+                return
+            if conn.execute("SELECT 1 FROM regs LIMIT 1").fetchone():
+                return
+            with FileLock(json_path + ".lock"):
+                states = _load_states(json_path)
+            regs = states.get("regs", {})
+            for reg_id, reg in regs.items():
+                reg = dict(reg or {})
+                pending = reg.pop("pending_interests", None) or []
+                self._write_reg(conn, reg_id, reg)
+                self._insert_pending(conn, reg_id, pending)
+            conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('imported_from', ?)",
+                         (json_path,))
+        logger.info(f"[STATE] Импортировано регистраторов из {json_path}: {len(regs)}")
+
+    def close(self):
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
+
+class ShardedJsonStateStore(StateStore):
+    """
+    states.json, разрезанный по регистраторам: <folder>/<reg_id>.json, у каждого
+    файла свой lock-файл, так что несвязанные регистраторы не ждут друг друга.
+    Поиск reg_id по госномеру — через маленький общий индекс <folder>/index.json
+    (свой lock; трогается только при смене госномера).
+
+    Формат шарда: {"reg_id": ..., "reg": {...}, "pending_interests": [...]}.
+    bulk_write атомарен в пределах одного регистратора, не всей пачки.
+    """
+
+    INDEX_FILE = "index.json"
+    SUFFIX = ".json"
+
+    def __init__(self, folder: str, import_from: str | None = None):
+        self.folder = folder
+        self.index_path = os.path.join(folder, self.INDEX_FILE)
+        os.makedirs(folder, exist_ok=True)
+        if import_from:
+            self._auto_import(import_from)
+
+    # --- файлы -----------------------------------------------------------------------
+
+    def _path(self, reg_id: str) -> str:
+        return os.path.join(self.folder, re.sub(r"[^\w.-]", "_", str(reg_id)) + self.SUFFIX)
+
+    def _lock(self, reg_id: str) -> FileLock:
+        return FileLock(self._path(reg_id) + ".lock")
+
+    def _read_shard(self, reg_id: str) -> Optional[dict]:
+        path = self._path(reg_id)
+        if not os.path.exists(path):
+            return None
+        shard = _load_states(path)
+        return shard if "reg" in shard else None
+
+    def _write_shard(self, reg_id: str, reg: dict, pending: list) -> None:
+        _atomic_save_states({"reg_id": reg_id, "reg": reg, "pending_interests": pending}, self._path(reg_id))
+
+    def _shard_files(self) -> list[str]:
+        return sorted(fn for fn in os.listdir(self.folder)
+                      if fn.endswith(self.SUFFIX) and fn != self.INDEX_FILE)
+
+    # --- индекс госномеров -------------------------------------------------------------
+
+    def _load_index(self) -> dict:
+        index = _load_states(self.index_path)
+        index.pop("regs", None)
+        index.setdefault("plates", {})
+        return index
+
+    def _index_plate(self, reg_id: str, old_plate, new_plate) -> None:
+        old_key, new_key = _plate_key(old_plate), _plate_key(new_plate)
+        if old_key == new_key:
+            return
+        with FileLock(self.index_path + ".lock"):
+            index = self._load_index()
+            plates = index["plates"]
+            if old_key and plates.get(old_key) == reg_id:
+                plates.pop(old_key, None)
+            if new_key:
+                plates[new_key] = reg_id
+            _atomic_save_states(index, self.index_path)
+
+    def rebuild_index(self) -> int:
+        plates = {}
+        for reg_id, reg in self.iter_regs():
+            key = _plate_key(reg.get("plate"))
+            if key and key not in plates:
+                plates[key] = reg_id
+        with FileLock(self.index_path + ".lock"):
+            _atomic_save_states({"plates": plates}, self.index_path)
+        return len(plates)
+
+    # --- регистраторы ----------------------------------------------------------------
+
+    def get_reg(self, reg_id):
+        with self._lock(reg_id):
+            shard = self._read_shard(reg_id)
+        return _copy(shard["reg"]) if shard else None
+
+    def update_reg(self, reg_id, mutator, factory):
+        with self._lock(reg_id):
+            shard = self._read_shard(reg_id)
+            created = shard is None
+            if created:
+                reg = factory()
+                pending = reg.pop("pending_interests", None) or []
+            else:
+                reg, pending = shard["reg"], shard.get("pending_interests", [])
+            old_plate = None if created else reg.get("plate")
+            if mutator(reg, created):
+                self._write_shard(reg_id, reg, pending)
+                self._index_plate(reg_id, old_plate, reg.get("plate"))
+            return _copy(reg)
+
+    def iter_regs(self):
+        for fn in self._shard_files():
+            shard = _load_states(os.path.join(self.folder, fn))
+            if "reg" in shard:
+                yield shard.get("reg_id") or fn[:-len(self.SUFFIX)], _copy(shard["reg"])
+
+    def find_reg_id_by_plate(self, plate):
+        key = _plate_key(plate)
+        if key is None:
+            return None
+        with FileLock(self.index_path + ".lock"):
+            return self._load_index()["plates"].get(key)
+
+    # --- pending ---------------------------------------------------------------------
+
+    def _mutate_pending(self, reg_id: str, factory: RegFactory, fn) -> Any:
+        with self._lock(reg_id):
+            shard = self._read_shard(reg_id)
+            if shard is None:
+                reg = factory()
+                reg.pop("pending_interests", None)
+                pending = []
+                self._index_plate(reg_id, None, reg.get("plate"))
+            else:
+                reg, pending = shard["reg"], shard.get("pending_interests", [])
+            result, pending = fn(pending)
+            self._write_shard(reg_id, reg, pending)
+            return result
+
+    def get_pending(self, reg_id):
+        with self._lock(reg_id):
+            shard = self._read_shard(reg_id)
+        return list(shard.get("pending_interests", [])) if shard else None
+
+    def set_pending(self, reg_id, interests, factory):
+        self._mutate_pending(reg_id, factory, lambda cur: (None, list(interests)))
+
+    def append_pending(self, reg_id, interests, factory):
+        def _append(cur):
+            added = _dedup_append(cur, interests)
+            return added, cur
+        return self._mutate_pending(reg_id, factory, _append)
+
+    def remove_pending(self, reg_id, interest_name, factory):
+        def _remove(cur):
+            left = [it for it in cur if it.get("name") != interest_name]
+            return len(left) != len(cur), left
+        return self._mutate_pending(reg_id, factory, _remove)
+
+    def bulk_write(self, regs, pending):
+        for reg_id in sorted(set(regs) | set(pending)):
+            with self._lock(reg_id):
+                shard = self._read_shard(reg_id)
+                old_reg = shard["reg"] if shard else {}
+                reg = regs.get(reg_id, old_reg)
+                items = pending[reg_id] if reg_id in pending else (shard or {}).get("pending_interests", [])
+                self._write_shard(reg_id, reg, list(items))
+                self._index_plate(reg_id, old_reg.get("plate"), reg.get("plate"))
+
+    # --- импорт ----------------------------------------------------------------------
+
+    def import_states(self, states):
+        regs = (states or {}).get("regs", {})
+        for reg_id, reg in regs.items():
+            reg = dict(reg or {})
+            pending = reg.pop("pending_interests", None) or []
+            with self._lock(reg_id):
+                self._write_shard(reg_id, reg, pending)
+        self.rebuild_index()
+        return len(regs)
+
+    def _auto_import(self, json_path: str) -> None:
+        """Разовая нарезка states.json на шарды (если шардов ещё нет)."""
+        marker = os.path.join(self.folder, ".imported")
+        if os.path.exists(marker) or self._shard_files() or not os.path.exists(json_path):
+            return
+        with FileLock(json_path + ".lock"):
+            states = _load_states(json_path)
+        n = self.import_states(states)
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(json_path)
+        logger.info(f"[STATE] states.json разрезан на шарды: {n} рег. -> {self.folder}")
+
+
+class CachedStateStore(StateStore):
+    """
+    Write-behind кэш поверх любого StateStore.
+
+    Загруженные регистраторы живут в памяти, изменения копятся и сбрасываются во
+    внутреннее хранилище одной пачкой (merge_write — одна транзакция SQLite / одна
+    атомарная перезапись states.json).
+
+    Сбрасывается не запись целиком, а правка: поля, которые мы поменяли относительно
+    последнего прочитанного снимка (_base), и операции над очередью pending
+    (append/remove/set) в порядке выполнения. Они накладываются на то, что лежит в
+    хранилище на момент сброса, под его блокировкой — правки других процессов в
+    других полях и интересах не затираются. После сброса кэш берёт итоговую запись
+    из хранилища (и доигрывает поверх неё то, что успели поменять за время сброса).
+
+    Режимы (durability):
+      - "interval" — фоновый сброс раз в flush_interval секунд: при падении
+                     теряется не более одного интервала изменений;
+      - "shutdown" — сброс только по checkpoint()/close()/выходу процесса
+                     (или по переполнению max_dirty).
+    Чистые записи перечитываются из хранилища не реже раза в ttl секунд, чтобы
+    подхватывать правки из других процессов.
+    """
+
+    def __init__(self, inner: StateStore, durability: str = "interval",
+                 flush_interval: float = 2.0, max_dirty: int = 200, ttl: float = 30.0):
+        self.inner = inner
+        self.durability = durability
+        self.flush_interval = max(0.05, float(flush_interval))
+        self.max_dirty = max(1, int(max_dirty))
+        self.ttl = float(ttl)
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._regs: dict[str, Optional[dict]] = {}       # None — регистратора нет
+        self._base: dict[str, Optional[dict]] = {}       # запись, какой её последний раз видели в хранилище
+        self._pending: dict[str, list[dict]] = {}
+        self._loaded_at: dict[str, float] = {}
+        self._dirty_regs: set[str] = set()
+        self._pending_ops: dict[str, list[tuple]] = {}   # несброшенные операции над pending
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if durability == "interval":
+            self._thread = threading.Thread(target=self._flush_loop, name="state-flush", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    # --- кэш -------------------------------------------------------------------------
+
+    def _is_dirty(self, reg_id: str) -> bool:
+        return reg_id in self._dirty_regs or reg_id in self._pending_ops
+
+    def _load(self, reg_id: str) -> Optional[dict]:
+        now = time.monotonic()
+        if reg_id in self._regs and (self._is_dirty(reg_id) or now - self._loaded_at[reg_id] < self.ttl):
+            return self._regs[reg_id]
+        reg = self.inner.get_reg(reg_id)
+        self._regs[reg_id] = reg
+        self._base[reg_id] = _copy(reg)
+        self._pending[reg_id] = (self.inner.get_pending(reg_id) or []) if reg is not None else []
+        self._loaded_at[reg_id] = now
+        return reg
+
+    def _load_or_create(self, reg_id: str, factory: RegFactory) -> dict:
+        reg = self._load(reg_id)
+        if reg is None:
+            reg = factory()
+            reg.pop("pending_interests", None)
+            self._regs[reg_id] = reg
+            self._pending[reg_id] = []
+            self._mark(reg_id, reg=True)
+        return reg
+
+    def _mark(self, reg_id: str, reg: bool = False, op: Optional[tuple] = None) -> None:
+        if reg:
+            self._dirty_regs.add(reg_id)
+        if op is not None:
+            self._pending_ops.setdefault(reg_id, []).append(op)
+        if len(self._dirty_regs) + len(self._pending_ops) >= self.max_dirty:
+            if self._thread is not None:
+                self._wakeup.set()
+            elif not self._flush_lock.locked():
+                # без фонового потока сбрасываем сами, но не под локом кэша
+                threading.Thread(target=self.checkpoint, name="state-flush-now", daemon=True).start()
+
+    # --- интерфейс StateStore ---------------------------------------------------------
+
+    def get_reg(self, reg_id):
+        with self._lock:
+            reg = self._load(reg_id)
+            return _copy(reg) if reg is not None else None
+
+    def update_reg(self, reg_id, mutator, factory):
+        with self._lock:
+            reg = self._load(reg_id)
+            created = reg is None
+            if created:
+                reg = factory()
+                reg.pop("pending_interests", None)
+            if mutator(reg, created):
+                if created:
+                    self._regs[reg_id] = reg
+                    self._pending[reg_id] = []
+                self._mark(reg_id, reg=True)
+            return _copy(reg)
+
+    def iter_regs(self):
+        # перечисление всего парка — редкая операция: сбрасываем хвост и читаем хранилище
+        self.checkpoint()
+        return self.inner.iter_regs()
+
+    def find_reg_id_by_plate(self, plate):
+        with self._lock:
+            for reg_id, reg in self._regs.items():
+                if reg is not None and self._is_dirty(reg_id) and \
+                        _plate_key(reg.get("plate")) == _plate_key(plate):
+                    return reg_id
+        return self.inner.find_reg_id_by_plate(plate)
+
+    def get_pending(self, reg_id):
+        with self._lock:
+            if self._load(reg_id) is None:
+                return None
+            return _copy(self._pending.get(reg_id, []))
+
+    def set_pending(self, reg_id, interests, factory):
+        interests = _copy(list(interests))
+        with self._lock:
+            self._load_or_create(reg_id, factory)
+            self._pending[reg_id] = interests
+            self._mark(reg_id, op=("set", _copy(interests)))
+
+    def append_pending(self, reg_id, interests, factory):
+        interests = _copy(list(interests))
+        with self._lock:
+            self._load_or_create(reg_id, factory)
+            added = _dedup_append(self._pending.setdefault(reg_id, []), interests)
+            if added:
+                self._mark(reg_id, op=("append", interests))
+            return added
+
+    def remove_pending(self, reg_id, interest_name, factory):
+        with self._lock:
+            self._load_or_create(reg_id, factory)
+            cur = self._pending.get(reg_id, [])
+            left = [it for it in cur if it.get("name") != interest_name]
+            if len(left) == len(cur):
+                return False
+            self._pending[reg_id] = left
+            self._mark(reg_id, op=("remove", interest_name))
+            return True
+
+    def bulk_write(self, regs, pending):
+        with self._lock:
+            for reg_id, reg in regs.items():
+                self._load(reg_id)
+                reg = _copy(reg)
+                reg.pop("pending_interests", None)
+                self._regs[reg_id] = reg
+                self._pending.setdefault(reg_id, [])
+                self._mark(reg_id, reg=True)
+            for reg_id, items in pending.items():
+                self._load(reg_id)
+                self._pending[reg_id] = _copy(list(items))
+                self._mark(reg_id, op=("set", _copy(list(items))))
+
+    def import_states(self, states):
+        self.checkpoint()
+        n = self.inner.import_states(states)
+        with self._lock:
+            self._regs.clear()
+            self._base.clear()
+            self._pending.clear()
+            self._loaded_at.clear()
+        return n
+
+    def export_states(self):
+        self.checkpoint()
+        return self.inner.export_states()
+
+    # --- сброс -----------------------------------------------------------------------
+
+    def checkpoint(self) -> None:
+        """Синхронно наложить все несброшенные правки на хранилище одной пачкой."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty_regs and not self._pending_ops:
+                    return
+                sent = {rid: _copy(self._regs[rid]) for rid in self._dirty_regs
+                        if self._regs.get(rid) is not None}
+                changes = {rid: _diff(self._base.get(rid), reg) for rid, reg in sent.items()}
+                ops = self._pending_ops
+                dirty_regs = self._dirty_regs
+                self._dirty_regs, self._pending_ops = set(), {}
+            try:
+                result = self.inner.merge_write(changes, ops)
+            except Exception as e:
+                # вернём правки — наложим в следующий раз (раньше тех, что успели появиться)
+                with self._lock:
+                    self._dirty_regs |= dirty_regs
+                    for rid, rid_ops in ops.items():
+                        self._pending_ops[rid] = rid_ops + self._pending_ops.get(rid, [])
+                logger.error(f"[STATE] Не удалось сбросить состояние ({len(changes)} рег., "
+                             f"{len(ops)} очередей pending): {e}")
+                raise
+            with self._lock:
+                now = time.monotonic()
+                for rid, (fresh, fresh_pending) in result.items():
+                    local = self._regs.get(rid)
+                    if rid in self._dirty_regs and local is not None:
+                        # за время сброса запись снова поменяли — доиграем эти правки поверх
+                        reg = _copy(fresh) if fresh is not None else {}
+                        _apply_fields(reg, _diff(sent.get(rid, self._base.get(rid)), local))
+                    else:
+                        reg = _copy(fresh)
+                    queue = _copy(fresh_pending)
+                    for op in self._pending_ops.get(rid, []):
+                        queue = _apply_pending_op(queue, op)
+                    self._regs[rid] = reg
+                    self._base[rid] = _copy(fresh)
+                    self._pending[rid] = queue
+                    self._loaded_at[rid] = now
+            logger.debug(f"[STATE] Сброшено: {len(changes)} рег., {len(ops)} очередей pending")
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.checkpoint()
+            except Exception:
+                pass
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5.0)
+        try:
+            self.checkpoint()
+        finally:
+            self.inner.close()
+            try:
+                atexit.unregister(self.close)
+            except Exception:
+                pass
+
+
+def _sqlite_path() -> str:
+    path = settings.config.get("State", "SQLITE_PATH", fallback="states.sqlite3")
+    return path if os.path.isabs(path) else os.path.join(settings.DATA_FOLDER, path)
+
+
+def _shards_folder() -> str:
+    path = settings.config.get("State", "SHARDS_FOLDER", fallback="states")
+    return path if os.path.isabs(path) else os.path.join(settings.DATA_FOLDER, path)
+
+
+_BACKENDS = ("json", "sharded", "sqlite")
+
+
+def _default_path(backend: str) -> str:
+    return {"sqlite": _sqlite_path, "sharded": _shards_folder}.get(backend, lambda: settings.states)()
+
+
+def _open_backend(backend: str, path: str | None = None, import_from: str | None = None) -> StateStore:
+    path = path or _default_path(backend)
+    if backend == "sqlite":
+        return SqliteStateStore(path, import_from=import_from)
+    if backend == "sharded":
+        return ShardedJsonStateStore(path, import_from=import_from)
+    return JsonStateStore(path)
+
+
+def _build_store() -> StateStore:
+    backend = settings.config.get("State", "BACKEND", fallback="json").strip().lower()
+    if backend not in _BACKENDS:
+        logger.warning(f"[STATE] Неизвестный BACKEND={backend!r}, используем json")
+        backend = "json"
+    store = _open_backend(backend, import_from=settings.states)
+    if backend != "json" and os.path.exists(settings.states):
+        # states.json импортируется один раз; дальше его правки молча терялись бы
+        logger.warning(
+            f"[STATE] BACKEND={backend}: состояние хранится в {_default_path(backend)}, "
+            f"правки {settings.states} НЕ подхватываются. Чтобы применить их: "
+            f"python -m qt_pvp.state_store import --backend {backend}")
+
+    durability = settings.config.get("State", "DURABILITY", fallback="strict").strip().lower()
+    if durability in ("interval", "shutdown"):
+        store = CachedStateStore(
+            store,
+            durability=durability,
+            flush_interval=settings.config.getfloat("State", "FLUSH_INTERVAL_SEC", fallback=2.0),
+            max_dirty=settings.config.getint("State", "MAX_DIRTY_REGS", fallback=200),
+            ttl=settings.config.getfloat("State", "CACHE_TTL_SEC", fallback=30.0),
+        )
+    elif durability != "strict":
+        logger.warning(f"[STATE] Неизвестный DURABILITY={durability!r}, используем strict")
+    return store
+
+
+_store: StateStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> StateStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _build_store()
+    return _store
+
+
+def checkpoint() -> None:
+    """Сбросить отложенные изменения текущего хранилища (если оно уже создано)."""
+    if _store is not None:
+        _store.checkpoint()
+
+
+def set_store(store: StateStore | None) -> None:
+    """Подменить глобальное хранилище (тесты, утилиты миграции)."""
+    global _store
+    with _store_lock:
+        if _store is not None and _store is not store:
+            _store.close()
+        _store = store
+
+
+def main(argv=None) -> int:
+    import argparse
+    default_backend = settings.config.get("State", "BACKEND", fallback="json").strip().lower()
+    if default_backend not in _BACKENDS:
+        default_backend = "json"
+    parser = argparse.ArgumentParser(prog="python -m qt_pvp.state_store")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    imp = sub.add_parser("import", help="Импорт states.json в хранилище (BACKEND из config.cfg)")
+    imp.add_argument("--src", default=settings.states)
+    exp = sub.add_parser("export", help="Выгрузка хранилища в формат states.json")
+    exp.add_argument("--dst", required=True)
+    for p in (imp, exp):
+        p.add_argument("--backend", choices=_BACKENDS, default=default_backend)
+        p.add_argument("--db", "--path", dest="path", default=None,
+                       help="Файл базы / папка шардов / states.json (по умолчанию — из config.cfg)")
+    args = parser.parse_args(argv)
+
+    target = args.path or _default_path(args.backend)
+    store = _open_backend(args.backend, target)
+    try:
+        if args.cmd == "import":
+            if args.backend == "json" and os.path.abspath(args.src) == os.path.abspath(target):
+                print(f"BACKEND=json уже читает {target} — импорт не нужен")
+                return 0
+            with FileLock(args.src + ".lock"):
+                states = _load_states(args.src)
+            n = store.import_states(states)
+            print(f"Импортировано регистраторов: {n} -> {target}")
+        else:
+            _atomic_save_states(store.export_states(), args.dst)
+            print(f"Выгружено -> {args.dst}")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,197 @@
+"""
+Поиск остановок регистратора возле площадок (движок /find-stops).
+
+Раньше каждый трек сравнивался с каждой площадкой хаверсином в двойном цикле Python,
+а при закрытии остановки площадка искалась линейным проходом по результатам. Здесь:
+  - треки разбираются один раз в массивы (ts, lat, lon, speed), отсортированные по времени;
+  - до расчёта расстояний остаются только точки стоянки (speed <= порога);
+  - площадки разложены по сетке с ячейкой не меньше радиуса, так что кандидаты точки —
+    площадки из 3×3 соседних ячеек; пары «точка–площадка» собираются searchsorted'ом;
+  - расстояния считаются векторно, серии стоянки у площадки — по разрывам индексов.
+Результат совпадает с прежним автоматом: серия — подряд идущие (среди валидных треков)
+точки стоянки в радиусе площадки, длительность — от первой до последней точки серии,
+от площадки оставляется одна остановка — с ближайшей к ней последней точкой.
+"""
+from typing import Any, Dict, List, Tuple
+from qt_pvp.geo_funcs import EARTH_RADIUS_M, _parse_latlon
+from qt_pvp.logger import logger
+import numpy as np
+import datetime
+import math
+
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def prepare_sites(sites: List[dict], reg_id=None) -> List[Tuple[str, float, float]]:
+    """[(site_id, lat, lon), ...]; площадки с некорректными координатами пропускаются."""
+    prepared: List[Tuple[str, float, float]] = []
+    for idx, raw in enumerate(sites):
+        sid = raw.get("id") or raw.get("site_id") or f"site_{idx}"
+        try:
+            prepared.append((sid, float(raw["lat"]), float(raw["lon"])))
+        except Exception as e:
+            logger.warning(f"{reg_id}: [STOP SEARCH] Пропущена площадка {sid}: некорректные координаты ({e})")
+    return prepared
+
+
+def _parse_times(values: List[str]) -> np.ndarray:
+    """gt -> секунды наивного времени; некорректные строки -> -1."""
+    try:
+        return np.array([v.replace(" ", "T", 1) for v in values], dtype="datetime64[s]").astype(np.int64)
+    except ValueError:
+        out = np.full(len(values), -1, dtype=np.int64)
+        for k, v in enumerate(values):
+            try:
+                out[k] = int((datetime.datetime.strptime(v, TIME_FMT) - _EPOCH).total_seconds())
+            except ValueError:
+                pass
+        return out
+
+
+def track_arrays(tracks: List[dict], reg_id=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Треки CMS -> (ts, lat, lon, speed), отсортированные по времени (устойчиво).
+    Треки без времени/координат или с некорректными значениями отбрасываются.
+    """
+    gts, lat, lon, speed = [], [], [], []
+    for t in tracks:
+        gt, geo = t.get("gt"), t.get("ps")
+        if not gt or not geo or not isinstance(gt, str):
+            continue
+        try:
+            la, lo = _parse_latlon(geo)
+        except Exception:
+            logger.debug(f"{reg_id}: [STOP SEARCH] skip track (bad geo): {t}")
+            continue
+        try:
+            sp = float(t.get("sp") or 0)
+        except Exception:
+            sp = 0.0
+        gts.append(gt)
+        lat.append(la)
+        lon.append(lo)
+        speed.append(sp)
+    ts = _parse_times(gts) if gts else np.zeros(0, dtype=np.int64)
+    ok = ts >= 0
+    order = np.argsort(ts[ok], kind="stable")
+    return (ts[ok][order], np.array(lat, dtype=np.float64)[ok][order],
+            np.array(lon, dtype=np.float64)[ok][order], np.array(speed, dtype=np.float64)[ok][order])
+
+
+def haversine_m(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Векторный хаверсин (градусы -> метры), та же формула, что geo_funcs._haversine_m."""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = np.radians(lat2 - lat1)
+    dlmb = np.radians(lon2 - lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class SiteGrid:
+    """Площадки в сетке с ячейкой не меньше радиуса поиска (по широте и по долготе)."""
+
+    _SHIFT = np.int64(1 << 32)
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, radius_m: float):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.radius_m = radius_m
+        r_deg = math.degrees(max(radius_m, 0.01) / EARTH_RADIUS_M) * 1.01  # с запасом на округления
+        max_abs_lat = min(89.0, float(np.max(np.abs(self.lat))) + r_deg) if len(self.lat) else 0.0
+        self.cell_lat = r_deg
+        self.cell_lon = min(360.0, r_deg / math.cos(math.radians(max_abs_lat)))
+        keys = self._keys(*self._cells(self.lat, self.lon))
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    def _cells(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        return (np.floor(lat / self.cell_lat).astype(np.int64),
+                np.floor(lon / self.cell_lon).astype(np.int64))
+
+    def _keys(self, ci: np.ndarray, cj: np.ndarray) -> np.ndarray:
+        return ci * self._SHIFT + cj
+
+    def within(self, lat: np.ndarray, lon: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Пары (позиция точки, индекс площадки, расстояние) с расстоянием <= radius_m."""
+        ci, cj = self._cells(lat, lon)
+        pos_parts, site_parts = [], []
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                k = self._keys(ci + di, cj + dj)
+                lo = np.searchsorted(self.keys, k, side="left")
+                cnt = np.searchsorted(self.keys, k, side="right") - lo
+                total = int(cnt.sum())
+                if not total:
+                    continue
+                # все площадки ячейки для каждой точки: развёртка диапазонов [lo, lo + cnt)
+                first = np.repeat(lo, cnt)
+                offset = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+                pos_parts.append(np.repeat(np.arange(len(lat)), cnt))
+                site_parts.append(self.order[first + offset])
+        if not pos_parts:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        pos = np.concatenate(pos_parts)
+        site = np.concatenate(site_parts)
+        dist = haversine_m(lat[pos], lon[pos], self.lat[site], self.lon[site])
+        near = dist <= self.radius_m
+        return pos[near], site[near], dist[near]
+
+
+def closest_stops(ts: np.ndarray, lat: np.ndarray, lon: np.ndarray, speed: np.ndarray, grid: SiteGrid,
+                  min_stop_speed: float, min_stop_duration: int) -> Dict[int, dict]:
+    """
+    {индекс площадки: остановка} — для каждой площадки одна остановка длительностью
+    >= min_stop_duration, последняя точка которой ближе всего к площадке.
+    """
+    stopped = np.flatnonzero(speed <= min_stop_speed)
+    pos, site, dist = grid.within(lat[stopped], lon[stopped])
+    if not len(pos):
+        return {}
+    idx = stopped[pos]
+    order = np.lexsort((idx, site))
+    idx, site, dist = idx[order], site[order], dist[order]
+
+    # серия — подряд идущие треки у одной площадки
+    brk = np.ones(len(idx), dtype=bool)
+    brk[1:] = (site[1:] != site[:-1]) | (idx[1:] != idx[:-1] + 1)
+    starts = np.flatnonzero(brk)
+    ends = np.append(starts[1:] - 1, len(idx) - 1)
+    duration = (ts[idx[ends]] - ts[idx[starts]]).astype(np.float64)
+    keep = duration >= min_stop_duration
+    starts, ends, duration = starts[keep], ends[keep], duration[keep]
+    if not len(starts):
+        return {}
+
+    # ближайшая по последней точке; при равенстве — более ранняя
+    run_site, run_dist = site[starts], dist[ends]
+    best = np.lexsort((np.arange(len(starts)), run_dist, run_site))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = run_site[best][1:] != run_site[best][:-1]
+    out: Dict[int, dict] = {}
+    for r in best[first]:
+        out[int(run_site[r])] = {
+            "start": (_EPOCH + datetime.timedelta(seconds=int(ts[idx[starts[r]]]))).strftime(TIME_FMT),
+            "end": (_EPOCH + datetime.timedelta(seconds=int(ts[idx[ends[r]]]))).strftime(TIME_FMT),
+            "duration_sec": float(duration[r]),
+            "distance_m": float(run_dist[r]),
+        }
+    return out
+
+
+def find_stops(tracks: List[dict], sites: List[Tuple[str, float, float]], radius_m: float,
+               min_stop_speed: float, min_stop_duration: int, reg_id=None) -> List[Dict[str, Any]]:
+    """
+    Остановки по трекам CMS у подготовленных площадок (prepare_sites):
+    [{"site_id", "lat", "lon", "stops": [] или [ближайшая остановка]}, ...] в порядке площадок.
+    """
+    results = [{"site_id": sid, "lat": la, "lon": lo, "stops": []} for sid, la, lo in sites]
+    ts, lat, lon, speed = track_arrays(tracks, reg_id)
+    logger.info(f"{reg_id}: [STOP SEARCH] norm_tracks={len(ts)} (after filtering)")
+    if not len(ts) or not sites:
+        return results
+    grid = SiteGrid(np.array([s[1] for s in sites]), np.array([s[2] for s in sites]), radius_m)
+    for k, stop in closest_stops(ts, lat, lon, speed, grid, min_stop_speed, min_stop_duration).items():
+        results[k]["stops"].append(stop)
+    return results
@@ -0,0 +1,46 @@
+from qt_pvp.cms_interface import circuit_breaker as cb
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _breaker(clock):
+    return cb.DeviceBreaker("104039", failure_threshold=3, base_delay=10, max_delay=35, jitter=0, clock=clock)
+
+
+def test_offline_code_opens_immediately_and_probe_closes():
+    clock = _Clock()
+    br = _breaker(clock)
+    br.record_result(32)
+    assert br.allow() == cb.OPEN
+    clock.now = 9.9
+    assert br.allow() == cb.OPEN
+    clock.now = 10
+    assert br.allow() == cb.HALF_OPEN
+    # проба одна: остальные ждут её результата
+    assert br.allow() == cb.OPEN
+    br.record_success()
+    assert br.allow() == cb.CLOSED
+
+
+def test_soft_failures_need_threshold_and_backoff_grows():
+    clock = _Clock()
+    br = _breaker(clock)
+    br.record_result(22)
+    br.record_result(22)
+    assert br.allow() == cb.CLOSED
+    br.record_failure("timeout")
+    assert br.allow() == cb.OPEN
+
+    delays = []
+    for _ in range(3):
+        delays.append(br.open_until - clock.now)
+        clock.now = br.open_until
+        assert br.allow() == cb.HALF_OPEN
+        br.record_failure("probe: device offline")
+    assert delays == [10, 20, 35]
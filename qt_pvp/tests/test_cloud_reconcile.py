@@ -0,0 +1,105 @@
+import os
+
+os.environ.setdefault("webdav_hostname", "http://dav")  # cloud_uploader создаёт клиент WebDAV при импорте
+
+from qt_pvp import cloud_reconcile
+from qt_pvp.data import settings
+from urllib.parse import quote, unquote
+import datetime
+import asyncio
+import random
+import httpx
+import pytest
+
+
+class _Dav:
+    options = {"webdav_hostname": "http://dav", "webdav_login": "u", "webdav_password": "p"}
+
+
+def _name(plate, start, dur):
+    st = datetime.datetime(2025, 3, 1, 6, 0, 0) + datetime.timedelta(seconds=start)
+    en = st + datetime.timedelta(seconds=dur)
+    return f"{plate}_{st.strftime('%Y.%m.%d %H.%M.%S')}-{en.strftime('%H.%M.%S')}"
+
+
+def _brute_force(expected, detected, eps):
+    """Прежний попарный diff_sets: сначала совпадающие имена, затем фаззи."""
+    new, missing = set(detected) - set(expected), set(expected) - set(detected)
+    for e in sorted(missing):
+        _, s1, e1 = cloud_reconcile.main_funcs._interest_name_to_interval(e)
+        for d in sorted(new):
+            p2, s2, e2 = cloud_reconcile.main_funcs._interest_name_to_interval(d)
+            if p2 == e.split("_")[0] and abs((s1 - s2).total_seconds()) <= eps and abs((e1 - e2).total_seconds()) <= eps:
+                new.discard(d)
+                missing.discard(e)
+                break
+    return new, missing
+
+
+def test_sweep_diff_matches_pairwise_on_separated_intervals():
+    rnd = random.Random(3)
+    # интервалы разнесены больше чем на 2*eps — пара у каждого имени единственная
+    starts = rnd.sample(range(0, 20000, 100), 60)
+    cloud = {_name(rnd.choice("AB"), s, 60) for s in starts[:40]}
+    found = {_name(n.split("_")[0], s + rnd.randint(-20, 20), 60 + rnd.randint(-5, 5))
+             for n, s in zip(sorted(cloud), sorted(starts[:40]))}
+    found |= {_name("A", s, 60) for s in starts[40:]}
+    assert cloud_reconcile.diff_names(cloud, found, 30) == _brute_force(cloud, found, 30)
+    assert cloud_reconcile.diff_names(cloud, found, 0) == (found - cloud, cloud - found)
+
+
+def _multistatus(folder, names):
+    items = [folder] + [f"{folder}/{n}" for n in names]
+    body = "".join(
+        f"<d:response><d:href>{quote(p)}/</d:href><d:propstat><d:prop><d:resourcetype><d:collection/>"
+        f"</d:resourcetype></d:prop></d:propstat></d:response>" for p in items)
+    return f'<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{body}</d:multistatus>'
+
+
+@pytest.fixture
+def dav(monkeypatch):
+    day = f"{settings.CLOUD_PATH}/A001AA/2025.03.01"
+    state = {"names": [_name("A001AA", 0, 60), _name("A001AA", 600, 60)], "deleted": []}
+
+    def handler(request):
+        path = unquote(request.url.path).rstrip("/")
+        if request.method == "PROPFIND":
+            if path != day:
+                return httpx.Response(404)
+            return httpx.Response(207, content=_multistatus(day, state["names"]))
+        if request.method == "DELETE":
+            state["deleted"].append(path.rsplit("/", 1)[-1])
+            return httpx.Response(204)
+        return httpx.Response(405)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(cloud_reconcile, "get_http_client", lambda: client)
+    return state
+
+
+def _run(dry_run):
+    added = []
+
+    async def add(items):
+        added.extend(i["name"] for i in items)
+
+    detected = [{"name": _name("A001AA", 0, 60)}, {"name": _name("A001AA", 1200, 60)}]
+    report = asyncio.run(cloud_reconcile.reconcile(
+        "r1", "A001AA", detected,
+        datetime.datetime(2025, 3, 1, 5, 0, 0), datetime.datetime(2025, 3, 2, 0, 30, 0),
+        add, client=_Dav(), dry_run=dry_run))
+    return report, added
+
+
+def test_reconcile_adds_new_and_deletes_stale(dav):
+    report, added = _run(dry_run=False)
+    assert added == [_name("A001AA", 1200, 60)]
+    assert dav["deleted"] == [_name("A001AA", 600, 60)]
+    assert report.deleted == [_name("A001AA", 600, 60)] and not report.failed
+
+
+def test_dry_run_only_reports(dav):
+    report, added = _run(dry_run=True)
+    assert added == [] and dav["deleted"] == []
+    assert report.to_add == [_name("A001AA", 1200, 60)]
+    assert report.to_delete == [_name("A001AA", 600, 60)]
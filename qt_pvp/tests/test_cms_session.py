@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from qt_pvp.cms_interface import functions
+from qt_pvp.cms_interface import session as cms_session
+from qt_pvp.cms_interface import cms_api
+
+
+class _LoginResponse:
+    def __init__(self, jsession):
+        self._jsession = jsession
+
+    def json(self):
+        return {"result": 0, "jsession": self._jsession}
+
+
+@pytest.fixture
+def logins(monkeypatch):
+    calls = []
+
+    async def fake_login():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return _LoginResponse(f"S{len(calls)}")
+
+    monkeypatch.setattr(cms_api, "login", fake_login)
+    cms_session.set_manager(cms_session.CMSSessionManager())
+    yield calls
+    cms_session.set_manager(None)
+
+
+def test_expired_session_relogins_once_and_retries(logins):
+    seen = []
+
+    @functions.cms_data_get_decorator_async(return_json=True, delay=0)
+    async def query(jsession, device_id):
+        seen.append(jsession)
+        if jsession == "S1":
+            return {"result": 5}
+        return {"result": 0, "device": device_id}
+
+    async def scenario():
+        manager = cms_session.get_manager()
+        first = await manager.get()
+        results = await asyncio.gather(*(query(first, n) for n in range(5)))
+        assert [r["device"] for r in results] == list(range(5))
+        # пять одновременных «сессия истекла» — один перелогин
+        assert len(logins) == 2
+        # старый jsession подменяется без похода в CMS
+        assert await query(first, device_id=9) == {"result": 0, "device": 9}
+        assert seen[-1] == "S2"
+        assert len(logins) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,42 @@
+from qt_pvp.interests_search import detection_params
+from qt_pvp.data import settings
+import configparser
+import dataclasses
+import os
+import pytest
+
+
+def test_reg_overrides_on_top_of_config():
+    base = detection_params.DetectionParams.from_config(settings.config)
+    reg = base.for_reg({"euro_container_alarm": "2", "kgo_container_alarm": 3,
+                        "interest_kgo_before_shift_sec": 40, "photo_after_shift_sec": "x"})
+
+    assert (reg.euro_alarm, reg.kgo_alarm, reg.kgo_before_shift) == (2, 3, 40)
+    # нечисловое значение не ломает проход — остаётся значение из конфига
+    assert reg.photo_after_shift == base.photo_after_shift
+    assert reg.min_stop_speed == base.min_stop_speed
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        reg.min_stop_speed = 0
+
+
+def test_config_change_is_picked_up_by_mtime(tmp_path, monkeypatch):
+    path = tmp_path / "config.cfg"
+    with open(settings.CONFIG_PATH, encoding="utf-8") as f:
+        text = f.read()
+    path.write_text(text, encoding="utf-8")
+    cfg = configparser.ConfigParser(inline_comment_prefixes="#", allow_no_value=True)
+    cfg.read(path, encoding="utf-8")
+    monkeypatch.setattr(settings, "CONFIG_PATH", str(path))
+    monkeypatch.setattr(settings, "config", cfg)
+    monkeypatch.setattr(detection_params, "_snapshot", None)
+
+    first = detection_params.current()
+    assert detection_params.current() is first
+
+    path.write_text(text.replace("MIN_STOP_SPEED = 3 ", "MIN_STOP_SPEED = 7 "), encoding="utf-8")
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 5))
+
+    assert detection_params.current().min_stop_speed == 7
+    # глобальный конфиг не перечитывается из рабочих потоков
+    assert cfg.getint("Interests", "MIN_STOP_SPEED") == 3
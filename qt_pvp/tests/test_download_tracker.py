@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from qt_pvp.cms_interface import download_tracker as dt
+from qt_pvp.cms_interface import cms_api
+
+
+def _tracker(responses, **kw):
+    polls = []
+
+    async def poll(jsession, url, reg_id):
+        polls.append(url)
+        return responses[url](sum(1 for u in polls if u == url))
+
+    params = dict(min_interval=0.01, max_interval=0.08, backoff=2.0, max_concurrent_polls=2)
+    params.update(kw)
+    return dt.DownloadTracker(poll=poll, **params), polls
+
+
+def test_tasks_share_scheduler_and_back_off_without_progress():
+    async def scenario():
+        tracker, polls = _tracker({
+            # ответ не меняется, пока не будет готово
+            "slow": lambda n: {"result": 11, "oldTaskAll": {"dph": "/v/slow.mp4"}} if n >= 6
+            else {"result": 0, "oldTaskAll": {"st": 1}},
+            "fast": lambda n: {"result": 11, "oldTaskAll": {"dph": "/v/fast.mp4"}} if n >= 2
+            else {"result": 0, "oldTaskAll": {}},
+        })
+        results = await asyncio.gather(
+            tracker.wait("js", "slow", "1"),
+            tracker.wait("js", "slow", "1"),     # тот же DownTaskUrl — общий future
+            tracker.wait("js", "fast", "1"),
+        )
+        assert results == ["/v/slow.mp4", "/v/slow.mp4", "/v/fast.mp4"]
+        assert polls.count("slow") == 6
+        assert polls.count("fast") == 2
+
+    asyncio.run(scenario())
+
+
+def test_offline_and_timeout_resolve_waiters():
+    async def scenario():
+        tracker, _ = _tracker({
+            "off": lambda n: {"result": 32},
+            "never": lambda n: {"result": 0},
+        })
+        with pytest.raises(cms_api.DeviceOfflineError):
+            await tracker.wait("js", "off", "2")
+        with pytest.raises(TimeoutError):
+            await tracker.wait("js", "never", "2", timeout=0.1)
+        assert tracker.snapshot()["tasks"] == 0
+
+    asyncio.run(scenario())
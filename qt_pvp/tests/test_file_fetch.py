@@ -0,0 +1,44 @@
+import asyncio
+import httpx
+import pytest
+from qt_pvp.cms_interface import file_fetch
+from qt_pvp.cms_interface import cms_http
+from qt_pvp.cms_interface import retry_policy
+
+PAYLOAD = b"0123456789" * 100
+
+
+@pytest.fixture
+def server(monkeypatch):
+    ranges = []
+
+    def handler(request):
+        rng = request.headers.get("Range")
+        ranges.append(rng)
+        if rng is None:
+            # обрыв: заявлен весь файл, отдана только часть
+            return httpx.Response(200, headers={"Content-Length": str(len(PAYLOAD))}, content=PAYLOAD[:300])
+        start = int(rng.split("=")[1].rstrip("-"))
+        body = PAYLOAD[start:]
+        return httpx.Response(206, content=body, headers={
+            "Content-Range": f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}",
+            "Content-Length": str(len(body))})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(cms_http, "get_cms_async_client", lambda: client)
+    return ranges
+
+
+def test_resumes_with_range_after_interruption(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(retry_policy.RetryPolicy, "backoff", lambda self, attempt: 0.0)
+    dest = tmp_path / "ch0.mp4"
+    path = asyncio.run(file_fetch.fetch_file("http://cms:6604/f", str(dest), expected_size=len(PAYLOAD)))
+    assert path == str(dest)
+    assert dest.read_bytes() == PAYLOAD
+    assert not (tmp_path / "ch0.mp4.part").exists()
+    assert server == [None, "bytes=300-"]
+
+
+def test_local_mode_returns_cms_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(file_fetch, "fetch_mode", lambda: "local")
+    assert asyncio.run(file_fetch.materialize("/cms/video.mp4", "js", str(tmp_path))) == "/cms/video.mp4"
@@ -0,0 +1,60 @@
+from qt_pvp.cms_interface import cms_api
+from qt_pvp.data import settings
+import asyncio
+import pytest
+
+INTEREST = {
+    "name": "A001AA_2025.03.01 06.00.00-06.20.00",
+    "start_time": "2025-03-01 06:00:00",
+    "end_time": "2025-03-01 06:20:00",
+    # кадр ПОСЛЕ сдвинут от конца (PHOTO_AFTER_SHIFT_SEC), но из клипа берётся последний кадр файла
+    "photo_before_timestamp": "2025-03-01 06:00:00",
+    "photo_after_timestamp": "2025-03-01 06:19:40",
+}
+
+
+@pytest.fixture
+def cms(monkeypatch, tmp_path):
+    requests, merged = [], []
+
+    async def download_video(jsession, reg_id, channel_id, year, month, day, start_sec, end_sec, **kwargs):
+        requests.append((channel_id, start_sec, end_sec))
+        return [str(tmp_path / f"ch{channel_id}_{start_sec}.mp4")]
+
+    monkeypatch.setattr(cms_api, "download_video", download_video)
+    monkeypatch.setattr(cms_api.core_funcs, "concatenate_videos", lambda paths, out, *a: merged.append(paths))
+    monkeypatch.setattr(cms_api, "frame_only_window_sec", lambda: 5)
+    monkeypatch.setattr(settings, "TEMP_FOLDER", str(tmp_path))
+    return requests, merged
+
+
+def test_only_primary_channel_downloads_full_clip(cms):
+    requests, merged = cms
+    out = asyncio.run(cms_api.download_single_clip_per_channel(
+        "js", "r1", INTEREST, channels=[0, 1, 2], frame_only_channels=[1, 2]))
+
+    full = (6 * 3600, 6 * 3600 + 1200)
+    assert sorted(requests) == sorted([
+        (0, *full),
+        (1, 6 * 3600, 6 * 3600 + 5), (1, 6 * 3600 + 1195, 6 * 3600 + 1200),
+        (2, 6 * 3600, 6 * 3600 + 5), (2, 6 * 3600 + 1195, 6 * 3600 + 1200),
+    ])
+    # два окна канала склеиваются в один файл: первый кадр — ДО, последний — ПОСЛЕ
+    assert out[1]["path"].endswith("ch1_merged.mp4") and len(merged) == 2
+    assert out[0]["path"].endswith(f"ch0_{full[0]}.mp4")
+
+
+def test_frame_windows_edges_match_full_clip(cms):
+    requests, _ = cms
+    asyncio.run(cms_api.download_single_clip_per_channel(
+        "js", "r1", INTEREST, channels=[0, 1], frame_only_channels=[1]))
+    # первый кадр первого окна и последний кадр последнего — там же, где у полного клипа
+    full = [(s, e) for ch, s, e in requests if ch == 0]
+    windows = sorted((s, e) for ch, s, e in requests if ch == 1)
+    assert (windows[0][0], windows[-1][1]) == (full[0][0], full[-1][1])
+
+
+def test_close_frames_share_one_window():
+    short = dict(INTEREST, end_time="2025-03-01 06:00:08")
+    windows = cms_api.frame_windows(short, 5)
+    assert [(a.strftime("%H:%M:%S"), b.strftime("%H:%M:%S")) for a, b in windows] == [("06:00:00", "06:00:08")]
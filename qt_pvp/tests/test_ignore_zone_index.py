@@ -0,0 +1,34 @@
+from qt_pvp import geo_funcs
+import json
+import os
+import random
+
+
+def test_index_matches_linear_search():
+    rnd = random.Random(3)
+    points = [{"name": f"p{k}", "geo": f"{53.6 + rnd.random() * 0.1:.6f},{55.9 + rnd.random() * 0.1:.6f}"}
+              for k in range(2000)]
+    points.append({"name": "битая", "geo": "нет координат"})
+    index = geo_funcs.IgnoreZoneIndex(points)
+    assert len(index) == 2000
+
+    for _ in range(100):
+        geo = f"{53.6 + rnd.random() * 0.1:.6f},{55.9 + rnd.random() * 0.1:.6f}"
+        for tolerance in (50, 300, 5000):
+            assert index.nearest_name(geo, tolerance) == geo_funcs.find_nearby_name(geo, points[:-1], tolerance)
+
+
+def test_index_reloads_on_file_change(tmp_path):
+    path = tmp_path / "ignore_points.json"
+    path.write_text(json.dumps({"ignore_points": [{"name": "ДЕПО", "geo": "53.650170, 55.976258"}]}))
+    first = geo_funcs.get_ignore_index(str(path))
+    assert geo_funcs.get_ignore_index(str(path)) is first
+    assert first.nearest_name("53.650200,55.976258", 50) == "ДЕПО"
+
+    path.write_text(json.dumps({"ignore_points": [{"name": "МПЗ", "geo": "53.477097,56.037945"}]}))
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 5))
+
+    reloaded = geo_funcs.get_ignore_index(str(path))
+    assert reloaded.nearest_name("53.650200,55.976258", 50) is None
+    assert reloaded.nearest_name("53.477097,56.037945", 50) == "МПЗ"
@@ -0,0 +1,106 @@
+from qt_pvp.interests_search.incremental import IncrementalInterestDetector
+from qt_pvp.interests_search import incremental
+from qt_pvp.cms_interface import functions as cms_funcs
+from qt_pvp import geo_funcs
+import datetime
+import pytest
+
+EURO = 1 << 23
+FMT = "%Y-%m-%d %H:%M:%S"
+
+
+@pytest.fixture(autouse=True)
+def _no_ignore_points(monkeypatch):
+    monkeypatch.setattr(geo_funcs, "get_ignore_index", lambda: geo_funcs.IgnoreZoneIndex([]))
+    monkeypatch.setattr(cms_funcs, "get_reg_info", lambda reg_id: {})
+
+
+def _day(bit=EURO):
+    """
+    Три погрузки: стоим, концевик, уезжаем; между ними — езда. Треки моложе 30 минут,
+    так что погрузка на хвосте порции считается незавершённой.
+    """
+    t = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(minutes=25)
+    rows = []
+
+    def add(seconds, sp, s1=0):
+        nonlocal t
+        for _ in range(seconds):
+            rows.append({"gt": t.strftime(FMT), "sp": sp, "s1": s1, "vid": "A001AA", "ps": "55.0,37.0"})
+            t += datetime.timedelta(seconds=1)
+
+    add(120, 40)
+    for _ in range(3):
+        add(60, 0)
+        add(20, 0, bit)
+        add(30, 0)
+        add(300, 40)
+    return rows
+
+
+def _names(interests):
+    return sorted(i["name"] for i in interests)
+
+
+def test_one_shot_detection_applies_reg_overrides(monkeypatch):
+    # концевик на тревожном входе 2 (бит 21) — виден, только если это указано у регистратора
+    tracks = _day(bit=1 << 21)
+    assert cms_funcs.find_interests_by_lifting_switches(tracks=tracks, reg_id="r1")["interests"] == []
+    monkeypatch.setattr(cms_funcs, "get_reg_info", lambda reg_id: {"euro_container_alarm": 2})
+    assert len(cms_funcs.find_interests_by_lifting_switches(tracks=tracks, reg_id="r1")["interests"]) == 3
+
+
+def test_chunked_feed_matches_one_shot_detection(monkeypatch):
+    # короткая история, чтобы за 22 минуты треков буфер успел обрезаться
+    monkeypatch.setattr(incremental, "history_sec", lambda: 300)
+    tracks = _day()
+    expected = cms_funcs.find_interests_by_lifting_switches(tracks=tracks, reg_id="r1")["interests"]
+    assert len(expected) == 3
+
+    detector = IncrementalInterestDetector("r1")
+    detector.reset(tracks[0]["gt"])
+    found, in_progress_seen = [], False
+    # порции режут погрузки посередине
+    for a in range(0, len(tracks), 97):
+        chunk = tracks[a:a + 97]
+        detector.extend(chunk, [], chunk[-1]["gt"])
+        result = detector.detect({"euro_container_alarm": 4})
+        assert not result.need_history
+        in_progress_seen |= result.in_progress
+        found.extend(result.interests)
+
+    assert in_progress_seen
+    assert _names(found) == _names(expected)
+    # буфер не растёт: держим только историю для поиска остановки и неразобранный хвост
+    assert len(detector.tracks) <= 300 + 97
+
+
+def test_window_outside_buffer_resets():
+    tracks = _day()
+    detector = IncrementalInterestDetector("r1")
+    detector.reset(tracks[0]["gt"])
+    detector.extend(tracks[:500], [], tracks[499]["gt"])
+
+    assert detector.continues(tracks[200]["gt"])
+    assert detector.fetch_from() == tracks[500]["gt"]
+    assert not detector.continues(tracks[600]["gt"])
+
+
+def test_history_is_fetched_with_window_and_topped_up_by_prefix(monkeypatch):
+    tracks = _day()
+    start = tracks[600]["gt"]
+    detector = IncrementalInterestDetector("r1")
+    detector.reset(start)
+    # окно качается одним запросом вместе с историей перед ним
+    assert detector.fetch_from() == incremental._shift(start, -incremental.lookback_pad_sec())
+    assert detector.missing_history() is None
+
+    monkeypatch.setattr(incremental, "lookback_pad_sec", lambda: 100)
+    monkeypatch.setattr(incremental, "history_sec", lambda: 300)
+    detector.reset(start)
+    detector.extend(tracks[500:], [], tracks[-1]["gt"])
+    # запаса не хватило — догружается только недостающий кусок перед буфером
+    assert detector.missing_history() == (tracks[300]["gt"], tracks[499]["gt"])
+    detector.prepend(tracks[:500], [], tracks[300]["gt"])
+    assert detector.missing_history() is None
+    assert detector.tracks == tracks
@@ -0,0 +1,61 @@
+from qt_pvp.interest_merge_funcs import InterestIntervalSet, merge_overlapping_interests
+import datetime
+import random
+
+FMT = "%Y-%m-%d %H:%M:%S"
+T0 = datetime.datetime(2025, 3, 1, 6, 0, 0)
+
+
+def _interest(start_sec, dur, reg_id="r1"):
+    st = T0 + datetime.timedelta(seconds=start_sec)
+    en = st + datetime.timedelta(seconds=dur)
+    return {
+        "reg_id": reg_id,
+        "car_number": "A001AA",
+        "year": st.year, "month": st.month, "day": st.day,
+        "start_time": st.strftime(FMT),
+        "end_time": en.strftime(FMT),
+        "name": "x",
+        "report": {"switch_events": [{"datetime": st.strftime(FMT), "switch": 1, "source": "track"}]},
+    }
+
+
+def _random_interests(rnd, n=60):
+    return [_interest(rnd.randint(0, 3600), rnd.randint(0, 120)) for _ in range(n)]
+
+
+def _key(interests):
+    return [(i["name"], i["start_time"], i["end_time"], i["report"]["switch_events"]) for i in interests]
+
+
+def test_any_insertion_order_matches_whole_list_merge():
+    rnd = random.Random(7)
+    for _ in range(20):
+        interests = _random_interests(rnd)
+        expected = merge_overlapping_interests(interests)
+        shuffled = interests[:]
+        rnd.shuffle(shuffled)
+        interest_set = InterestIntervalSet(eps=1.0)
+        for it in shuffled:
+            interest_set.add(it)
+        assert _key(interest_set.to_list()) == _key(expected)
+
+
+def test_touching_interests_merge_with_switch_events():
+    interest_set = InterestIntervalSet([_interest(0, 10), _interest(100, 10)], eps=1.0)
+    assert len(interest_set) == 2
+    # зазор в 1 с — в пределах допуска, и мост между двумя интервалами
+    interest_set.add(_interest(11, 88))
+    assert len(interest_set) == 1
+    merged, = interest_set.to_list()
+    assert (merged["start_time"], merged["end_time"]) == ("2025-03-01 06:00:00", "2025-03-01 06:01:50")
+    assert merged["report"]["switches_amount"] == 3
+    assert merged["name"] == "A001AA_2025.03.01 06.00.00-06.01.50"
+
+
+def test_oldest_and_range_queries():
+    interest_set = InterestIntervalSet([_interest(s, 30) for s in (600, 0, 300, 900)], eps=1.0)
+    assert [i["start_time"][-8:] for i in interest_set.oldest(2)] == ["06:00:00", "06:05:00"]
+    found = interest_set.between(T0 + datetime.timedelta(seconds=320), T0 + datetime.timedelta(seconds=600))
+    assert [i["start_time"][-8:] for i in found] == ["06:05:00", "06:10:00"]
+    assert interest_set.between(T0 + datetime.timedelta(seconds=40), T0 + datetime.timedelta(seconds=200)) == []
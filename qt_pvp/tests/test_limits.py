@@ -0,0 +1,102 @@
+import asyncio
+from qt_pvp.cms_interface import limits
+
+
+def _limiter(**kw):
+    params = dict(initial=2, min_limit=1, max_limit=6, window=10,
+                  p95_tolerance=2.0, retry_rate_max=0.1, decrease_factor=0.5)
+    params.update(kw)
+    return limits.AdaptiveLimiter("test", **params)
+
+
+def test_blocks_at_limit_and_wakes_in_order():
+    async def scenario():
+        lim = _limiter(initial=1, max_limit=1)
+        order = []
+
+        async def job(n):
+            async with lim:
+                order.append(n)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(job(n) for n in range(3)))
+        assert order == [0, 1, 2]
+        assert lim.snapshot()["inflight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        lim = _limiter(initial=1, max_limit=1)
+        await lim.acquire()
+        waiter = asyncio.ensure_future(lim.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        lim.release()
+        assert lim.snapshot()["inflight"] == 0
+        assert lim.snapshot()["waiting"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_grows_when_saturated_and_healthy():
+    lim = _limiter()
+    for _ in range(6):
+        lim._saturated = True
+        for _ in range(10):
+            lim.record(0.1)
+    assert lim.snapshot()["limit"] == 6
+
+
+def test_shrinks_on_latency_or_retries():
+    lim = _limiter(initial=6)
+    for _ in range(10):
+        lim.record(0.1)
+    for _ in range(5):
+        lim.record(1.0)
+    assert lim.snapshot()["limit"] == 3
+    # замеры до снижения повторно не учитываются
+    assert lim.snapshot()["samples"] == 0
+
+    lim = _limiter(initial=6)
+    for _ in range(5):
+        lim.record(0.1)
+        lim.record_retry()
+    assert lim.snapshot()["limit"] == 3
+
+
+def test_cms_result_is_reported_to_measured_limiters():
+    async def scenario():
+        lim = _limiter()
+        limits.begin_cms_call()
+        async with lim:
+            with limits.measure_cms_request():
+                pass
+        limits.report_cms_result(22)
+        assert lim.retry_rate() == 1.0
+
+    asyncio.run(scenario())
+
+
+def test_latency_excludes_waiting_for_inner_limiter():
+    async def scenario():
+        outer, inner = _limiter(initial=2), _limiter(initial=1, max_limit=1)
+        await inner.acquire()
+
+        async def request():
+            async with outer:
+                async with inner:
+                    with limits.measure_cms_request():
+                        await asyncio.sleep(0.01)
+
+        task = asyncio.ensure_future(request())
+        await asyncio.sleep(0.2)
+        inner.release()
+        await task
+        # ожидание inner в задержку outer не попало; замер получили оба лимитера
+        assert list(outer._latencies) == list(inner._latencies)
+        assert len(outer._latencies) == 1 and outer._latencies[0] < 0.15
+
+    asyncio.run(scenario())
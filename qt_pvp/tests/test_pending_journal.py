@@ -0,0 +1,162 @@
+import json
+import os
+import datetime
+import pytest
+from qt_pvp import pending_journal
+from qt_pvp import state_store
+from qt_pvp import functions as fs
+
+
+def _it(name, **extra):
+    return {"name": name, "reg_id": "104039", "report": {"switch_events": [1, 2, 3]}, **extra}
+
+
+@pytest.fixture
+def journal(tmp_path):
+    j = pending_journal.PendingJournal(str(tmp_path / "pending"), compact_interval=0, compact_min_records=4)
+    pending_journal.set_journal(j)
+    yield j
+    pending_journal.set_journal(None)
+
+
+def test_enqueue_dedup_and_complete(journal):
+    fs.append_pending_interests("104039", [_it("A"), _it("B"), _it("A")])
+    fs.append_pending_interests("104039", [_it("B"), _it("C")])
+    assert [it["name"] for it in fs.get_pending_interests("104039")] == ["A", "B", "C"]
+    fs.remove_pending_interest("104039", "B")
+    assert [it["name"] for it in fs.get_pending_interests("104039")] == ["A", "C"]
+    # после завершения то же имя снова можно поставить
+    fs.append_pending_interests("104039", [_it("B")])
+    assert [it["name"] for it in fs.get_pending_interests("104039")] == ["A", "C", "B"]
+
+
+def test_replay_after_restart(tmp_path, journal):
+    fs.append_pending_interests("104039", [_it("A"), _it("B"), _it("C", at=datetime.datetime(2025, 1, 1))])
+    assert fs.claim_pending_interest("104039", "A")
+    assert not fs.claim_pending_interest("104039", "A")
+    fs.fail_pending_interest("104039", "A", "boom")
+    fs.claim_pending_interest("104039", "B")
+    fs.remove_pending_interest("104039", "C")
+
+    # битый хвост от падения посреди записи
+    with open(journal.device("104039").path, "a", encoding="utf-8") as f:
+        f.write('{"op": "enq')
+    journal.close()
+
+    j2 = pending_journal.PendingJournal(journal.folder, compact_interval=0)
+    dev = j2.device("104039")
+    assert [it["name"] for it in dev.items()] == ["A", "B"]
+    # незавершённый claim после рестарта снова доступен
+    assert dev.claim("B")
+    assert dev._index["A"]["attempts"] == 1
+    j2.close()
+
+
+def test_replay_keeps_reg_id_that_file_name_cannot(journal):
+    # в имени файла "/" и пробел заменяются — reg_id берётся из заголовка журнала
+    fs.append_pending_interests("dev/1 A", [_it("A")])
+    assert os.path.basename(journal.device("dev/1 A").path) == "dev_1_A.journal"
+    journal.close()
+
+    j2 = pending_journal.PendingJournal(journal.folder, compact_interval=0)
+    assert list(j2._devices) == ["dev/1 A"]
+    assert [it["name"] for it in j2.get_pending("dev/1 A")] == ["A"]
+    j2.close()
+
+
+def test_compaction_keeps_live_entries(journal):
+    names = [f"N{i}" for i in range(10)]
+    fs.append_pending_interests("104039", [_it(n) for n in names])
+    for n in names[:8]:
+        fs.remove_pending_interest("104039", n)
+    dev = journal.device("104039")
+    assert dev.needs_compaction()
+    assert journal.compact_due() == 1
+    with open(dev.path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0] == {"op": "device", "reg_id": "104039"}
+    assert [r["name"] for r in lines[1:]] == ["N8", "N9"]
+    fs.append_pending_interests("104039", [_it("N10")])
+    assert [it["name"] for it in fs.get_pending_interests("104039")] == ["N8", "N9", "N10"]
+
+
+def test_seed_from_state_store(tmp_path):
+    json_path = tmp_path / "states.json"
+    json_path.write_text(json.dumps({"regs": {"104039": {"pending_interests": [_it("OLD")]}}}),
+                         encoding="utf-8")
+    state_store.set_store(state_store.JsonStateStore(str(json_path)))
+    j = pending_journal.PendingJournal(str(tmp_path / "pending"), compact_interval=0,
+                                       seed=pending_journal._seed_from_state_store)
+    pending_journal.set_journal(j)
+    try:
+        assert [it["name"] for it in fs.get_pending_interests("104039")] == ["OLD"]
+        # очередь переехала: в хранилище состояний она больше не дублируется
+        assert state_store.get_store().get_pending("104039") == []
+    finally:
+        pending_journal.set_journal(None)
+        state_store.set_store(None)
+
+
+def _main():
+    import os
+    os.environ.setdefault("webdav_hostname", "http://dav")  # cloud_uploader создаёт клиент WebDAV при импорте
+    from main_operator import Main
+    return Main
+
+
+def _timed(name, start, end):
+    return _it(name, report={"switch_events": []}, car_number="A001AA", year=2025, month=3, day=1, start_time=f"2025-03-01 {start}", end_time=f"2025-03-01 {end}")
+
+
+class _Worker:
+    """Вместо _process_one_interest: complete=True — закрывает записи очереди, как успешная обработка."""
+
+    def __init__(self, complete=True):
+        self.complete = complete
+        self.processed = []
+
+    async def _process_one_interest(self, interest, channel_id, pending_names=None):
+        self.processed.append(interest["name"])
+        if self.complete:
+            for name in pending_names:
+                fs.remove_pending_interest("104039", name)
+        return interest["end_time"]
+
+
+def test_interest_claimed_elsewhere_is_skipped(journal):
+    import asyncio
+    Main = _main()
+    fs.append_pending_interests("104039", [_it("A"), _it("B")])
+    assert fs.claim_pending_interest("104039", "B")
+    worker = _Worker()
+
+    assert asyncio.run(Main._run_pending_interest(worker, _it("M"), 0, ["A", "B"])) is None
+    assert worker.processed == []
+    # свой claim на A снят без попытки — A снова можно взять
+    assert fs.claim_pending_interest("104039", "A")
+    assert journal.device("104039")._index["A"]["attempts"] == 0
+
+
+def test_merged_interest_claims_and_completes_its_sources(journal):
+    import asyncio
+    from qt_pvp.interest_merge_funcs import InterestIntervalSet
+    Main = _main()
+    fs.append_pending_interests("104039", [_timed("A", "06:00:00", "06:01:00"), _timed("B", "06:00:30", "06:02:00")])
+
+    (merged, sources), = InterestIntervalSet(fs.get_pending_interests("104039"), eps=1.0).oldest_with_sources(8)
+    assert merged["name"] not in ("A", "B") and sorted(sources) == ["A", "B"]
+    worker = _Worker()
+    assert asyncio.run(Main._run_pending_interest(worker, merged, 0, sources)) == merged["end_time"]
+    assert worker.processed == [merged["name"]]
+    assert fs.get_pending_interests("104039") == []
+
+
+def test_unfinished_interest_goes_back_to_queue(journal):
+    import asyncio
+    Main = _main()
+    fs.append_pending_interests("104039", [_it("A", end_time="2025-03-01 06:01:00")])
+    # обработка вернулась, не убрав интерес из очереди (например, не загрузились кадры)
+    asyncio.run(Main._run_pending_interest(_Worker(complete=False), fs.get_pending_interests("104039")[0], 0))
+    entry = journal.device("104039")._index["A"]
+    assert (entry["state"], entry["attempts"]) == ("queued", 1)
+    assert fs.claim_pending_interest("104039", "A")
@@ -0,0 +1,69 @@
+import asyncio
+import httpx
+import pytest
+from qt_pvp.cms_interface import functions
+from qt_pvp.cms_interface import retry_policy as rp
+
+
+def test_backoff_is_jittered_and_capped():
+    pol = rp.RetryPolicy(base_delay=1.0, max_delay=4.0)
+    for attempt in range(1, 10):
+        for _ in range(20):
+            assert 0.0 <= pol.backoff(attempt) <= min(4.0, 2 ** (attempt - 1))
+
+
+def test_budget_limits_retries_to_fraction_of_traffic():
+    budget = rp.RetryBudget(ratio=0.25, min_tokens=2)
+    assert budget.try_retry() and budget.try_retry()
+    assert not budget.try_retry()
+    for _ in range(4):
+        budget.on_request()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+
+def test_nested_deadline_cannot_extend_outer():
+    with rp.deadline(1):
+        with rp.deadline(100):
+            assert rp.remaining() <= 1
+        assert rp.remaining() <= 1
+    assert rp.remaining() is None
+
+
+def _response(status, payload):
+    return httpx.Response(status, json=payload, request=httpx.Request("GET", "http://cms/"))
+
+
+def test_decorator_classifies_http_status():
+    calls = []
+
+    @functions.cms_data_get_decorator_async(policy=rp.RetryPolicy(max_attempts=5, base_delay=0))
+    async def query(status):
+        calls.append(status)
+        return _response(status, {"result": 0})
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(query(404))
+    assert len(calls) == 1
+
+    calls.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(query(503))
+    assert len(calls) == 5
+
+
+def test_decorator_stops_retrying_at_deadline():
+    calls = []
+
+    @functions.cms_data_get_decorator_async(policy=rp.RetryPolicy(max_attempts=50, base_delay=0.2, max_delay=0.2))
+    async def query():
+        calls.append(1)
+        return {"result": 22}
+
+    async def scenario():
+        with rp.deadline(0.3):
+            await query()
+
+    with pytest.raises(rp.DeadlineExceeded):
+        asyncio.run(scenario())
+    assert 1 <= len(calls) < 10
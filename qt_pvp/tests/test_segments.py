@@ -0,0 +1,40 @@
+from qt_pvp.interests_search.segments import SegmentIndex, STOP, MID, MOVE
+from qt_pvp.interests_search.track_frame import TrackFrame
+import datetime
+
+
+def _frame(speeds, step=2):
+    t0 = datetime.datetime(2025, 3, 1, 8, 0, 0)
+    return TrackFrame.of([
+        {"gt": (t0 + datetime.timedelta(seconds=i * step)).strftime("%Y-%m-%d %H:%M:%S"), "sp": v, "s1": 0}
+        for i, v in enumerate(speeds)
+    ])
+
+
+def _index(frame):
+    # стоп: v <= 3 и >= 6 с; движение: v >= 10 и >= 4 с; шаг не больше 20 с
+    return SegmentIndex(frame, 3, 6, 10, 4, 20, int_speed=True)
+
+
+def test_runs_and_stable_stops():
+    speeds = [0, 0, 20, 0, 0, 0, 0, 5, 20, 20, 20, 0, 0, 0, 0]
+    index = _index(_frame(speeds))
+
+    assert list(index.run_cls) == [STOP, MOVE, STOP, MID, MOVE, STOP]
+    # первая серия стопа: шаг первой точки 0, набирает только 2 с — не стабильна
+    assert index.stable_stop_starts == [3, 11]
+    assert index.first_stable_stop_after(8, right=14) == 11
+    assert index.first_stable_stop_after(8, right=12) is None
+
+
+def test_window_matches_pointwise_scan():
+    speeds = [0, 0, 0, 0, 0, 12, 12, 12, 0, 0, 5, 0, 0, 0, 0, 12, 12, 12, 12]
+    index = _index(_frame(speeds))
+
+    # с начала трека: длинный стоп 0..4 подтверждён движением на 6, затем стоп 11..14 — на 16
+    assert index.last_confirmed_stop(0, 18) == ((11, 16), None)
+    # окно, начатое посреди первого стопа: он не набирает длительность, остаётся только второй
+    assert index.last_confirmed_stop(3, 9) == (None, None)
+    assert index.last_confirmed_stop(3, 18) == ((11, 16), None)
+    # окно до подтверждения второго стопа: он ещё активен и длинный
+    assert index.last_confirmed_stop(0, 15) == ((0, 6), 11)
@@ -0,0 +1,98 @@
+from qt_pvp.cms_interface import cms_api
+from qt_pvp.cms_interface import retry_policy
+import asyncio
+import httpx
+import pytest
+
+
+def _counting(result=None, error=None, delay=0.02):
+    calls = []
+
+    async def fetch(jsession, device_id):
+        calls.append((jsession, device_id, retry_policy.remaining()))
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result if result is not None else httpx.Response(200, json={"result": 0, "id": device_id})
+
+    return calls, fetch
+
+
+@pytest.fixture(autouse=True)
+def _clean():
+    cms_api._inflight.clear()
+    cms_api._recent.clear()
+    yield
+    cms_api._inflight.clear()
+    cms_api._recent.clear()
+
+
+def test_concurrent_callers_share_one_request():
+    calls, fetch = _counting()
+    fetch = cms_api.single_flight(ttl=0)(fetch)
+
+    async def run():
+        return await asyncio.gather(*(fetch(f"js{i}", "r1") for i in range(5)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results) and results[0].json()["id"] == "r1"
+
+
+def test_failure_reaches_every_waiter_and_is_not_cached():
+    calls, fetch = _counting(error=RuntimeError("cms down"))
+    fetch = cms_api.single_flight(ttl=60)(fetch)
+
+    async def run():
+        first = await asyncio.gather(*(fetch("js", "r1") for _ in range(3)), return_exceptions=True)
+        second = await asyncio.gather(fetch("js", "r1"), return_exceptions=True)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert all(isinstance(e, RuntimeError) for e in first + second)
+    assert len(calls) == 2
+
+
+def test_error_response_is_not_cached():
+    offline = httpx.Response(200, json={"result": 32})
+    calls, fetch = _counting(result=offline)
+    fetch = cms_api.single_flight(ttl=60)(fetch)
+
+    async def run():
+        await fetch("js", "r1")
+        return await fetch("js", "r1")
+
+    assert asyncio.run(run()).json()["result"] == 32
+    assert len(calls) == 2
+
+
+def test_ttl_expiry():
+    calls, fetch = _counting(delay=0)
+    fetch = cms_api.single_flight(ttl=0.05)(fetch)
+
+    async def run():
+        await fetch("js", "r1")
+        await fetch("js2", "r1")       # jsession не входит в ключ — из кэша
+        await asyncio.sleep(0.1)
+        await fetch("js", "r1")
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_shared_request_does_not_inherit_callers_deadline():
+    calls, fetch = _counting(delay=0.1)
+    fetch = cms_api.single_flight(ttl=0)(fetch)
+
+    async def short():
+        with retry_policy.deadline(0.02):
+            return await fetch("js", "r1")
+
+    async def run():
+        return await asyncio.gather(short(), fetch("js", "r1"), return_exceptions=True)
+
+    first, second = asyncio.run(run())
+    # у общего запроса дедлайна нет; первый вызвавший перестал ждать по своему, второй дождался
+    assert calls[0][2] is None
+    assert isinstance(first, retry_policy.DeadlineExceeded)
+    assert second.json()["result"] == 0
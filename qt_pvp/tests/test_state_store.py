@@ -0,0 +1,228 @@
+import json
+import threading
+import pytest
+from qt_pvp import state_store
+from qt_pvp import pending_journal
+from qt_pvp import functions as fs
+
+
+def _states_fixture():
+    return {
+        "regs": {
+            "104039": {
+                "plate": "А123ВС",
+                "last_upload_time": "2025-01-01 10:00:00",
+                "verified_until": "2025-01-01 10:00:00",
+                "pending_interests": [
+                    {"name": "A_2025.01.01 10.00.00-10.01.00", "reg_id": "104039"},
+                    {"name": "B_2025.01.01 11.00.00-11.01.00", "reg_id": "104039"},
+                ],
+            },
+            "118270": {"plate": "Х777ХХ", "pending_interests": []},
+        }
+    }
+
+
+@pytest.fixture(params=["json", "sharded", "sqlite", "cached"])
+def store(request, tmp_path):
+    json_path = tmp_path / "states.json"
+    json_path.write_text(json.dumps(_states_fixture(), ensure_ascii=False), encoding="utf-8")
+    if request.param == "json":
+        st = state_store.JsonStateStore(str(json_path))
+    elif request.param == "sharded":
+        st = state_store.ShardedJsonStateStore(str(tmp_path / "states"), import_from=str(json_path))
+    elif request.param == "sqlite":
+        st = state_store.SqliteStateStore(str(tmp_path / "states.sqlite3"), import_from=str(json_path))
+    else:
+        st = state_store.CachedStateStore(state_store.JsonStateStore(str(json_path)),
+                                          durability="interval", flush_interval=0.05)
+    state_store.set_store(st)
+    # очередь pending — в самом хранилище, без журнала
+    pending_journal.set_journal(None)
+    yield st
+    state_store.set_store(None)
+
+
+def test_import_keeps_regs_and_pending(store):
+    reg = fs.get_reg_info("104039")
+    assert reg["plate"] == "А123ВС"
+    assert "pending_interests" not in reg
+    names = [it["name"] for it in fs.get_pending_interests("104039")]
+    assert names == ["A_2025.01.01 10.00.00-10.01.00", "B_2025.01.01 11.00.00-11.01.00"]
+    assert store.find_reg_id_by_plate("Х777ХХ") == "118270"
+
+
+def test_pending_append_dedup_and_remove(store):
+    fs.append_pending_interests("104039", [
+        {"name": "A_2025.01.01 10.00.00-10.01.00"},
+        {"name": "C_2025.01.01 12.00.00-12.01.00"},
+        {"reg_id": "104039"},  # без имени — не добавляется
+    ])
+    names = [it["name"] for it in fs.get_pending_interests("104039")]
+    assert names[-1] == "C_2025.01.01 12.00.00-12.01.00"
+    assert len(names) == 3
+
+    fs.remove_pending_interest("104039", "A_2025.01.01 10.00.00-10.01.00")
+    names = [it["name"] for it in fs.get_pending_interests("104039")]
+    assert "A_2025.01.01 10.00.00-10.01.00" not in names
+    # соседний регистратор не задет
+    assert fs.get_pending_interests("118270") == []
+
+
+def test_missing_reg_pending_is_empty_and_not_created(store):
+    assert fs.get_pending_interests("000000") == []
+    assert store.get_reg("000000") is None
+
+
+def test_time_fields_only_move_forward(store):
+    fs.save_new_reg_last_upload_time("104039", "2024-12-31 10:00:00")
+    assert fs.get_reg_info("104039")["last_upload_time"] == "2025-01-01 10:00:00"
+    fs.save_new_reg_last_upload_time("104039", "2025-01-02 10:00:00")
+    assert fs.get_reg_info("104039")["last_upload_time"] == "2025-01-02 10:00:00"
+    fs.save_reg_verified_until("104039", "2025-01-01 10:00:00")
+    fs.save_reg_verified_until_long("104039", "2025-01-03 00:00:00")
+    reg = fs.get_reg_info("104039")
+    assert reg["verified_until"] == "2025-01-01 10:00:00"
+    assert reg["verified_until_long"] == "2025-01-03 00:00:00"
+
+
+def test_get_reg_info_fills_missing_fields(store):
+    reg = fs.get_reg_info("118270")
+    assert reg["euro_container_alarm"] == 4
+    assert "verified_until_long" in reg
+    created = fs.get_reg_info("555555")
+    assert created["by_lifting_limit_switch"] == 1
+    assert store.get_reg("555555") is not None
+
+
+def test_concurrent_appends_are_not_lost(store):
+    def worker(n):
+        for i in range(10):
+            fs.append_pending_interests("118270", [{"name": f"T{n}_{i}"}])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(fs.get_pending_interests("118270")) == 40
+
+
+def test_sqlite_auto_import_runs_once(tmp_path):
+    json_path = tmp_path / "states.json"
+    json_path.write_text(json.dumps(_states_fixture(), ensure_ascii=False), encoding="utf-8")
+    db = str(tmp_path / "states.sqlite3")
+    st = state_store.SqliteStateStore(db, import_from=str(json_path))
+    st.remove_pending("104039", "A_2025.01.01 10.00.00-10.01.00", factory=dict)
+    st.close()
+    st = state_store.SqliteStateStore(db, import_from=str(json_path))
+    assert len(st.get_pending("104039")) == 1
+    exported = st.export_states()
+    assert set(exported["regs"]) == {"104039", "118270"}
+    st.close()
+
+
+def test_cached_store_coalesces_writes(tmp_path):
+    json_path = tmp_path / "states.json"
+    json_path.write_text(json.dumps(_states_fixture(), ensure_ascii=False), encoding="utf-8")
+    inner = state_store.JsonStateStore(str(json_path))
+    calls = []
+    orig = inner.merge_write
+    inner.merge_write = lambda regs, pending: (calls.append((set(regs), set(pending))), orig(regs, pending))[1]
+    st = state_store.CachedStateStore(inner, durability="shutdown")
+    state_store.set_store(st)
+    pending_journal.set_journal(None)
+    try:
+        for i in range(20):
+            fs.append_pending_interests("104039", [{"name": f"N{i}"}])
+            fs.save_new_reg_last_upload_time("104039", f"2025-01-02 10:00:{i:02d}")
+        fs.remove_pending_interest("104039", "N0")
+        # до checkpoint на диске — исходное состояние
+        assert len(inner.get_pending("104039")) == 2
+        st.checkpoint()
+        assert len(calls) == 1
+        assert len(inner.get_pending("104039")) == 2 + 19
+        assert inner.get_reg("104039")["last_upload_time"] == "2025-01-02 10:00:19"
+    finally:
+        state_store.set_store(None)
+
+
+@pytest.mark.parametrize("backend", ["json", "sharded", "sqlite"])
+def test_cached_stores_do_not_lose_each_others_updates(tmp_path, backend):
+    # два процесса (два кэша над одним хранилищем) правят разные поля и очередь одного рега
+    json_path = tmp_path / "states.json"
+    json_path.write_text(json.dumps(_states_fixture(), ensure_ascii=False), encoding="utf-8")
+
+    def inner():
+        if backend == "json":
+            return state_store.JsonStateStore(str(json_path))
+        if backend == "sharded":
+            return state_store.ShardedJsonStateStore(str(tmp_path / "states"), import_from=str(json_path))
+        return state_store.SqliteStateStore(str(tmp_path / "states.sqlite3"), import_from=str(json_path))
+
+    a = state_store.CachedStateStore(inner(), durability="shutdown")
+    b = state_store.CachedStateStore(inner(), durability="shutdown")
+    assert a.get_reg("104039") and b.get_reg("104039")   # оба прочитали исходную запись
+
+    def set_field(key, value):
+        def mutator(reg, created):
+            reg[key] = value
+            return True
+        return mutator
+
+    a.update_reg("104039", set_field("last_upload_time", "2025-01-02 00:00:00"), factory=dict)
+    a.append_pending("104039", [{"name": "C_2025.01.01 12.00.00-12.01.00"}], factory=dict)
+    b.update_reg("104039", set_field("ignore", True), factory=dict)
+    b.remove_pending("104039", "A_2025.01.01 10.00.00-10.01.00", factory=dict)
+    a.checkpoint()
+    b.checkpoint()
+
+    check = inner()
+    try:
+        reg = check.get_reg("104039")
+        assert reg["last_upload_time"] == "2025-01-02 00:00:00" and reg["ignore"] is True
+        assert [it["name"] for it in check.get_pending("104039")] == \
+            ["B_2025.01.01 11.00.00-11.01.00", "C_2025.01.01 12.00.00-12.01.00"]
+        # после сброса кэш видит и чужую правку
+        assert b.get_reg("104039")["last_upload_time"] == "2025-01-02 00:00:00"
+    finally:
+        a.close()
+        b.close()
+        check.close()
+
+
+def test_sharded_plate_index_follows_changes(tmp_path):
+    st = state_store.ShardedJsonStateStore(str(tmp_path / "states"))
+    st.update_reg("1", lambda reg, created: True, factory=lambda: {"plate": "а 123 вс"})
+    assert st.find_reg_id_by_plate("А123ВС") == "1"
+
+    def _rename(reg, created):
+        reg["plate"] = "В456ОР"
+        return True
+    st.update_reg("1", _rename, factory=dict)
+    assert st.find_reg_id_by_plate("А123ВС") is None
+    assert st.find_reg_id_by_plate("в456ор") == "1"
+    # каждый регистратор — свой файл
+    assert sorted(fn for fn in (tmp_path / "states").iterdir() if fn.suffix == ".json") == \
+        [tmp_path / "states" / "1.json", tmp_path / "states" / "index.json"]
+
+
+@pytest.mark.parametrize("backend", ["sharded", "sqlite"])
+def test_cli_import_export_follows_backend(tmp_path, backend):
+    src = tmp_path / "states.json"
+    src.write_text(json.dumps(_states_fixture(), ensure_ascii=False), encoding="utf-8")
+    target, dst = tmp_path / "store", tmp_path / "out.json"
+    assert state_store.main(["import", "--backend", backend, "--path", str(target), "--src", str(src)]) == 0
+    assert state_store.main(["export", "--backend", backend, "--path", str(target), "--dst", str(dst)]) == 0
+    exported = json.loads(dst.read_text(encoding="utf-8"))
+    assert set(exported["regs"]) == {"104039", "118270"}
+    assert len(exported["regs"]["104039"]["pending_interests"]) == 2
+
+
+def test_incomplete_backend_fails_on_creation():
+    class NoImport(state_store.StateStore):
+        get_reg = update_reg = iter_regs = get_pending = lambda self, *a: None
+        set_pending = append_pending = remove_pending = lambda self, *a: None
+
+    with pytest.raises(TypeError, match="import_states"):
+        NoImport()
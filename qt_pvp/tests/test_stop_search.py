@@ -0,0 +1,82 @@
+from qt_pvp import geo_funcs, stop_search
+import datetime
+import random
+
+T0 = datetime.datetime(2025, 3, 1, 6, 0, 0)
+
+
+def _reference(tracks, sites, radius_m, min_speed, min_dur):
+    """Эталон — прежний поточечный автомат find_stops_near_sites_by_date."""
+    norm = []
+    for t in tracks:
+        try:
+            dt = datetime.datetime.strptime(t["gt"], "%Y-%m-%d %H:%M:%S")
+            lat, lon = geo_funcs._parse_latlon(t["ps"])
+        except Exception:
+            continue
+        norm.append((dt, lat, lon, float(t.get("sp") or 0)))
+    norm.sort(key=lambda r: r[0])
+    out = []
+    for sid, s_lat, s_lon in sites:
+        stops, run = [], None
+        for dt, lat, lon, sp in norm + [(None, 0, 0, 0)]:
+            inside = dt is not None and sp <= min_speed and geo_funcs._haversine_m(lat, lon, s_lat, s_lon) <= radius_m
+            if inside:
+                run = (run[0] if run else dt, dt, lat, lon)
+            elif run:
+                dur = (run[1] - run[0]).total_seconds()
+                if dur >= min_dur:
+                    stops.append({"start": run[0].strftime("%Y-%m-%d %H:%M:%S"),
+                                  "end": run[1].strftime("%Y-%m-%d %H:%M:%S"), "duration_sec": dur,
+                                  "distance_m": geo_funcs._haversine_m(run[2], run[3], s_lat, s_lon)})
+                run = None
+        out.append({"site_id": sid, "lat": s_lat, "lon": s_lon,
+                    "stops": [min(stops, key=lambda s: s["distance_m"])] if stops else []})
+    return out
+
+
+def _day(rnd, sites, n=2000):
+    tracks, t = [], T0
+    lat, lon = 53.6, 56.3
+    for _ in range(n):
+        if rnd.random() < 0.03:
+            _, lat, lon = rnd.choice(sites)
+            lat += rnd.uniform(-0.001, 0.001)
+            lon += rnd.uniform(-0.001, 0.001)
+        lat += rnd.uniform(-0.0001, 0.0001)
+        ps = f"{lat:.6f},{lon:.6f}" if rnd.random() > 0.01 else "мусор"
+        gt = t.strftime("%Y-%m-%d %H:%M:%S") if rnd.random() > 0.005 else "нет времени"
+        tracks.append({"gt": gt, "ps": ps, "sp": rnd.choice([0, 0, 1, 2, 5, 40])})
+        t += datetime.timedelta(seconds=rnd.choice([1, 1, 2, 5, 30]))
+    head = tracks[:50]
+    rnd.shuffle(head)  # порядок треков из CMS не гарантирован
+    tracks[:50] = head
+    return tracks
+
+
+def test_engine_matches_pointwise_automaton():
+    rnd = random.Random(11)
+    sites = stop_search.prepare_sites(
+        [{"id": str(k), "lat": 53.6 + rnd.uniform(-0.05, 0.05), "lon": 56.3 + rnd.uniform(-0.05, 0.05)}
+         for k in range(60)] + [{"id": "bad", "lat": "x", "lon": 1}])
+    assert len(sites) == 60
+
+    found = 0
+    for seed in range(2):
+        tracks = _day(random.Random(seed), sites)
+        for radius in (50, 150, 400):
+            got = stop_search.find_stops(tracks, sites, radius, 2, 10)
+            want = _reference(tracks, sites, radius, 2, 10)
+            found += sum(len(r["stops"]) for r in want)
+            assert [r["site_id"] for r in got] == [r["site_id"] for r in want]
+            for g, w in zip(got, want):
+                assert [(s["start"], s["end"], s["duration_sec"]) for s in g["stops"]] == \
+                       [(s["start"], s["end"], s["duration_sec"]) for s in w["stops"]]
+                for gs, ws in zip(g["stops"], w["stops"]):
+                    assert abs(gs["distance_m"] - ws["distance_m"]) < 1e-6
+    assert found
+
+
+def test_no_tracks_keeps_sites():
+    sites = [("a", 53.6, 56.3)]
+    assert stop_search.find_stops([], sites, 100, 3, 6) == [{"site_id": "a", "lat": 53.6, "lon": 56.3, "stops": []}]
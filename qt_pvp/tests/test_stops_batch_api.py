@@ -0,0 +1,67 @@
+import os
+
+os.environ.setdefault("webdav_hostname", "http://dav")  # cloud_uploader создаёт клиент WebDAV при импорте
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from qt_pvp.data import settings
+from qt_pvp import api
+import asyncio
+import json
+import pytest
+
+BODY = {"reg_ids": ["r1", "bad", "boom"], "date_from": "2025-03-01", "date_to": "2025-03-02",
+        "sites": [{"id": "s1", "lat": 55.0, "lon": 37.0}]}
+
+
+class _Main:
+    jsession = "js"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def logged_in():
+        return _Main()
+
+    async def find_stops(reg_id, sites, date, radius_m, jsession):
+        await asyncio.sleep(0.01 if date.endswith("01") else 0)
+        if reg_id == "bad":
+            raise HTTPException(status_code=404, detail="device not found")
+        if reg_id == "boom":
+            raise RuntimeError("cms down")
+        return [{"id": s["id"], "stops": []} for s in sites]
+
+    monkeypatch.setattr(api, "API_KEY", "secret")
+    monkeypatch.setattr(api, "_get_main_logged_in", logged_in)
+    monkeypatch.setattr(api.cms_funcs, "find_stops_near_sites_by_date", find_stops)
+    return TestClient(api.app)
+
+
+def _lines(resp):
+    return [json.loads(line) for line in resp.text.splitlines() if line]
+
+
+def test_per_item_errors_do_not_break_the_stream(client):
+    resp = client.post("/find-stops/batch", json=BODY, headers={"X-API-Key": "secret"})
+    assert resp.status_code == 200 and resp.headers["content-type"].startswith("application/x-ndjson")
+    by_key = {(r["reg_id"], r["date"]): r for r in _lines(resp)}
+    assert len(by_key) == 6
+    assert by_key[("r1", "2025-03-01")]["sites"] == [{"id": "s1", "stops": []}]
+    assert by_key[("bad", "2025-03-02")]["error"] == "device not found"
+    assert by_key[("boom", "2025-03-01")]["error"] == "cms down"
+
+
+def test_stream_order(client, monkeypatch):
+    # по одной паре за раз — строки идут в порядке (устройство, дата)
+    monkeypatch.setitem(settings.config["Process"], "STOPS_BATCH_CONCURRENCY", "1")
+    resp = client.post("/find-stops/batch", json=BODY, headers={"X-API-Key": "secret"})
+    assert [(r["reg_id"], r["date"]) for r in _lines(resp)] == [
+        (reg_id, date) for reg_id in BODY["reg_ids"] for date in ("2025-03-01", "2025-03-02")]
+
+
+def test_unauthenticated_and_oversized_requests_are_rejected(client, monkeypatch):
+    assert client.post("/find-stops/batch", json=BODY).status_code == 403
+    assert client.post("/find-stops/batch", json=BODY, headers={"X-API-Key": "wrong"}).status_code == 403
+    monkeypatch.setitem(settings.config["Process"], "STOPS_BATCH_MAX_DEVICES", "2")
+    resp = client.post("/find-stops/batch", json=BODY, headers={"X-API-Key": "secret"})
+    assert resp.status_code == 422
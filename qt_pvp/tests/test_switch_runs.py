@@ -0,0 +1,53 @@
+from qt_pvp.interests_search.switch_runs import SwitchRuns, StopStartTracker, SW, LOW, MOVE, BAD
+from qt_pvp.interests_search.track_frame import TrackFrame
+import datetime
+import random
+
+EURO, KGO = 23, 22
+
+
+def _frame(rows, step=1):
+    t0 = datetime.datetime(2025, 3, 1, 8, 0, 0)
+    return TrackFrame.of([
+        {"gt": (t0 + datetime.timedelta(seconds=i * step)).strftime("%Y-%m-%d %H:%M:%S"), "sp": sp, "s1": s1}
+        for i, (sp, s1) in enumerate(rows)
+    ])
+
+
+def test_lifting_end_walks_runs():
+    e, k = 1 << EURO, 1 << KGO
+    rows = [(0, e), (0, e | k), (0, 5), (12, 0), (0, k), (12, 0), (12, 0), (12, 0), (0, None), (0, e)]
+    runs = SwitchRuns(_frame(rows), EURO, KGO, min_move_speed=10)
+
+    assert [r.kind for r in runs.runs] == [SW, LOW, MOVE, SW, MOVE, BAD, SW]
+    assert list(runs.switch_idx) == [0, 1, 4, 9]
+    assert list(runs.kgo) == [False, True, False, False, True, False, False, False, False, False]
+
+    # движение с 3 не сбрасывается концевиком на 4 и набирает 3 с к точке 6
+    assert runs.scan_lifting_end(0, 3) == (6, 4, [1, 4], 3)
+    # длительность не набрана — упираемся в неразобранный s1
+    assert runs.scan_lifting_end(0, 10) == (7, 4, [1, 4], 3)
+
+
+def test_stop_tracker_matches_pointwise_update():
+    rnd = random.Random(5)
+    speeds = [rnd.choice([0, 1, 3, 4, 6, 12]) for _ in range(300)]
+    frame = _frame([(v, 0) for v in speeds])
+    tracker = StopStartTracker(frame, min_stop_speed=3, min_move_speed=6)
+
+    started, prev = None, None
+    i = 0
+    while i < len(speeds):
+        # эталон — прежний поточечный _update_stop_state
+        j = min(len(speeds) - 1, i + rnd.randint(0, 15))
+        for p in range(i, j + 1):
+            v = speeds[p]
+            if v <= 3 and (prev is None or prev > 3):
+                started = p
+            if v >= 6:
+                started = None
+            prev = v
+        tracker.advance(i, j)
+        assert tracker.started == started
+        # пропуск точек, как после обработанного концевика
+        i = j + 1 + rnd.randint(0, 3)
@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+import pytest
+from qt_pvp.cms_interface import telemetry_cache as tc
+from qt_pvp.cms_interface import cms_api
+
+
+def test_find_gaps():
+    assert tc.find_gaps([], 10, 20) == [(10, 20)]
+    assert tc.find_gaps([(0, 12), (15, 16)], 10, 20) == [(13, 14), (17, 20)]
+    assert tc.find_gaps([(5, 25)], 10, 20) == []
+    assert tc.find_gaps([(10, 10), (20, 30)], 10, 20) == [(11, 19)]
+
+
+def _fmt(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+@pytest.fixture
+def fake_cms(monkeypatch):
+    calls = []
+
+    async def tracks_pages(jsession, device_id, start_time, end_time):
+        calls.append(("tracks", start_time, end_time))
+        a = datetime.datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
+        b = datetime.datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")
+        pts, t = [], a
+        while t <= b:
+            if t.second % 10 == 0:
+                pts.append({"gt": _fmt(t), "sp": 0, "s1": 0})
+            t += datetime.timedelta(seconds=1)
+        return [{"tracks": pts}]
+
+    async def alarm_pages(jsession, device_id, begin_time, end_time, arm_types="19,20,69,70"):
+        calls.append(("alarms", begin_time, end_time))
+        return [{"alarms": [{"guid": "g1", "atp": 19, "bTimeStr": begin_time, "eTimeStr": begin_time},
+                            {"guid": "g2", "atp": 19, "bTimeStr": end_time, "eTimeStr": end_time}]}]
+
+    monkeypatch.setattr(cms_api, "get_device_track_all_pages_async", tracks_pages)
+    monkeypatch.setattr(cms_api, "get_device_alarm_all_pages_async", alarm_pages)
+    return calls
+
+
+def test_second_request_fetches_only_missing_part(tmp_path, fake_cms):
+    cache = tc.TelemetryCache(str(tmp_path / "t.sqlite3"), settle_horizon_sec=3600)
+    base = datetime.datetime.now().replace(second=0, microsecond=0) - datetime.timedelta(days=1)
+
+    async def run():
+        first = await cache.get_tracks("js", "r1", _fmt(base), _fmt(base + datetime.timedelta(minutes=10)))
+        second = await cache.get_tracks("js", "r1", _fmt(base + datetime.timedelta(minutes=5)),
+                                        _fmt(base + datetime.timedelta(minutes=20)))
+        again = await cache.get_tracks("js", "r1", _fmt(base), _fmt(base + datetime.timedelta(minutes=20)))
+        return first, second, again
+
+    first, second, again = asyncio.run(run())
+    assert fake_cms == [
+        ("tracks", _fmt(base), _fmt(base + datetime.timedelta(minutes=10))),
+        ("tracks", _fmt(base + datetime.timedelta(minutes=10, seconds=1)),
+         _fmt(base + datetime.timedelta(minutes=20))),
+    ]
+    gts = [t["gt"] for t in again]
+    assert gts == sorted(gts) and len(gts) == len(set(gts))
+    assert [t["gt"] for t in second] == [g for g in gts if g >= _fmt(base + datetime.timedelta(minutes=5))]
+
+
+def test_fresh_tail_is_always_from_cms(tmp_path, fake_cms):
+    cache = tc.TelemetryCache(str(tmp_path / "t.sqlite3"), settle_horizon_sec=3600)
+    now = datetime.datetime.now().replace(microsecond=0)
+    start = _fmt(now - datetime.timedelta(hours=2))
+    end = _fmt(now)
+
+    async def run():
+        await cache.get_alarms("js", "r1", start, end)
+        await cache.get_alarms("js", "r1", start, end)
+
+    asyncio.run(run())
+    kinds = [c for c in fake_cms if c[0] == "alarms"]
+    # устоявшаяся часть — один раз, свежий хвост — на каждый запрос
+    assert len(kinds) == 3
+    assert kinds[0][1] == start
+    assert kinds[1][2] == end and kinds[2][2] == end
+
+
+def test_empty_fetch_is_not_covered(tmp_path, monkeypatch):
+    cache = tc.TelemetryCache(str(tmp_path / "t.sqlite3"), settle_horizon_sec=3600)
+    base = datetime.datetime.now().replace(second=0, microsecond=0) - datetime.timedelta(days=1)
+    start, end = _fmt(base), _fmt(base + datetime.timedelta(minutes=10))
+    uploaded = {"until": None}
+    calls = []
+
+    async def tracks_pages(jsession, device_id, start_time, end_time):
+        # CMS отдаёт точки только до того момента, до которого регистратор их уже дослал
+        calls.append((start_time, end_time))
+        a, b = (datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S") for v in (start_time, end_time))
+        pts = [base + datetime.timedelta(seconds=30 * k) for k in range(21)]
+        return [{"tracks": [{"gt": _fmt(t), "sp": 0, "s1": 0} for t in pts
+                            if a <= t <= b and uploaded["until"] and t <= uploaded["until"]]}]
+
+    monkeypatch.setattr(cms_api, "get_device_track_all_pages_async", tracks_pages)
+
+    async def run():
+        empty = await cache.get_tracks("js", "r1", start, end)
+        uploaded["until"] = base + datetime.timedelta(minutes=5)
+        partial = await cache.get_tracks("js", "r1", start, end)
+        uploaded["until"] = base + datetime.timedelta(minutes=10)
+        full = await cache.get_tracks("js", "r1", start, end)
+        cached = await cache.get_tracks("js", "r1", start, end)
+        refreshed = await cache.get_tracks("js", "r1", start, end, refresh=True)
+        return empty, partial, full, cached, refreshed
+
+    empty, partial, full, cached, refreshed = asyncio.run(run())
+    assert empty == []
+    assert len(partial) == 11 and len(full) == 21
+    assert cached == full and refreshed == full
+    # пустой ответ покрытия не дал, частичный — только до последней точки;
+    # скачанное уже устоявшимся refresh не перекачивает
+    assert calls == [(start, end), (start, end), (_fmt(base + datetime.timedelta(minutes=5, seconds=1)), end)]
+
+
+def test_refresh_refetches_only_ranges_cached_before_settled(tmp_path, fake_cms):
+    path = str(tmp_path / "t.sqlite3")
+    now = datetime.datetime.now().replace(microsecond=0)
+    start = _fmt(now - datetime.timedelta(hours=2))
+    settled_border = now - datetime.timedelta(hours=1)
+
+    async def run():
+        # хвост моложе часа скачан и закэширован неустоявшимся
+        await tc.TelemetryCache(path, settle_horizon_sec=3600).get_tracks("js", "r1", start, _fmt(now))
+        fake_cms.clear()
+        # прошло время: с горизонтом в 10 минут весь запрошенный кусок уже устоялся
+        later = tc.TelemetryCache(path, settle_horizon_sec=600)
+        end = _fmt(now - datetime.timedelta(minutes=20))
+        plain = await later.get_tracks("js", "r1", start, end)
+        plain_calls = list(fake_cms)
+        rechecked = await later.get_tracks("js", "r1", start, end, refresh=True)
+        again = await later.get_tracks("js", "r1", start, end, refresh=True)
+        return plain, plain_calls, rechecked, again
+
+    plain, plain_calls, rechecked, again = asyncio.run(run())
+    assert plain_calls == []
+    assert len(fake_cms) == 1
+    _, fetched_from, fetched_to = fake_cms[0]
+    # перекачан только кусок, скачанный до того, как устоялся; после этого он уже устоявшийся
+    assert fetched_from >= _fmt(settled_border - datetime.timedelta(seconds=5))
+    assert fetched_to == _fmt(now - datetime.timedelta(minutes=20))
+    assert [t["gt"] for t in rechecked] == [t["gt"] for t in plain] == [t["gt"] for t in again]
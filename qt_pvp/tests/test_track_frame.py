@@ -0,0 +1,26 @@
+from qt_pvp.interests_search.track_frame import TrackFrame, dt_to_ts
+import datetime
+
+
+def test_columns_match_row_parsing():
+    tracks = [
+        {"gt": "2025-03-01 08:00:00", "sp": 15, "s1": 1 << 23, "ps": "55.1,37.2"},
+        {"gt": "2025-03-01 08:00:07", "sp": None, "s1": "8", "ps": "55.1,37.2"},
+        {"gt": "2025-03-01 08:01:00", "sp": "42", "s1": None},
+    ]
+    frame = TrackFrame.of(tracks)
+
+    assert len(frame) == 3
+    for i, t in enumerate(tracks):
+        assert frame.dt(i) == datetime.datetime.strptime(t["gt"], "%Y-%m-%d %H:%M:%S")
+    assert list(frame.ts[1:] - frame.ts[:-1]) == [7, 53]
+    assert [frame.speed_int(i) for i in range(3)] == [15, 0, 42]
+    assert frame.bit(0, 23) and not frame.bit(0, 3)
+    assert frame.bit(1, 3) and not frame.bit(1, None)
+    assert list(frame.s1_ok) == [True, True, False]
+    assert frame.geo(0) == frame.geo(1) == "55.1,37.2" and frame.geo(2) is None
+    assert len(frame.geo_values) == 1
+    assert frame.lat[0] == 55.1 and frame.lon[1] == 37.2
+    # готовый фрейм не пересобирается
+    assert TrackFrame.of(frame) is frame
+    assert dt_to_ts(frame.dt(2)) == frame.ts[2]